@@ -0,0 +1,92 @@
+import time
+
+import SimpleITK as sitk
+import numpy as np
+
+from dicom_utils import augmentation
+
+# Size (x, y, z) of the volume on which the per voxel loop is compared with the vectorized version.
+SMALL_SIZE = (32, 32, 16)
+# Size (x, y, z) of the volume on which only the vectorized version is timed.
+LARGE_SIZE = (512, 512, 100)
+SPACING = (0.7, 0.7, 2.5)
+ORIGIN = (-120., -95., 40.)
+# Slightly oblique direction, so that all the terms of the index to physical mapping are checked.
+DIRECTION = tuple(sitk.VersorTransform((0.1, 0.2, 0.3), 0.2).GetMatrix())
+
+
+def create_image(size):
+    image = sitk.Image(size, sitk.sitkFloat32)
+    image.SetSpacing(SPACING)
+    image.SetOrigin(ORIGIN)
+    image.SetDirection(DIRECTION)
+
+    return image
+
+
+def radialdistort_transform_loop(image, k1, k2, k3):
+    """Reference implementation computing the displacement field voxel by voxel.
+
+    """
+
+    c = np.array(image.TransformContinuousIndexToPhysicalPoint(np.array(image.GetSize()) / 2.0))
+    delta_image = sitk.Image(image.GetSize(), sitk.sitkVectorFloat64)
+    delta_image.CopyInformation(image)
+    index_ranges = [np.arange(0, i) for i in image.GetSize()]
+    for indexes in np.nditer(np.meshgrid(*index_ranges)):
+        index = tuple(int(i) for i in indexes)
+        delta_image[index] = np.array(image.TransformContinuousIndexToPhysicalPoint(index)) - c
+    delta_image_components = [sitk.VectorIndexSelectionCast(delta_image, index) for index in
+                              range(image.GetDimension())]
+
+    r2_image = sitk.Image(image.GetSize(), sitk.sitkFloat64)
+    r2_image.CopyInformation(image)
+    for img in delta_image_components:
+        r2_image += img ** 2
+    r4_image = r2_image ** 2
+    r6_image = r2_image * r4_image
+    disp_image = k1 * r2_image + k2 * r4_image + k3 * r6_image
+
+    return sitk.Compose([disp_image * img for img in delta_image_components])
+
+
+def time_vectorized(image, seed=0):
+    np.random.seed(seed)
+    start = time.perf_counter()
+    transform = augmentation.radialdistort_transform(image)
+    elapsed = time.perf_counter() - start
+
+    return transform, elapsed
+
+
+def main():
+    image = create_image(SMALL_SIZE)
+
+    # Same random coefficients drawn by radialdistort_transform.
+    np.random.seed(0)
+    k1, k2, k3 = (np.random.uniform(1e-7, 1e-5), np.random.uniform(1e-15, 1e-12), np.random.uniform(1e-15, 1e-12))
+
+    start = time.perf_counter()
+    loop_field = radialdistort_transform_loop(image, k1, k2, k3)
+    loop_elapsed = time.perf_counter() - start
+
+    transform, vectorized_elapsed = time_vectorized(image)
+    vectorized_field = sitk.GetArrayFromImage(transform.GetDisplacementField())
+    max_difference = np.abs(vectorized_field - sitk.GetArrayFromImage(loop_field)).max()
+
+    print("{0:12} {1:>14} {2:>14} {3:>10} {4:>16}".format("size", "loop [s]", "vectorized [s]", "speedup",
+                                                          "max difference"))
+    print("{0:12} {1:14.3f} {2:14.3f} {3:10.1f} {4:16.3g}".format("x".join(map(str, SMALL_SIZE)), loop_elapsed,
+                                                                 vectorized_elapsed,
+                                                                 loop_elapsed / vectorized_elapsed, max_difference))
+
+    _, vectorized_elapsed = time_vectorized(create_image(LARGE_SIZE))
+    # The loop time is extrapolated from the small volume, running it would take hours.
+    loop_elapsed *= np.prod(LARGE_SIZE) / np.prod(SMALL_SIZE)
+    print("{0:12} {1:14.3f} {2:14.3f} {3:10.1f} {4:>16}".format("x".join(map(str, LARGE_SIZE)), loop_elapsed,
+                                                               vectorized_elapsed,
+                                                               loop_elapsed / vectorized_elapsed, "-"))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+from .index import *
 from .loaders import *
 from .processing import *
 from .registration import *
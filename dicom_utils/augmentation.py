@@ -1,6 +1,12 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import SimpleITK as sitk
 import numpy as np
 
+from .processing import to_numpy
+from .utils import set_number_of_threads
+
 
 # FROM: https://github.com/SimpleITK/SPIE2018_COURSE
 # %
@@ -57,106 +63,206 @@ def eul2quat(ax, ay, az, atol=1e-8):
     return qv
 
 
+def _get_random_state(random_state=None):
+    '''
+    Return the random state used to draw the augmentation parameters: the global NumPy
+    random state if None, so that the functions behave as before when no state is given.
+    '''
+    if random_state is None:
+        return (np.random)
+    return (random_state)
+
+
 def __rototranscale_random_parameters(thetaXrange=[-np.pi / 18.0, np.pi / 18.0],
                                       thetaYrange=[-np.pi / 18.0, np.pi / 18.0],
                                       thetaZrange=[-np.pi / 18.0, np.pi / 18.0],
                                       tXrange=[-2, 2],
                                       tYrange=[-2, 2],
                                       tZrange=[-2, 2],
-                                      scalerange=[0.9, 1.3]):
-    thetaX = np.random.uniform(thetaXrange[0], thetaXrange[1])
-    thetaY = np.random.uniform(thetaYrange[0], thetaYrange[1])
-    thetaZ = np.random.uniform(thetaZrange[0], thetaZrange[1])
+                                      scalerange=[0.9, 1.3],
+                                      random_state=None):
+    random_state = _get_random_state(random_state)
+    thetaX = random_state.uniform(thetaXrange[0], thetaXrange[1])
+    thetaY = random_state.uniform(thetaYrange[0], thetaYrange[1])
+    thetaZ = random_state.uniform(thetaZrange[0], thetaZrange[1])
 
-    tX = np.random.uniform(tXrange[0], tXrange[1])
-    tY = np.random.uniform(tYrange[0], tYrange[1])
-    tZ = np.random.uniform(tZrange[0], tZrange[1])
+    tX = random_state.uniform(tXrange[0], tXrange[1])
+    tY = random_state.uniform(tYrange[0], tYrange[1])
+    tZ = random_state.uniform(tZrange[0], tZrange[1])
 
-    scale = np.random.uniform(scalerange[0], scalerange[1])
+    scale = random_state.uniform(scalerange[0], scalerange[1])
 
     return (list(eul2quat(thetaX, thetaY, thetaZ)) + [tX, tY, tZ, scale])
 
 
 def __radialdistort_random_parameters(k1range=[1e-7, 1e-5],
                                       k2range=[1e-15, 1e-12],
-                                      k3range=[1e-15, 1e-12]):
-    k1 = np.random.uniform(k1range[0], k1range[1])
-    k2 = np.random.uniform(k2range[0], k2range[1])
-    k3 = np.random.uniform(k3range[0], k3range[1])
+                                      k3range=[1e-15, 1e-12],
+                                      random_state=None):
+    random_state = _get_random_state(random_state)
+    k1 = random_state.uniform(k1range[0], k1range[1])
+    k2 = random_state.uniform(k2range[0], k2range[1])
+    k3 = random_state.uniform(k3range[0], k3range[1])
 
     return (k1, k2, k3)
 
 
 # %
-def rototranscale_transform(image):
+def rototranscale_transform(image, random_state=None):
     aug_transform = sitk.Similarity3DTransform()
     reference_center = np.array(image.TransformContinuousIndexToPhysicalPoint(np.array(image.GetSize()) / 2.0))
     aug_transform.SetCenter(reference_center)
-    aug_transform.SetParameters(__rototranscale_random_parameters())
+    aug_transform.SetParameters(__rototranscale_random_parameters(random_state=random_state))
     return (aug_transform)
 
 
-def radialdistort_transform(image, distortion_center=None):
+def get_physical_points_offsets(image, point):
+    '''
+    Compute, for every voxel of the image, the offset between its physical point and a given point.
+    The physical points are obtained from the origin, spacing and direction of the image with
+    broadcasting, so no per voxel call to SimpleITK is needed.
+    Args:
+        image: SimpleITK image.
+        point: physical point subtracted from the physical points of the voxels.
+    Return:
+        List with one array per physical axis, each array has the NumPy shape of the image.
+
+    '''
+    dimension = image.GetDimension()
+    # Matrix mapping an index to the physical offset from the origin: direction * diag(spacing)
+    index_to_physical = np.array(image.GetDirection()).reshape(dimension, dimension) * np.array(image.GetSpacing())
+    origin_offset = np.array(image.GetOrigin()) - np.asarray(point, dtype=np.float64)
+
+    # Index ranges shaped to broadcast on the NumPy (z, y, x) order of the image
+    index_ranges = []
+    for axis, size in enumerate(image.GetSize()):
+        shape = [1] * dimension
+        shape[dimension - 1 - axis] = size
+        index_ranges.append(np.arange(size, dtype=np.float64).reshape(shape))
+
+    offsets = []
+    for i in range(dimension):
+        offset = np.full(image.GetSize()[::-1], origin_offset[i])
+        for j in range(dimension):
+            if index_to_physical[i, j] != 0:
+                offset += index_to_physical[i, j] * index_ranges[j]
+        offsets.append(offset)
+    return (offsets)
+
+
+def radialdistort_transform(image, distortion_center=None, random_state=None):
     c = distortion_center
-    if not c:  # The default distortion center coincides with the image center
+    if c is None:  # The default distortion center coincides with the image center
         c = np.array(image.TransformContinuousIndexToPhysicalPoint(np.array(image.GetSize()) / 2.0))
-    k1, k2, k3 = __radialdistort_random_parameters()
-    # Compute the vector image (p_d - p_c) 
-    delta_image = sitk.Image(image.GetSize(), sitk.sitkVectorFloat64)
-    delta_image.CopyInformation(image)
-    index_ranges = [np.arange(0, i) for i in image.GetSize()]
-    for indexes in np.nditer(np.meshgrid(*index_ranges)):
-        index = tuple(map(np.asscalar, indexes))
-        delta_image[index] = np.array(image.TransformContinuousIndexToPhysicalPoint(index)) - c
-    delta_image_components = [sitk.VectorIndexSelectionCast(delta_image, index) for index in
-                              range(image.GetDimension())]
-
-    # Compute the radial distortion expression
-    r2_image = sitk.Image(image.GetSize(), sitk.sitkFloat64)
-    r2_image.CopyInformation(image)
-    for img in delta_image_components:
-        r2_image += img ** 2
-    r4_image = r2_image ** 2
-    r6_image = r2_image * r4_image
-    disp_image = k1 * r2_image + k2 * r4_image + k3 * r6_image
-    displacement_image = sitk.Compose([disp_image * img for img in delta_image_components])
+    k1, k2, k3 = __radialdistort_random_parameters(random_state=random_state)
+    # Compute the offsets (p_d - p_c) of every voxel
+    delta_components = get_physical_points_offsets(image, c)
+
+    # Compute the radial distortion expression k1 * r^2 + k2 * r^4 + k3 * r^6
+    r2 = sum(delta ** 2 for delta in delta_components)
+    disp = r2 * (k1 + r2 * (k2 + k3 * r2))
+    del r2
+
+    # The displacement field is built in a single array and copied once into the vector image
+    displacement = np.empty(image.GetSize()[::-1] + (image.GetDimension(),), dtype=np.float64)
+    for i, delta in enumerate(delta_components):
+        np.multiply(disp, delta, out=displacement[..., i])
+    del delta_components, disp
+
+    displacement_image = sitk.GetImageFromArray(displacement, isVector=True)
+    displacement_image.CopyInformation(image)
 
     displacement_field_transform = sitk.DisplacementFieldTransform(displacement_image)
     return (displacement_field_transform)
 
 
-def augment_morph(image_list):
+# Functions creating the transforms of the morphological augmentation, they are called with the
+# reference image and the random state and are composed in this order (the first one is the outermost).
+# The radial distortion allocates a full displacement field, so it is used only when requested, e.g.
+# transform_functions=(rototranscale_transform, radialdistort_transform).
+MORPH_TRANSFORMS = (rototranscale_transform,)
+
+
+def register_morph_transform(transform_function):
+    '''
+    Add a transform type to the default morphological augmentation.
+    Args:
+        transform_function: function with signature (image, random_state=None) returning a SimpleITK transform.
+    '''
+    global MORPH_TRANSFORMS
+    MORPH_TRANSFORMS = MORPH_TRANSFORMS + (transform_function,)
+    return (transform_function)
+
+
+def morph_transform(image, random_state=None, transform_functions=None):
+    '''
+    Create the composite transform of the morphological augmentation of an image.
+    Args:
+        image: reference image on which the transforms are defined.
+        random_state: random state used to draw the parameters of the transforms.
+        transform_functions: functions creating the transforms, MORPH_TRANSFORMS if None.
+    Return:
+        SimpleITK CompositeTransform, a single resample with it is equivalent to one resample per transform.
+    '''
+    if transform_functions is None:
+        transform_functions = MORPH_TRANSFORMS
+
+    # The CompositeTransform applies the last added transform first, so a point of the output is mapped
+    # by the radial distortion and then by the similarity, as resampling first with the similarity would do.
+    composite_transform = sitk.CompositeTransform(image.GetDimension())
+    for transform_function in transform_functions:
+        composite_transform.AddTransform(transform_function(image, random_state=random_state))
+    return (composite_transform)
+
+
+def augment_morph(image_list, random_state=None, transform_functions=None, stats_list=None):
+    '''
+    Apply the same random morphological transform to a list of aligned images.
+    Args:
+        image_list: list of SimpleITK images.
+        random_state: random state used to draw the parameters of the transforms.
+        transform_functions: functions creating the transforms, MORPH_TRANSFORMS if None.
+        stats_list: optional intensity statistics of the images (e.g. from a DatasetIndex), their
+                    median is the value of the voxels mapped outside of the image instead of the
+                    exact median computed for the images without statistics.
+    '''
     ref_image = image_list[0]
-    T1 = rototranscale_transform(ref_image)
-    #    T2 = radialdistort_transform(ref_image)
+    # The same transform is shared by all the images of the list, so that they stay aligned
+    T = morph_transform(ref_image, random_state=random_state, transform_functions=transform_functions)
+
+    if stats_list is None:
+        stats_list = [None] * len(image_list)
 
     aug_image_list = []
-    for image in image_list:
-        out_value = int(100 * np.nanmedian(sitk.GetArrayViewFromImage(image))) / 100
-        aug_image = sitk.Resample(image, image, T1, sitk.sitkBSpline, out_value)
-        #        aug_image = sitk.Resample(aug_image, aug_image, T2)
+    for image, stats in zip(image_list, stats_list):
+        median = np.nanmedian(sitk.GetArrayViewFromImage(image)) if stats is None else stats['median']
+        out_value = int(100 * median) / 100
+        aug_image = sitk.Resample(image, image, T, sitk.sitkBSpline, out_value)
         aug_image_list.append(aug_image)
     return (aug_image_list)
 
 
-def get_gauss_noise():
-    sd = np.random.uniform(0, 0.1)
+def get_gauss_noise(random_state=None):
+    random_state = _get_random_state(random_state)
+    sd = random_state.uniform(0, 0.1)
     f_gauss = sitk.AdditiveGaussianNoiseImageFilter()
     f_gauss.SetStandardDeviation(sd)
+    f_gauss.SetSeed(int(random_state.randint(1, 2 ** 31)))
     return (f_gauss)
 
 
-def get_histo_equal():
-    alpha = np.random.uniform(.7, 1)
-    beta = np.random.uniform(.7, 1)
+def get_histo_equal(random_state=None):
+    random_state = _get_random_state(random_state)
+    alpha = random_state.uniform(.7, 1)
+    beta = random_state.uniform(.7, 1)
     f_histo = sitk.AdaptiveHistogramEqualizationImageFilter()
     f_histo.SetAlpha(alpha)
     f_histo.SetBeta(beta)
     return (f_histo)
 
 
-def augment_intensity(image_list):
-    filters = [get_histo_equal(), get_gauss_noise()]
+def augment_intensity(image_list, random_state=None):
+    filters = [get_histo_equal(random_state), get_gauss_noise(random_state)]
 
     aug_image_list = []
     for aug_image in image_list:
@@ -165,6 +271,83 @@ def augment_intensity(image_list):
         aug_image_list.append(aug_image)
     return (aug_image_list)
 
+
+def _load_augmented_batch(task):
+    '''
+    Load, augment and crop the samples of a batch, it runs inside of a worker process.
+    The random state is seeded by the task, so the batch does not depend on the worker that computes it.
+    '''
+    samples, size, task_seed, intensity, samples_stats = task
+    random_state = np.random.RandomState(task_seed)
+
+    batch = np.empty((len(samples), len(samples[0])) + tuple(size), dtype=np.float32)
+    for i, (sample, sample_stats) in enumerate(zip(samples, samples_stats)):
+        image_list = [sitk.Cast(sitk.ReadImage(path), sitk.sitkFloat32) for path in sample]
+        image_list = augment_morph(image_list, random_state=random_state, stats_list=sample_stats)
+        if intensity:
+            image_list = augment_intensity(image_list, random_state=random_state)
+            # The intensity augmentation changes the statistics, the padding uses the mean of the augmented images
+            sample_stats = None
+        if sample_stats is None:
+            sample_stats = [None] * len(image_list)
+        for j, (image, stats) in enumerate(zip(image_list, sample_stats)):
+            batch[i, j] = to_numpy(image, size, stats=stats)
+    return (batch)
+
+
+def augmented_batches(samples, batch_size, size, n_workers=2, prefetch=2, seed=0, epoch=0, shuffle=True,
+                      intensity=False, threads_per_worker=1, index=None):
+    '''
+    Generator of augmented batches, the batches are computed in background by a pool of worker
+    processes while the caller consumes the previous ones.
+    Args:
+        samples: list of samples, each sample is a list of image paths (e.g. the registered sequences of a patient).
+        batch_size: number of samples in a batch, the last batch can be smaller.
+        size: (z, y, x) size of the images in the batch, see processing.to_numpy.
+        n_workers: number of worker processes, if 0 the batches are computed in the caller process.
+        prefetch: number of batches computed in advance by each worker.
+        seed: seed of the augmentation, the same seed and epoch give the same batches.
+        epoch: epoch number, used together with the seed to draw different batches every epoch.
+        shuffle: if True the samples are shuffled before being split in batches.
+        intensity: if True also the intensity augmentation is applied.
+        threads_per_worker: number of ITK threads of every worker process.
+        index: optional DatasetIndex, the intensity statistics stored in it are not computed again by the workers.
+    Return:
+        Generator of float32 arrays with shape (batch size, number of images per sample) + size.
+    '''
+    order = np.arange(len(samples))
+    if shuffle:
+        np.random.RandomState([seed, epoch]).shuffle(order)
+
+    def get_stats(sample):
+        if index is None:
+            return ([None] * len(sample))
+        return ([index.get(path, 'intensity_stats') for path in sample])
+
+    tasks = ([[samples[k] for k in order[start:start + batch_size]], size, [seed, epoch, batch_index], intensity,
+              [get_stats(samples[k]) for k in order[start:start + batch_size]]]
+             for batch_index, start in enumerate(range(0, len(samples), batch_size)))
+
+    if n_workers == 0:
+        for task in tasks:
+            yield (_load_augmented_batch(task))
+        return
+
+    # At most prefetch batches per worker are pending, so that the memory used is bounded.
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=set_number_of_threads,
+                             initargs=(threads_per_worker,)) as executor:
+        pending = deque()
+        try:
+            for task in tasks:
+                pending.append(executor.submit(_load_augmented_batch, task))
+                if len(pending) >= n_workers * prefetch:
+                    yield (pending.popleft().result())
+            while pending:
+                yield (pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+
 ##%%    
 #
 # TEST_DATA_FILE = '/home/andrea/Trento/Lavori/BraTS/results/bbox/Brats18_2013_2_1/T2.mha'
@@ -0,0 +1,99 @@
+import json
+import os
+
+import SimpleITK as sitk
+
+from .loaders import get_roi_bboxes
+from .processing import compute_intensity_stats
+from .utils import get_file_fingerprint
+
+
+class DatasetIndex:
+    '''
+    Index of a dataset persisted as a JSON file, it stores per volume information (e.g. the
+    intensity statistics) so that it is computed once and reused across runs. The entry of a
+    volume is discarded when the volume file changes.
+    '''
+
+    def __init__(self, path):
+        '''
+        Args:
+            path: path of the JSON file of the index, it is loaded if it exists.
+        '''
+
+        self.path = path
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as index_file:
+                self.entries = json.load(index_file)
+
+    def _get_entry(self, volume_path):
+        key = os.path.abspath(volume_path)
+        fingerprint = get_file_fingerprint(volume_path)
+
+        entry = self.entries.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            entry = {'fingerprint': fingerprint}
+            self.entries[key] = entry
+        return (entry)
+
+    def get(self, volume_path, field):
+        '''
+        Return a field of the entry of a volume, None if it is not stored or the volume has changed.
+        '''
+        entry = self.entries.get(os.path.abspath(volume_path))
+        if entry is None or entry['fingerprint'] != get_file_fingerprint(volume_path):
+            return (None)
+        return (entry.get(field))
+
+    def set(self, volume_path, field, value):
+        '''
+        Store a field (that can be serialized as JSON) in the entry of a volume.
+        '''
+        self._get_entry(volume_path)[field] = value
+
+    def get_intensity_stats(self, volume_path, image=None):
+        '''
+        Return the intensity statistics of a volume (see processing.compute_intensity_stats), computing
+        them only if they are not in the index or the volume file has changed.
+        Args:
+            volume_path: path of the volume file (or of the folder of a DICOM series).
+            image: optional image already loaded from the path, it is read if needed and not supplied.
+        '''
+        stats = self.get(volume_path, 'intensity_stats')
+
+        if stats is None:
+            if image is None:
+                image = sitk.ReadImage(volume_path)
+            stats = compute_intensity_stats(image)
+            self.set(volume_path, 'intensity_stats', stats)
+        return (stats)
+
+    def get_roi_bboxes(self, rtstruct_path, image, margin=5):
+        '''
+        Return the bounding boxes of the ROIs of a RTSTRUCT (see loaders.get_roi_bboxes), computing
+        them only if they are not in the index or were computed with another margin or image geometry.
+        Args:
+            rtstruct_path: path of the RTSTRUCT file.
+            image: SimpleITK image on which the index bounding boxes are computed.
+            margin: margin in mm added on every side of the bounding boxes.
+        '''
+        geometry = [list(image.GetSize()), list(image.GetOrigin()), list(image.GetSpacing()),
+                    list(image.GetDirection())]
+        roi_bboxes = self.get(rtstruct_path, 'roi_bboxes')
+
+        if roi_bboxes is None or roi_bboxes['margin'] != margin or roi_bboxes['geometry'] != geometry:
+            roi_bboxes = {'margin': margin,
+                          'geometry': geometry,
+                          'bboxes': get_roi_bboxes(rtstruct_path, image, margin=margin)}
+            self.set(rtstruct_path, 'roi_bboxes', roi_bboxes)
+        return (roi_bboxes['bboxes'])
+
+    def save(self):
+        '''
+        Write the index on disk, the file is replaced atomically.
+        '''
+        with open(self.path + '.tmp', 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.replace(self.path + '.tmp', self.path)
@@ -38,47 +38,247 @@ def load_series(folder, metadata=False):
         return None
 
 
-def load_roi(file, roi_name, image):
+def physical_to_index(image, points, continuous=False):
     '''
-    Load a DCM file (RTSTRUCT modality) containing volume ROIs.
-    Return a dictionary for the selected roi names (all rois if name=None):
-        'image': names of the ROIs; 
-        'coords': coordinates of the ROIs;
-        'box': coordinate of the bounding box of each ROI;
-        'reference': reference dicom dataset with metadata (if return_ref=True).
+    Map physical points to the index space of an image with a single affine transform, the
+    vectorized equivalent of TransformPhysicalPointToIndex (or ToContinuousIndex).
+    Args:
+        image: SimpleITK image.
+        points: array with shape (N, 3) of physical points.
+        continuous: if False the indexes are rounded to the nearest integer.
+    Return:
+        Array with shape (N, 3) of (x, y, z) indexes.
     '''
+    dimension = image.GetDimension()
+    index_to_physical = np.array(image.GetDirection()).reshape(dimension, dimension) * np.array(image.GetSpacing())
+    indexes = np.linalg.solve(index_to_physical, (np.asarray(points, dtype=np.float64) - image.GetOrigin()).T).T
+    if continuous:
+        return (indexes)
+    return (np.floor(indexes + 0.5).astype(int))
 
-    mask = sitk.Image(image.GetSize(), sitk.sitkFloat32)
-    mask.CopyInformation(image)
 
+def fill_polygon(mask_slice, rows, cols, label=1):
+    '''
+    Fill a polygon into a 2D mask with skimage.draw.polygon.
+    Args:
+        mask_slice: 2D NumPy array in which the polygon is filled, the polygon is clipped to its shape.
+        rows: row coordinates of the vertices.
+        cols: column coordinates of the vertices.
+        label: value written inside of the polygon.
+    '''
+    rr, cc = polygon(np.asarray(rows), np.asarray(cols), shape=mask_slice.shape)
+    mask_slice[rr, cc] = label
+    return (mask_slice)
+
+
+def rasterize_contours(mask_np, contours, image, label=1, offset=(0, 0, 0)):
+    '''
+    Fill the planar contours of a ROI into a NumPy mask with (z, y, x) shape.
+    Args:
+        mask_np: NumPy array in which the contours are filled, with the shape of the image
+                 or of a region of it.
+        contours: list of arrays with shape (N, 3) of physical points, one array for each contour.
+        image: SimpleITK image defining the geometry of the mask.
+        label: value written inside of the contours.
+        offset: (x, y, z) index of the image corresponding to the first voxel of the mask.
+    '''
+    if len(contours) == 0:
+        return (mask_np)
+
+    # All the points are mapped to index space at once and then split back into contours
+    indexes = physical_to_index(image, np.concatenate(contours)) - np.asarray(offset)
+    splits = np.cumsum([len(C) for C in contours])[:-1]
+    for contour in np.split(indexes, splits):
+        idx_z = contour[-1, 2]
+        if idx_z < 0 or idx_z >= mask_np.shape[0]:
+            continue
+        fill_polygon(mask_np[idx_z], contour[:, 1], contour[:, 0], label=label)
+    return (mask_np)
+
+
+def read_rtstruct(file):
+    '''
+    Read a DCM file (RTSTRUCT modality) and parse the contours of all its ROIs, the contours
+    are matched with the structures by ROI number. If more ROIs have the same name their
+    contours are merged.
+    Return a dictionary from the ROI names to the lists of contours, each contour is an array
+    with shape (N, 3) of physical points.
+    '''
     dataset = pydicom.dcmread(file)
 
-    structure_set = dataset.StructureSetROISequence
-    rois = dataset.ROIContourSequence
-
-    for i, (STRUCT, ROI) in enumerate(zip(structure_set, rois)):
-        if STRUCT.ROIName == roi_name:
-            contours = ROI.ContourSequence
-            coords = []
-            for Z_CONT in contours:
-                z_data = np.array([float(x) for x in Z_CONT.ContourData])
-                z_data = np.reshape(z_data, (int(len(z_data) / 3), 3))
-                coords.append(z_data)
-
-    for zslice in coords:
-        x_ = []
-        y_ = []
-        for point in zslice:
-            idx_x, idx_y, idx_z = image.TransformPhysicalPointToIndex(point)
-            x_.append(idx_x)
-            y_.append(idx_y)
-        rr, cc = polygon(np.array(y_), np.array(x_))
-        for R, C in zip(rr, cc):
-            mask[int(C), int(R), int(idx_z)] = 1
+    names = {STRUCT.ROINumber: STRUCT.ROIName for STRUCT in dataset.StructureSetROISequence}
+    rtstruct = {name: [] for name in names.values()}
+
+    for ROI in dataset.ROIContourSequence:
+        name = names.get(ROI.ReferencedROINumber)
+        if name is None:
+            continue
+        for Z_CONT in ROI.get('ContourSequence', []):
+            z_data = np.array(Z_CONT.ContourData, dtype=np.float64)
+            rtstruct[name].append(np.reshape(z_data, (int(len(z_data) / 3), 3)))
+
+    return (rtstruct)
+
+
+def load_roi(file, roi_name, image):
+    '''
+    Load a DCM file (RTSTRUCT modality) containing volume ROIs and rasterize the selected ROI
+    on the grid of the image. If more ROIs have the same name all of them are included.
+    Return a SimpleITK mask (unsigned char) with 1 inside of the ROI.
+    '''
+
+    coords = read_rtstruct(file).get(roi_name, [])
+
+    if len(coords) == 0:
+        print(f"No contours of the ROI {roi_name} found in {file}.")
+
+    mask_np = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
+    rasterize_contours(mask_np, coords, image)
+
+    mask = sitk.GetImageFromArray(mask_np)
+    mask.CopyInformation(image)
 
     return (mask)
 
 
+def _get_contours_region(contours, image):
+    '''
+    Return the (x, y, z) start index and size of the region of the image containing the contours,
+    None if the contours are outside of the image.
+    '''
+    indexes = physical_to_index(image, np.concatenate(contours))
+    start = np.clip(indexes.min(axis=0), 0, None)
+    stop = np.minimum(indexes.max(axis=0) + 1, image.GetSize())
+    if (stop <= start).any():
+        return (None)
+    return (start, stop - start)
+
+
+def load_rois(rtstruct, image, roi_names=None, as_label_map=True):
+    '''
+    Rasterize many ROIs of a RTSTRUCT on the grid of the image, parsing the file only once.
+    Args:
+        rtstruct: path of the RTSTRUCT file or dictionary returned by read_rtstruct.
+        image: SimpleITK image defining the geometry of the masks.
+        roi_names: names of the ROIs to rasterize, all the ROIs if None.
+        as_label_map: if True a single label map is returned, otherwise one mask per ROI
+                      cropped on its bounding box.
+    Return:
+        If as_label_map is True a tuple with:
+            'label_map': SimpleITK image (unsigned char, or unsigned short with more than 255 ROIs),
+                         where ROIs listed later overwrite the overlapping earlier ones;
+            'labels': dictionary from the ROI names to their labels.
+        Otherwise a dictionary from the ROI names to unsigned char SimpleITK masks cropped on
+        the bounding box of the ROI, their origin places them on the image (None if the ROI is
+        empty or outside of the image).
+    '''
+    if isinstance(rtstruct, str):
+        rtstruct = read_rtstruct(rtstruct)
+    if roi_names is None:
+        roi_names = list(rtstruct.keys())
+
+    if as_label_map:
+        labels = {name: label for label, name in enumerate(roi_names, 1)}
+        dtype = np.uint8 if len(labels) <= np.iinfo(np.uint8).max else np.uint16
+        label_map_np = np.zeros(image.GetSize()[::-1], dtype=dtype)
+        for name, label in labels.items():
+            rasterize_contours(label_map_np, rtstruct.get(name, []), image, label=label)
+
+        label_map = sitk.GetImageFromArray(label_map_np)
+        label_map.CopyInformation(image)
+        return (label_map, labels)
+
+    masks = {}
+    for name in roi_names:
+        contours = rtstruct.get(name, [])
+        region = _get_contours_region(contours, image) if len(contours) > 0 else None
+        if region is None:
+            masks[name] = None
+            continue
+        start, size = region
+        mask_np = np.zeros(size[::-1], dtype=np.uint8)
+        rasterize_contours(mask_np, contours, image, offset=start)
+
+        mask = sitk.GetImageFromArray(mask_np)
+        mask.SetSpacing(image.GetSpacing())
+        mask.SetDirection(image.GetDirection())
+        mask.SetOrigin(image.TransformIndexToPhysicalPoint([int(x) for x in start]))
+        masks[name] = mask
+    return (masks)
+
+
+def get_roi_bboxes(rtstruct, image, roi_names=None, margin=5):
+    '''
+    Compute the bounding boxes of the ROIs directly from the points of their contours, without
+    rasterizing any mask.
+    Args:
+        rtstruct: path of the RTSTRUCT file or dictionary returned by read_rtstruct.
+        image: SimpleITK image (or image read with only its header) on which the index bounding boxes are computed.
+        roi_names: names of the ROIs, all the ROIs if None.
+        margin: margin in mm added on every side of the bounding boxes.
+    Return:
+        Dictionary from the ROI names (with at least one contour) to dictionaries with:
+            'start_mm', 'stop_mm': physical vertices of the bounding box, as get_bbox_vertices;
+            'start_index', 'stop_index': (x, y, z) index region of the image containing the bounding box,
+                                         the stop is excluded and the region is clipped to the image.
+    '''
+    if isinstance(rtstruct, str):
+        rtstruct = read_rtstruct(rtstruct)
+    if roi_names is None:
+        roi_names = list(rtstruct.keys())
+
+    bboxes = {}
+    for name in roi_names:
+        contours = rtstruct.get(name, [])
+        if len(contours) == 0:
+            continue
+        points = np.concatenate(contours)
+        start_mm = points.min(axis=0) - margin
+        stop_mm = points.max(axis=0) + margin
+
+        # The corners of the physical box are mapped, since the direction can rotate or flip the axes
+        corners = np.array([[(start_mm, stop_mm)[c][i] for i, c in enumerate(corner)] for corner in np.ndindex(2, 2, 2)])
+        indexes = physical_to_index(image, corners, continuous=True)
+        start_index = np.clip(np.floor(indexes.min(axis=0) + 0.5), 0, image.GetSize()).astype(int)
+        stop_index = np.clip(np.floor(indexes.max(axis=0) + 0.5) + 1, 0, image.GetSize()).astype(int)
+
+        bboxes[name] = {'start_mm': start_mm.tolist(),
+                        'stop_mm': stop_mm.tolist(),
+                        'start_index': start_index.tolist(),
+                        'stop_index': stop_index.tolist()}
+    return (bboxes)
+
+
+def load_region(path, start_index, stop_index):
+    '''
+    Load only a region of a scan. For a folder with a DICOM series only the files of the needed
+    slices are read, for an image file the region is extracted by the reader (streamed when the
+    file format supports it).
+    Args:
+        path: folder of a DICOM series or path of an image file.
+        start_index: (x, y, z) index of the first voxel of the region.
+        stop_index: (x, y, z) index after the last voxel of the region.
+    Return:
+        SimpleITK image of the region, its origin places it in the physical space of the scan.
+    '''
+    start_index = [int(x) for x in start_index]
+    size = [int(stop) - start for start, stop in zip(start_index, stop_index)]
+
+    if os.path.isdir(path):
+        reader = sitk.ImageSeriesReader()
+        # The file names are sorted by slice position, so the slices of the region are a range of them
+        dicom_names = reader.GetGDCMSeriesFileNames(path)
+        reader.SetFileNames(dicom_names[start_index[2]: start_index[2] + size[2]])
+        image = reader.Execute()
+        return (sitk.RegionOfInterest(image, size[:2] + [image.GetSize()[2]], start_index[:2] + [0]))
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.SetExtractIndex(start_index)
+    reader.SetExtractSize(size)
+    return (reader.Execute())
+
+
 # %%
 def __str__(x):
     return (str(int(float(x))))
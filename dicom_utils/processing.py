@@ -1,34 +1,277 @@
 import SimpleITK as sitk
 import numpy as np
 
+DEFAULT_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
 
-def to_numpy(image, size=None):
+
+def _iterate_chunks(image_np, slices_per_chunk):
+    '''
+    Iterate over the finite values of chunks of slices of an array, so that no copy of the whole volume is made.
+    '''
+    for start in range(0, image_np.shape[0], slices_per_chunk):
+        chunk = image_np[start: start + slices_per_chunk]
+        if np.issubdtype(chunk.dtype, np.floating):
+            chunk = chunk[np.isfinite(chunk)]
+        yield (chunk.ravel())
+
+
+def _histogram_quantile(counts, edges, q):
+    '''
+    Approximate a quantile (0-100) interpolating linearly inside of the histogram bin that contains it.
+    '''
+    cumulative = np.cumsum(counts)
+    target = q / 100. * cumulative[-1]
+    i = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+    previous = cumulative[i - 1] if i > 0 else 0
+    fraction = (target - previous) / counts[i] if counts[i] > 0 else 0.
+    return (float(edges[i] + fraction * (edges[i + 1] - edges[i])))
+
+
+def compute_intensity_stats(image, percentiles=DEFAULT_PERCENTILES, bins=256, slices_per_chunk=16):
+    '''
+    Compute the intensity statistics of an image (SimpleITK or NumPy) in two streaming passes over chunks of slices:
+    the first one computes the moments and the range, the second one the histogram, from which
+    the median and the percentiles are approximated (the error is at most one bin width).
+    NaN and infinite values are ignored.
+    Return a dictionary that can be serialized as JSON:
+        'count', 'mean', 'std', 'min', 'max', 'median';
+        'percentiles': dictionary from the percentile (as string) to its value;
+        'histogram': dictionary with the bin 'counts' and 'edges'.
+    '''
+    image_np = image if isinstance(image, np.ndarray) else sitk.GetArrayViewFromImage(image)
+
+    count, total, total_squares = 0, 0., 0.
+    minimum, maximum = np.inf, -np.inf
+    for chunk in _iterate_chunks(image_np, slices_per_chunk):
+        if chunk.size == 0:
+            continue
+        chunk = chunk.astype(np.float64)
+        count += chunk.size
+        total += chunk.sum()
+        total_squares += np.dot(chunk, chunk)
+        minimum = min(minimum, chunk.min())
+        maximum = max(maximum, chunk.max())
+
+    if count == 0:
+        return (None)
+
+    mean = total / count
+    # A constant image still needs a non empty range for the histogram
+    edges = np.linspace(minimum, maximum if maximum > minimum else minimum + 1., bins + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    for chunk in _iterate_chunks(image_np, slices_per_chunk):
+        counts += np.histogram(chunk, bins=edges)[0]
+
+    return ({'count': int(count),
+             'mean': float(mean),
+             'std': float(np.sqrt(max(total_squares / count - mean ** 2, 0.))),
+             'min': float(minimum),
+             'max': float(maximum),
+             'median': _histogram_quantile(counts, edges, 50),
+             'percentiles': {str(q): _histogram_quantile(counts, edges, q) for q in percentiles},
+             'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}})
+
+
+def _crop_pad_slices(shape, size):
+    '''
+    Compute the slices of the output array (of the given size) and of the image (of the given shape)
+    used to center the image in the output: the image is padded where it is smaller than the output
+    and cropped where it is bigger.
+    Return the tuples of the output slices and of the image slices.
+    '''
+    out_slices = []
+    in_slices = []
+    for i in range(len(size)):
+        difference = int((size[i] - shape[i]) / 2)
+        start_out = max(difference, 0)
+        start_in = abs(min(difference, 0)) // 2
+        length = min(size[i] - start_out, shape[i] - start_in)
+        out_slices.append(slice(start_out, start_out + length))
+        in_slices.append(slice(start_in, start_in + length))
+    return (tuple(out_slices), tuple(in_slices))
+
+
+def to_numpy(image, size=None, fill_value=None, stats=None):
+    '''
+    Convert an image to a NumPy array, centered and cropped or padded to the given size.
+    The padding is filled with fill_value, the mean intensity of the image if None, taken from
+    its intensity statistics (e.g. from a DatasetIndex) if they are supplied.
+    '''
     image_np = sitk.GetArrayFromImage(image)
 
     if size is not None:
-        differences = np.array([int((size[i] - image_np.shape[i]) / 2) for i in range(3)])
-        starts_out = differences.copy()
-        starts_out[differences < 0] = 0
-        starts_in = differences
-        starts_in[differences > 0] = 0
-        starts_in = abs(starts_in / 2).astype(int)
-        out = np.mean(image_np) * np.ones(size)
-        out[starts_out[0]: starts_out[0] + image_np.shape[0],
-        starts_out[1]: starts_out[1] + image_np.shape[1],
-        starts_out[2]: starts_out[2] + image_np.shape[2]] = image_np[starts_in[0]: starts_in[0] + size[0],
-                                                            starts_in[1]: starts_in[1] + size[1],
-                                                            starts_in[2]: starts_in[2] + size[2]]
+        out_slices, in_slices = _crop_pad_slices(image_np.shape, size)
+        if fill_value is None:
+            fill_value = np.mean(image_np) if stats is None else stats['mean']
+        out = fill_value * np.ones(size)
+        out[out_slices] = image_np[in_slices]
         return (out)
     else:
         return (image_np)
 
 
+def to_numpy_batch(images, size, out=None, dtype=np.float32, fill_value=None, memmap_path=None):
+    '''
+    Crop or pad the images to the same size (as to_numpy does) and write them directly into a
+    preallocated (N, D, H, W) array, without intermediate copies of the images.
+    Args:
+        images: list of SimpleITK images, or of paths of images that are read one at a time.
+        size: (D, H, W) size of every image in the output.
+        out: optional preallocated array with shape (N, D, H, W).
+        dtype: data type of the output, if it is allocated.
+        fill_value: value of the padding, the mean intensity of every image if None.
+        memmap_path: optional path of a .npy file, the output is allocated as memory map on it.
+    Return:
+        The output array.
+    '''
+    size = tuple(size)
+    if out is None:
+        shape = (len(images),) + size
+        if memmap_path is not None:
+            out = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            out = np.empty(shape, dtype=dtype)
+    assert out.shape[1:] == size, 'The output array should have shape (N,) + size'
+
+    for i, image in enumerate(images):
+        if isinstance(image, str):
+            image = sitk.ReadImage(image)
+        image_np = sitk.GetArrayViewFromImage(image)
+        out_slices, in_slices = _crop_pad_slices(image_np.shape, size)
+
+        # The padding is filled only if the image does not cover the whole output
+        if any(S.stop - S.start < N for S, N in zip(out_slices, size)):
+            out[i] = np.mean(image_np) if fill_value is None else fill_value
+        out[i][out_slices] = image_np[in_slices]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return (out)
+
+
 def filter_outbounds(image, range_pixel):
     image = sitk.Threshold(image, lower=-2000, upper=range_pixel[1], outsideValue=range_pixel[1])
     image = sitk.Threshold(image, lower=range_pixel[0], upper=5000, outsideValue=range_pixel[0])
     return (image)
 
 
+def _compose_affine(mapping, scale, shift):
+    '''
+    Compose the mapping x -> clip(a * x + b, lower, upper) with v -> scale * v + shift.
+    '''
+    a, b, lower, upper = mapping
+    if scale == 0:
+        return ((0., shift, -np.inf, np.inf))
+    lower, upper = sorted((scale * lower + shift, scale * upper + shift))
+    return ((scale * a, scale * b + shift, lower, upper))
+
+
+def _compose_clip(mapping, clip_lower, clip_upper):
+    '''
+    Compose the mapping x -> clip(a * x + b, lower, upper) with v -> clip(v, clip_lower, clip_upper).
+    '''
+    a, b, lower, upper = mapping
+    return ((a, b, float(np.clip(lower, clip_lower, clip_upper)), float(np.clip(upper, clip_lower, clip_upper))))
+
+
+def _mapped_moments(image_np, mapping, slices_per_chunk):
+    '''
+    Compute mean and standard deviation (as sitk.Normalize, with n - 1) of the mapped intensities.
+    '''
+    a, b, lower, upper = mapping
+    count, total, total_squares = 0, 0., 0.
+    for chunk in _iterate_chunks(image_np, slices_per_chunk):
+        chunk = np.clip(a * chunk.astype(np.float64) + b, lower, upper)
+        count += chunk.size
+        total += chunk.sum()
+        total_squares += np.dot(chunk, chunk)
+    mean = total / count
+    return (mean, np.sqrt(max(total_squares - count * mean ** 2, 0.) / max(count - 1, 1)))
+
+
+def normalize_intensity(image, steps, in_place=False, slices_per_chunk=16, stats=None):
+    '''
+    Normalize the intensities of an image with a declarative list of steps, applied in order:
+        ('clip', lower, upper): clamp the intensities, as sitk.Clamp;
+        ('window', level, width[, output_min, output_max]): window/level mapped on [0, 1] by default,
+            as sitk.IntensityWindowing;
+        ('rescale', output_min, output_max): map the intensity range, as sitk.RescaleIntensity;
+        ('zscore',): zero mean and unit standard deviation, as sitk.Normalize;
+        ('cast', dtype): data type of the output, only as last step.
+    All the steps are folded in a single mapping clip(a * x + b, lower, upper), that is applied in one
+    pass over chunks of slices. The range and the moments needed by rescale and zscore come from the
+    intensity statistics of the image (computed if not supplied); only a zscore after a clip needs an extra pass to compute the moments.
+    Args:
+        image: SimpleITK image or NumPy array.
+        steps: list of steps, a step without arguments can be given as a string.
+        in_place: if True and the image is a NumPy array of the output data type, it is overwritten.
+        slices_per_chunk: number of slices processed at once.
+        stats: optional intensity statistics of the image (see compute_intensity_stats), e.g. from a DatasetIndex.
+    Return:
+        The normalized image, of the same kind of the input (float32 if no cast step is given).
+    '''
+    is_sitk = isinstance(image, sitk.Image)
+    image_np = sitk.GetArrayViewFromImage(image) if is_sitk else image
+
+    mapping = (1., 0., -np.inf, np.inf)
+    dtype = np.float32
+    for i, step in enumerate(steps):
+        name, *args = (step,) if isinstance(step, str) else step
+
+        if name in ('rescale', 'zscore') and stats is None:
+            stats = compute_intensity_stats(image_np)
+
+        if name == 'clip':
+            mapping = _compose_clip(mapping, *args)
+        elif name == 'window':
+            level, width, output_min, output_max = (list(args) + [0., 1.])[:4]
+            window_min, window_max = level - width / 2., level + width / 2.
+            mapping = _compose_clip(mapping, window_min, window_max)
+            scale = (output_max - output_min) / (window_max - window_min)
+            mapping = _compose_affine(mapping, scale, output_min - scale * window_min)
+        elif name == 'rescale':
+            output_min, output_max = args
+            a, b, lower, upper = mapping
+            current_min, current_max = np.clip(sorted((a * stats['min'] + b, a * stats['max'] + b)), lower, upper)
+            scale = (output_max - output_min) / (current_max - current_min) if current_max > current_min else 0.
+            mapping = _compose_affine(mapping, scale, output_min - scale * current_min)
+        elif name == 'zscore':
+            a, b, lower, upper = mapping
+            if np.isinf(lower) and np.isinf(upper):
+                count = stats['count']
+                mean = a * stats['mean'] + b
+                std = abs(a) * stats['std'] * np.sqrt(count / max(count - 1, 1))
+            else:
+                mean, std = _mapped_moments(image_np, mapping, slices_per_chunk)
+            scale = 1. / std if std > 0 else 0.
+            mapping = _compose_affine(mapping, scale, -mean * scale)
+        elif name == 'cast':
+            dtype = np.dtype(args[0])
+            if i != len(steps) - 1:
+                raise ValueError('cast should be the last step')
+        else:
+            raise ValueError(f'Unknown normalization step {name}')
+
+    if in_place and not is_sitk and image_np.dtype == dtype:
+        out = image_np
+    else:
+        out = np.empty(image_np.shape, dtype=dtype)
+
+    a, b, lower, upper = mapping
+    for start in range(0, image_np.shape[0], slices_per_chunk):
+        chunk = image_np[start: start + slices_per_chunk].astype(np.float64)
+        chunk *= a
+        chunk += b
+        np.clip(chunk, lower, upper, out=chunk)
+        out[start: start + slices_per_chunk] = chunk
+
+    if is_sitk:
+        out_image = sitk.GetImageFromArray(out, isVector=image.GetNumberOfComponentsPerPixel() > 1)
+        out_image.CopyInformation(image)
+        return (out_image)
+    return (out)
+
+
 def resample(image, spacing=None, size=None, interpolator=sitk.sitkBSpline):
     assert spacing is not None or size is not None, "Either pixel_size or pixel_number should be defined, not both"
     assert not (
@@ -1,17 +1,46 @@
+import hashlib
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+import SimpleITK as sitk
 import numpy as np
 import pydicom
 
 
 def flatten(x):
-    out = np.array([])
+    arrays = [np.ravel(np.array(X)) for X in x]
+    if len(arrays) == 0:
+        return (np.array([]))
+
+    out = np.concatenate(arrays)
+    # Numbers are returned as float, as when they were appended to an empty float array
+    if out.dtype.kind in 'biu':
+        out = out.astype(float)
+    return (out)
 
-    for X in x:
-        X = np.array(X)
-        out = np.r_[out, X]
 
-    return (out)
+def get_file_fingerprint(path):
+    '''
+    Return the fingerprint of a file, or of the files of a folder (e.g. a DICOM series), as an hexadecimal
+    string computed from the names, sizes and modification times of the files, without reading them.
+    '''
+    fingerprint = hashlib.sha1()
+    if os.path.isdir(path):
+        file_paths = sorted(entry.path for entry in os.scandir(path) if entry.is_file())
+    else:
+        file_paths = [path]
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        fingerprint.update(f'{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return (fingerprint.hexdigest())
+
+
+def set_number_of_threads(threads):
+    '''
+    Set the number of threads used by every SimpleITK filter of the process, e.g. as initializer
+    of the worker processes so that they do not oversubscribe the machine.
+    '''
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
 
 
 def isDCMLeaf(directory, all_dcm=True):
@@ -103,3 +132,68 @@ def get_rois_names(folder):
         roi_name.append(STRUCT.ROIName)
 
     return (roi_name)
+
+
+def read_modality(file):
+    '''
+    Read only the Modality tag from the header of a DCM file, '' if it cannot be read
+    '''
+    try:
+        return (str(pydicom.dcmread(file, stop_before_pixels=True, specific_tags=['Modality']).get('Modality', '')))
+    except Exception:
+        return ('')
+
+
+def _scan_directory(directory, all_dcm=True):
+    '''
+    List a directory once: return its record (path, n_files, modality, bytes) if it is a DCMLeaf, and its subdirectories
+    As in isDCMLeaf, the symbolic links are followed and every entry that is not a directory is a file,
+    so an empty directory is a DCMLeaf with no files and no modality
+    '''
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                files.append(entry)
+
+    # Same definition of isDCMLeaf, without listing the directory again
+    if len(subdirs) > 0:
+        return (None, subdirs)
+    if len(files) == 0:
+        return ((directory, 0, '', 0), subdirs)
+    dcm_files = [F for F in files if '.dcm' in F.name]
+    if (all_dcm and len(dcm_files) < len(files)) or (not all_dcm and len(dcm_files) / len(files) <= 0.9):
+        return (None, subdirs)
+
+    n_bytes = sum(F.stat().st_size for F in files if F.is_file())
+    return ((directory, len(files), read_modality(dcm_files[0].path), n_bytes), subdirs)
+
+
+def scan_inventory(directory, all_dcm=True, n_workers=8):
+    '''
+    Walk the tree once and report info about the DCMLeaf folders, as iterativeScan but reading only
+    the header of one file per folder. The folders are listed in parallel by a pool of threads, so
+    the latency of network file systems is overlapped.
+    Return a structured array with fields 'path', 'n_files', 'modality' and 'bytes', sorted by path.
+    '''
+    records = []
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = {executor.submit(_scan_directory, directory, all_dcm)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record, subdirs = future.result()
+                if record is not None:
+                    records.append(record)
+                pending.update(executor.submit(_scan_directory, SUB, all_dcm) for SUB in subdirs)
+
+    records.sort()
+    path_length = max([len(R[0]) for R in records] + [1])
+    modality_length = max([len(R[2]) for R in records] + [1])
+    dtype = [('path', f'U{path_length}'), ('n_files', np.int64), ('modality', f'U{modality_length}'),
+             ('bytes', np.int64)]
+    return (np.array(records, dtype=dtype))
@@ -1,53 +1,62 @@
-import os
-import SimpleITK as sitk
-import matplotlib.pyplot as plt
-import dicom_utils as du
+import argparse
 import logging
 import sys
 
-logger = logging.getLogger("Registration logger")
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-
-MOVING_SCAN_TYPE = "M"
-FIXED_SCAN_TYPE = "F"
-
-INPUT_PATH = f'/Volumes/SamsungT5/OPBG_Data/by_type/MB_by_sequence'
-OUTPUT_PATH = f'/Volumes/SamsungT5/OPBG_Data/by_type/MB_by_sequence_nii'
-
-# Loops over patients.
-for patient_code in filter(lambda path: not path.startswith('.'), os.listdir(INPUT_PATH)):
-    patient_path = os.path.join(INPUT_PATH, patient_code)
-
-    # Preparing the array that will contain all the paths of the scans.
-    patient_scans_paths = []
-    patient_scans_numbers = []
-
-    # Creating an output folder for each patient.
-    output_patient_path = os.path.join(OUTPUT_PATH, patient_code)
-    os.makedirs(output_patient_path, exist_ok=True)
-
-    # Loops over the scans of the patient.
-    for patient_scan_number in os.listdir(patient_path):
-        patient_scans_paths.append(os.path.join(patient_path, patient_scan_number))
-        patient_scans_numbers.append(patient_scan_number)
-
-    # Finds the reference image inside of the patient folder and
-    # returns an array with all the scans.
-    scans, ref_scan_index = du.read_scans_and_find_ref_scan(patient_scans_paths)
-
-    print("----------")
-
-    # Looping on all scans and converting them to nifti.
-    for (i, scan_obj) in enumerate(scans):
-        logger.debug(f"Writing image from {patient_scans_paths[i]}")
-        scan_type = MOVING_SCAN_TYPE
-
-        if i == ref_scan_index:
-            scan_type = FIXED_SCAN_TYPE
-            logger.debug(f"Reference scan found at {scan_obj.path}")
-
-        sitk.WriteImage(scan_obj.scan, os.path.join(output_patient_path, f"{scan_type}_{patient_scans_numbers[i]}.nii.gz"))
-
+import pycomed
 
+logger = logging.getLogger("Conversion logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Converts a DICOM dataset to NIfTI files, the fixed scan of every patient is prefixed by F_ "
+                    "and resampled, the other scans are prefixed by M_. Scans already converted are skipped.")
+    parser.add_argument("input_path", help="folder of the DICOM dataset, organized or not")
+    parser.add_argument("output_path", help="folder in which the NIfTI files are written")
+    parser.add_argument("--organized-path", default=None,
+                        help="folder in which the dataset is organized, if it is not already organized")
+    parser.add_argument("--patients", nargs="+", default=None, help="names of the patients to convert")
+    parser.add_argument("--compression-level", type=int, default=pycomed.DEFAULT_COMPRESSION_LEVEL,
+                        help="gzip compression level of the .nii.gz files")
+    parser.add_argument("--uncompressed", action="store_true", help="write uncompressed .nii files")
+    parser.add_argument("--fixed-spacing", type=float, nargs=3, default=(1., 1., 1.),
+                        help="spacing used to resample the fixed scans")
+    parser.add_argument("--orientation", default=None,
+                        help="orientation code (e.g. LPS or RAS) to which the scans are reoriented")
+    parser.add_argument("--store-path", default=None,
+                        help="folder in which the scans are also written as chunked volume stores")
+    parser.add_argument("--chunk-shape", type=int, nargs=3, default=pycomed.DEFAULT_CHUNK_SHAPE,
+                        help="(z, y, x) shape of the chunks of the stores")
+    parser.add_argument("--codec", choices=sorted(pycomed.CODECS), default=pycomed.DEFAULT_CODEC,
+                        help="codec of the chunks of the stores")
+    parser.add_argument("--threads", type=int, default=None, help="total number of threads, all the cores by default")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+
+    dataset_organizer = pycomed.DICOMDatasetOrganizer(
+        input_path=arguments.input_path,
+        output_path=arguments.organized_path if arguments.organized_path is not None else arguments.input_path)
+    dataset_reader = pycomed.DICOMDatasetReader(dataset_organizer)
+
+    converter = pycomed.DICOMDatasetConverter(
+        dataset_reader, arguments.output_path,
+        compression_level=None if arguments.uncompressed else arguments.compression_level,
+        fixed_spacing=arguments.fixed_spacing,
+        scheduler=pycomed.ThreadBudgetScheduler(total_threads=arguments.threads, workers=arguments.workers),
+        store_path=arguments.store_path, chunk_shape=arguments.chunk_shape, codec=arguments.codec,
+        orientation=arguments.orientation)
+
+    results = converter.convert(arguments.patients)
+
+    logger.debug(f"Converted {len(results['converted'])} scans, skipped {len(results['skipped'])} up to date "
+                 f"scans, {len(results['failed'])} scans failed.")
+
+
+if __name__ == '__main__':
+    main()
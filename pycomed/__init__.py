@@ -3,8 +3,15 @@ pycomed package - DICOM datasets processing with ease.
 
 """
 
+from pycomed.io.conversion import *
+from pycomed.io.export import *
+from pycomed.io.nifti import *
 from pycomed.io.organization import *
 from pycomed.io.reading import *
+from pycomed.io.sampling import *
+from pycomed.io.storage import *
+from pycomed.processing.cache import *
 from pycomed.processing.registration import *
+from pycomed.processing.scheduling import *
 from .entities import *
 from .exceptions import *
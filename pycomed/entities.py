@@ -1,4 +1,7 @@
+import logging
 import os
+import sys
+import time
 from abc import ABC, abstractmethod
 from enum import Enum
 
@@ -6,6 +9,10 @@ import SimpleITK as sitk
 
 import pycomed
 
+# Setting up the logger.
+logger = logging.getLogger("pycomed entities.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
 
 class MRIImage(ABC):
     """Base class that describes the behavior that any MRI image
@@ -14,7 +21,9 @@ class MRIImage(ABC):
     """
 
     @abstractmethod
-    def perform_registration(self, fixed_image, output_path):
+    def perform_registration(self, fixed_image, output_path, fixed_pyramid=None, transform_only=False,
+                             force_registration=False, config=None, report=None, cache=None, fixed_mask=None,
+                             moving_mask=None):
         """Performs the registration using as the moving image the object that
         implements this method and registers it on a fixed image given as param.
 
@@ -24,6 +33,20 @@ class MRIImage(ABC):
         Args:
             fixed_image: fixed image that will be used to register.
             output_path: path in which the registered image will be saved as nifti.
+            fixed_pyramid: optional precomputed pyramid of the fixed image, useful when
+                           many images are registered on the same fixed image.
+            transform_only: if true only the optimized transform is saved (as .tfm) instead
+                            of the registered image, the image can be resampled later on demand.
+                            The reason and the metric value of the registration are always saved
+                            next to them (as .json).
+            force_registration: if true the optimization is performed even if the images
+                                are already aligned, e.g. they share the same frame of reference.
+            config: registration configuration, e.g. one of the named presets.
+            report: optional RegistrationReport that collects the instrumentation of the registration.
+            cache: optional RegistrationCache, if the same images have been already registered with
+                   the same parameters the cached transform is used instead of registering again.
+            fixed_mask: optional mask of the fixed image, the metric is sampled only inside of it.
+            moving_mask: optional mask of the moving image, the metric is sampled only inside of it.
 
         Returns: the output path of the registered image so the user can choose how to read it.
 
@@ -57,28 +80,151 @@ class DICOMScan(Scan, MRIImage):
 
         self.sequences.append(sequence)
 
-    def perform_registration(self, fixed_image, output_path):
+    def perform_registration(self, fixed_image, output_path, fixed_pyramid=None, transform_only=False,
+                             force_registration=False, config=None, report=None, cache=None, fixed_mask=None,
+                             moving_mask=None):
         """InheritDoc.
 
         """
 
-        sitk_moving_image = sitk.Cast(pycomed.SITKHelper.load_series(self.path), sitk.sitkFloat32)
-        sitk_fixed_image = sitk.Cast(pycomed.SITKHelper.load_series(fixed_image.path), sitk.sitkFloat32)
+        if report is not None and report.name is None:
+            report.name = self.get_registration_file_name(fixed_image, "tfm")
+
+        registration_result = None
+        start_time = time.time()
+
+        if cache is not None:
+            if config is None:
+                config = fixed_pyramid.config if fixed_pyramid is not None else pycomed.RegistrationConfig()
+
+            moving_fingerprint = pycomed.FingerprintHelper.fingerprint_path(self.path)
+            fixed_fingerprint = pycomed.FingerprintHelper.fingerprint_path(fixed_image.path)
+
+            # The masks change the sampled points, so they are part of the parameters of the entry.
+            if fixed_mask is None and fixed_pyramid is not None:
+                fixed_mask = fixed_pyramid.fixed_mask
+            mask_fingerprints = {name: pycomed.FingerprintHelper.fingerprint_image(mask) if mask is not None else None
+                                 for name, mask in (("fixed_mask", fixed_mask), ("moving_mask", moving_mask))}
+
+            parameters = {"config": config.to_dict(), "force_registration": force_registration, **mask_fingerprints}
+
+            registration_result = cache.get(moving_fingerprint, fixed_fingerprint, parameters)
+
+            # The cache hits are reported too, so that the batch reports account for every registration.
+            if registration_result is not None and report is not None:
+                report.start(config, 0.)
+                report.finish(registration_result, time.time() - start_time, cached=True)
 
-        registered_scan = pycomed.SITKRegistrationHelper.perform_registration(sitk_moving_image, sitk_fixed_image)
+        # The images are not needed if only the cached transform has to be written.
+        if registration_result is None or not transform_only:
+            sitk_moving_image = sitk.Cast(pycomed.SITKHelper.load_series(self.path), sitk.sitkFloat32)
+
+            # The fixed image is already loaded inside of the pyramid, if supplied.
+            if fixed_pyramid is None:
+                sitk_fixed_image = sitk.Cast(pycomed.SITKHelper.load_series(fixed_image.path), sitk.sitkFloat32)
+            else:
+                sitk_fixed_image = fixed_pyramid.fixed_scan
+
+        if registration_result is None:
+            registration_result = pycomed.SITKRegistrationHelper.compute_registration(
+                sitk_moving_image, sitk_fixed_image, fixed_pyramid, moving_metadata=self.sequences[0],
+                fixed_metadata=fixed_image.sequences[0], force_registration=force_registration, config=config,
+                report=report, fixed_mask=fixed_mask, moving_mask=moving_mask)
+
+            if cache is not None:
+                cache.put(moving_fingerprint, fixed_fingerprint, parameters, registration_result)
+
+        logger.info(f"Registration of {self.path} on {fixed_image.path}: {registration_result.reason}, "
+                    f"metric value {registration_result.metric_value}.")
 
         if not os.path.exists(output_path):
             os.makedirs(output_path)
 
+        # The outcome of the registration is written next to it, e.g. to find the skipped optimizations.
+        pycomed.SITKRegistrationHelper.write_registration_result(
+            registration_result, os.path.join(output_path, self.get_registration_file_name(fixed_image, "json")))
+
+        if transform_only:
+            # We will write only the transform, the registered image can be resampled from it on demand.
+            pycomed.SITKRegistrationHelper.write_transform(
+                registration_result.transform,
+                os.path.join(output_path, self.get_registration_file_name(fixed_image, "tfm")))
+        else:
+            registered_scan = pycomed.SITKRegistrationHelper.apply_transforms(sitk_moving_image, sitk_fixed_image,
+                                                                              [registration_result.transform])
+
+            # We will write the registered image as a nifti file.
+            pycomed.SITKHelper.write_scan_as_nifti(
+                registered_scan, os.path.join(output_path, self.get_registration_file_name(fixed_image, "nii")))
+
+        return output_path
+
+    def get_registration_file_name(self, fixed_image, extension):
+        """Builds the name of the file in which the registration on a fixed image is saved.
+
+        Args:
+            fixed_image: fixed image used to register.
+            extension: extension of the file, e.g. nii for the registered image or tfm for the transform.
+
+        Returns: the file name.
+
+        """
+
         patient_name = self.sequences[0].PatientName
         moving_image_series_number = self.sequences[0].SeriesNumber
         fixed_image_series_number = fixed_image.sequences[0].SeriesNumber
-        file_name = f'{patient_name}_SEQ{moving_image_series_number}->SEQ{fixed_image_series_number}.nii'
 
-        # We will write the registered image as a nifti file.
-        pycomed.SITKHelper.write_scan_as_nifti(registered_scan, os.path.join(output_path, file_name))
+        return f'{patient_name}_SEQ{moving_image_series_number}->SEQ{fixed_image_series_number}.{extension}'
 
-        return output_path
+
+class NIfTIScan(Scan):
+    """NIfTI scan entity, e.g. a scan converted by the DICOMDatasetConverter or a registered scan.
+    The header is read only when needed and the voxels of uncompressed files are memory mapped.
+
+    """
+
+    def __init__(self, path, header=None):
+        super(NIfTIScan, self).__init__(path)
+        self._header = header
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = pycomed.NIfTIHelper.read_header(self.path)
+
+        return self._header
+
+    @property
+    def size(self):
+        return pycomed.NIfTIHelper.get_size(self.header)
+
+    @property
+    def geometry(self):
+        return pycomed.NIfTIHelper.get_geometry(self.header)
+
+    def get_array(self, memmap=True):
+        """Gets the voxels of the scan as a (z, y, x) array.
+
+        Args:
+            memmap: if true uncompressed files are memory mapped.
+
+        Returns: the array of the voxels.
+
+        """
+
+        return pycomed.NIfTIHelper.load_array(self.path, self.header, memmap)
+
+    def load_scan(self, memmap=True):
+        """Loads the scan with SimpleITK.
+
+        Args:
+            memmap: if true uncompressed files are memory mapped while they are copied.
+
+        Returns: the SimpleITK scan.
+
+        """
+
+        return pycomed.NIfTIHelper.load_scan(self.path, memmap)
 
 
 class SITKScan(Scan):
@@ -104,6 +250,28 @@ class SITKScan(Scan):
         self.direction = direction
 
 
+class RegistrationResult:
+    """Result of a registration, it keeps the optimized transform so that the moving scan
+    can be resampled on demand instead of writing every registered scan on the disk.
+
+    """
+
+    def __init__(self, transform, metric_value=None, reason=None):
+        """
+
+        Initialization method of the object.
+        Args:
+            transform: transform that maps the points of the fixed scan on the moving scan.
+            metric_value: value of the similarity metric at the end of the optimization.
+            reason: why the transform has been obtained in this way, e.g. the optimization
+                    has been skipped because the scans are already aligned.
+
+        """
+        self.transform = transform
+        self.metric_value = metric_value
+        self.reason = reason
+
+
 class ScanType(Enum):
     """Enum that specifies all the scan types that are supported by
     the pycomed SDK.
@@ -111,3 +279,4 @@ class ScanType(Enum):
     """
 
     DICOM = 0
+    NIFTI = 1
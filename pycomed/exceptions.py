@@ -38,3 +38,34 @@ class ScanTypeNotSupportedException(Exception):
 
     def __init__(self):
         super(ScanTypeNotSupportedException, self).__init__("pycomed currently does not support this scan type.")
+
+
+class RegistrationPresetNotFoundException(Exception):
+    """Exception thrown when a registration preset does not exist.
+
+    """
+
+    def __init__(self, preset_name):
+        super(RegistrationPresetNotFoundException, self).__init__(
+            f"The registration preset {preset_name} does not exist.")
+
+
+class PyramidNotCompatibleException(Exception):
+    """Exception thrown when the multi-resolution levels of a fixed image pyramid are
+    different from the ones of the registration configuration.
+
+    """
+
+    def __init__(self):
+        super(PyramidNotCompatibleException, self).__init__(
+            "The fixed image pyramid was built with different multi-resolution levels than the registration ones.")
+
+
+class MetadataNotAvailableException(Exception):
+    """Exception thrown when a query needs metadata that the scan type does not store, e.g.
+    the acquisition date of a NIfTI scan.
+
+    """
+
+    def __init__(self):
+        super(MetadataNotAvailableException, self).__init__("The metadata needed are not available for this scan type.")
@@ -3,5 +3,10 @@ io package - Manages the organization and reading of datasets.
 
 """
 
+from .conversion import *
+from .export import *
+from .nifti import *
 from .organization import *
 from .reading import *
+from .sampling import *
+from .storage import *
@@ -0,0 +1,343 @@
+"""This module contains the conversion of an organized DICOM dataset to NIfTI files, following the schema:
+/outputDir: (contains n number of different patients)
+    /patientX: (contains one NIfTI file for each scan of the patient)
+        F_scanX.nii.gz: (the fixed scan, resampled with an isotropic spacing)
+        M_scanY.nii.gz: (the moving scans)
+Optionally the scans are also written as chunked volume stores, following the same schema in another folder.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+
+import SimpleITK as sitk
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from pycomed.entities import SITKScan
+from pycomed.io.storage import DEFAULT_CHUNK_SHAPE, DEFAULT_CODEC, ChunkedVolumeStore
+from pycomed.processing import FingerprintHelper, SITKHelper, ThreadBudgetScheduler
+
+MOVING_SCAN_TYPE = "M"
+FIXED_SCAN_TYPE = "F"
+# Compression level of zlib used when it is not specified, the same of gzip.
+DEFAULT_COMPRESSION_LEVEL = 6
+# Name of the file that keeps track of the converted scans in the output folder, it is hidden
+# so that the output folder is a valid NIfTI dataset.
+MANIFEST_FILE_NAME = ".conversion_manifest.json"
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed conversion.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+def _convert_scan(task):
+    """Converts a scan to NIfTI, it is defined at the top level so that it can be run by the worker processes.
+
+    Args:
+        task: tuple with the scan path, the output file path, the spacing of the fixed scan
+              (None for a moving scan), the compression level, the number of compression threads,
+              the path, chunk shape and codec of the chunked store (None if it is not written) and
+              the orientation of the scan (None to keep the acquired one).
+
+    Returns: the output file path, None if the scan cannot be read or converted.
+
+    """
+
+    scan_path, output_file_path, fixed_spacing, compression_level, threads, store, orientation = task
+
+    # A scan that fails is reported as failed, so that it does not abort the conversion of the other scans.
+    try:
+        scan = SITKHelper.load_series(scan_path)
+        if scan is None:
+            return None
+
+        # The fixed scan is resampled, as done by SITKHelper.get_fixed_scan. The resampling
+        # keeps the identity direction, so the scan is brought to the LPS orientation first.
+        if fixed_spacing is not None:
+            if orientation is not None:
+                scan = SITKHelper.reorient(scan, "LPS")
+            scan = sitk.Cast(SITKHelper.resample(scan, spacing=fixed_spacing), sitk.sitkFloat32)
+
+        if orientation is not None:
+            scan = SITKHelper.reorient(scan, orientation)
+
+        SITKHelper.write_scan_as_nifti(scan, output_file_path, compression_level=compression_level, threads=threads)
+
+        if store is not None:
+            store_path, chunk_shape, codec = store
+            ChunkedVolumeStore.write(store_path, scan, chunk_shape=chunk_shape, codec=codec, threads=threads)
+    except Exception as exception:
+        logger.debug(f"The scan {scan_path} cannot be converted: {exception}")
+        return None
+
+    return output_file_path
+
+
+class DICOMDatasetConverter:
+    """Converts the scans of a DICOM dataset to NIfTI files in parallel. The scans that are
+    already converted and did not change since the previous conversion are skipped.
+
+    """
+
+    def __init__(self, dataset_reader, output_path, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 fixed_spacing=(1., 1., 1.), scheduler=None, store_path=None,
+                 chunk_shape=DEFAULT_CHUNK_SHAPE, codec=DEFAULT_CODEC, orientation=None):
+        """
+
+        Initialization method of the object.
+        Args:
+            dataset_reader: DICOMDatasetReader of the organized dataset.
+            output_path: folder in which the NIfTI files are written.
+            compression_level: gzip compression level (0-9) of the .nii.gz files,
+                               if None the files are written uncompressed as .nii.
+            fixed_spacing: spacing used to resample the fixed scan of every patient.
+            scheduler: ThreadBudgetScheduler used to convert the scans, one using
+                       all the cores is created if not supplied.
+            store_path: folder in which the scans are also written as chunked volume stores,
+                        the stores are not written if not specified.
+            chunk_shape: (z, y, x) shape of the chunks of the stores.
+            codec: codec of the chunks of the stores, one of CODECS.
+            orientation: orientation code (e.g. LPS or RAS) to which the scans are reoriented,
+                         if None the scans keep the orientation of the acquisition.
+
+        """
+
+        self.dataset_reader = dataset_reader
+        self.output_path = output_path
+        self.compression_level = compression_level
+        self.fixed_spacing = tuple(fixed_spacing)
+        self.scheduler = scheduler if scheduler is not None else ThreadBudgetScheduler()
+        self.store_path = store_path
+        self.chunk_shape = tuple(chunk_shape)
+        self.codec = codec
+        self.orientation = orientation
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.output_path, MANIFEST_FILE_NAME)
+
+    def convert(self, patient_names=None):
+        """Converts the scans of the dataset, skipping the ones that are up to date.
+
+        Args:
+            patient_names: names of the patients to convert, all the patients if not specified.
+
+        Returns: a dictionary with the lists of the "converted", "skipped" and "failed" output files.
+
+        """
+
+        manifest = self.read_manifest()
+
+        if patient_names is None:
+            patient_names = sorted(filter(lambda name: not name.startswith("."),
+                                          os.listdir(self.dataset_reader.dataset_path)))
+
+        tasks = []
+        entries = {}
+        skipped = []
+
+        for patient_name in patient_names:
+            scans_paths = DICOMDatasetConverterHelper.get_scans_paths(
+                os.path.join(self.dataset_reader.dataset_path, patient_name))
+
+            fixed_scan_index = DICOMDatasetConverterHelper.get_fixed_scan_index(scans_paths)
+
+            os.makedirs(os.path.join(self.output_path, patient_name), exist_ok=True)
+
+            for i, scan_path in enumerate(scans_paths):
+                is_fixed = i == fixed_scan_index
+                scan_key = os.path.join(patient_name, os.path.basename(scan_path))
+                output_file_name = self.get_output_file_name(scan_path, is_fixed)
+
+                entry = {
+                    "output": os.path.join(patient_name, output_file_name),
+                    "source": FingerprintHelper.fingerprint_path(scan_path),
+                    "parameters": {
+                        "fixed_spacing": self.fixed_spacing if is_fixed else None,
+                        "compression_level": self.compression_level,
+                        "orientation": self.orientation,
+                    },
+                }
+                if self.store_path is not None:
+                    entry["store"] = os.path.join(patient_name, self.get_store_name(scan_path, is_fixed))
+                    entry["parameters"]["chunk_shape"] = self.chunk_shape
+                    entry["parameters"]["codec"] = self.codec
+                # The parameters are compared as they are read back from the JSON manifest.
+                entry = json.loads(json.dumps(entry))
+
+                previous_entry = manifest.get(scan_key)
+                if previous_entry == entry and os.path.exists(os.path.join(self.output_path, entry["output"])) and \
+                        ("store" not in entry or os.path.exists(os.path.join(self.store_path, entry["store"]))):
+                    skipped.append(entry["output"])
+                    continue
+
+                # The scan can have changed role or compression, its previous output is removed.
+                if previous_entry is not None and previous_entry["output"] != entry["output"]:
+                    previous_output_path = os.path.join(self.output_path, previous_entry["output"])
+                    if os.path.exists(previous_output_path):
+                        os.remove(previous_output_path)
+
+                if previous_entry is not None and "store" in previous_entry and self.store_path is not None and \
+                        previous_entry["store"] != entry.get("store"):
+                    shutil.rmtree(os.path.join(self.store_path, previous_entry["store"]), ignore_errors=True)
+
+                entries[scan_key] = entry
+                # Every worker compresses its files with its share of the threads.
+                tasks.append((scan_path, os.path.join(self.output_path, entry["output"]),
+                              self.fixed_spacing if is_fixed else None, self.compression_level,
+                              self.scheduler.threads_per_worker,
+                              None if self.store_path is None else (os.path.join(self.store_path, entry["store"]),
+                                                                    self.chunk_shape, self.codec),
+                              self.orientation))
+
+        logger.debug(f"Converting {len(tasks)} scans, {len(skipped)} scans are up to date.")
+
+        results = self.scheduler.map(_convert_scan, tasks)
+
+        converted = []
+        failed = []
+        for (scan_key, entry), result in zip(entries.items(), results):
+            if result is None:
+                failed.append(entry["output"])
+                manifest.pop(scan_key, None)
+            else:
+                converted.append(entry["output"])
+                manifest[scan_key] = entry
+
+        self.write_manifest(manifest)
+
+        return {"converted": converted, "skipped": skipped, "failed": failed}
+
+    def get_output_file_name(self, scan_path, is_fixed):
+        """Gets the name of the NIfTI file of a scan, prefixed by its role.
+
+        Args:
+            scan_path: path of the folder of the scan.
+            is_fixed: true if the scan is the fixed scan of the patient.
+
+        Returns: the name of the output file.
+
+        """
+
+        scan_type = FIXED_SCAN_TYPE if is_fixed else MOVING_SCAN_TYPE
+        extension = "nii" if self.compression_level is None else "nii.gz"
+
+        return f"{scan_type}_{os.path.basename(scan_path)}.{extension}"
+
+    def get_store_name(self, scan_path, is_fixed):
+        """Gets the name of the folder of the chunked store of a scan, prefixed by its role.
+
+        Args:
+            scan_path: path of the folder of the scan.
+            is_fixed: true if the scan is the fixed scan of the patient.
+
+        Returns: the name of the store folder.
+
+        """
+
+        scan_type = FIXED_SCAN_TYPE if is_fixed else MOVING_SCAN_TYPE
+
+        return f"{scan_type}_{os.path.basename(scan_path)}"
+
+    def read_manifest(self):
+        """Reads the manifest of the previous conversions.
+
+        Returns: a dictionary from the scans to their output files, source fingerprints and parameters.
+
+        """
+
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def write_manifest(self, manifest):
+        """Writes the manifest of the conversions atomically.
+
+        Args:
+            manifest: dictionary from the scans to their output files, source fingerprints and parameters.
+
+        """
+
+        os.makedirs(self.output_path, exist_ok=True)
+
+        with open(self.manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+
+class DICOMDatasetConverterHelper:
+    """Helper class containing methods to choose the fixed scan from the DICOM headers, the same
+    choice is made by the converter, the exporter and DICOMDatasetReader.get_fixed_image.
+
+    """
+
+    @staticmethod
+    def get_scans_paths(patient_path):
+        """Lists the folders of the scans of a patient, in the order in which the fixed scan is searched.
+
+        Args:
+            patient_path: path of the folder of the patient.
+
+        Returns: the sorted paths of the folders of the scans, without the hidden ones.
+
+        """
+
+        return [os.path.join(patient_path, scan_folder_name) for scan_folder_name in sorted(os.listdir(patient_path))
+                if not scan_folder_name.startswith(".")]
+
+    @staticmethod
+    def get_scan_geometry(scan_path):
+        """Gets depth and direction of a scan from the header of one of its DICOM files,
+        without decoding the pixels.
+
+        Args:
+            scan_path: path of the folder containing the DICOM files of the scan.
+
+        Returns: a tuple with the depth (the lowest dimension) and the diagonal of the direction
+                 matrix of the scan, None if the header cannot be read.
+
+        """
+
+        scan_file_names = os.listdir(scan_path)
+
+        try:
+            header = pydicom.dcmread(os.path.join(scan_path, scan_file_names[0]), stop_before_pixels=True,
+                                     specific_tags=["Rows", "Columns", "ImageOrientationPatient"])
+            row_direction = np.array(header.ImageOrientationPatient[:3], dtype=float)
+            column_direction = np.array(header.ImageOrientationPatient[3:], dtype=float)
+            depth = min(int(header.Columns), int(header.Rows), len(scan_file_names))
+        except (InvalidDicomError, AttributeError, IndexError):
+            return None
+
+        # The columns of the direction matrix are the row, column and slice directions.
+        direction = np.stack([row_direction, column_direction, np.cross(row_direction, column_direction)], axis=1)
+
+        return depth, np.diag(direction)
+
+    @staticmethod
+    def get_fixed_scan_index(scans_paths):
+        """Searches for the fixed scan of a patient, the scan with an axial orientation and
+        with the highest depth, reading only the DICOM headers.
+
+        Args:
+            scans_paths: paths of the folders of the scans of the patient.
+
+        Returns: the index of the fixed scan in the list of the paths.
+
+        """
+
+        scans = []
+        for scan_path in scans_paths:
+            geometry = DICOMDatasetConverterHelper.get_scan_geometry(scan_path)
+            # A scan whose header cannot be read is never chosen, it has no depth and no direction.
+            depth, direction = geometry if geometry is not None else (0, np.zeros(3))
+            scans.append(SITKScan(scan_path, None, depth, direction))
+
+        return SITKHelper.get_fixed_scan_index(scans)
@@ -0,0 +1,246 @@
+"""This module contains the export of all the scans of a patient as a single multi-channel array on the
+grid of the fixed scan, following the schema:
+/outputDir: (contains n number of different patients)
+    /patientX:
+        channels.npy: (the (channels, z, y, x) array, the first channel is the fixed scan)
+        channels.json: (the geometry of the grid and the metadata of every channel)
+        *.tfm: (the transforms of the moving scans on the fixed scan)
+        *.json: (the reason and the metric value of every registration)
+
+"""
+
+import json
+import logging
+import os
+import sys
+
+import SimpleITK as sitk
+import numpy as np
+import pydicom
+
+from pycomed.io.conversion import DICOMDatasetConverterHelper
+from pycomed.io.reading import DICOMDatasetReaderHelper
+from pycomed.processing import RegistrationConfig, SITKHelper, SITKRegistrationHelper, ThreadBudgetScheduler
+
+CHANNELS_FILE_NAME = "channels.npy"
+CHANNELS_METADATA_FILE_NAME = "channels.json"
+FIXED_CHANNEL_ROLE = "fixed"
+MOVING_CHANNEL_ROLE = "moving"
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed export.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+def _export_channel(task):
+    """Resamples a scan on the grid of the fixed scan and writes it in its channel of the memory mapped
+    array, it is defined at the top level so that it can be run by the worker processes.
+
+    Args:
+        task: tuple with the channel index, the scan path, the fixed scan path (None for the fixed
+              scan), the path of the array, the grid geometry, the folder of the transforms, the
+              registration cache, the registration configuration and the interpolator.
+
+    Returns: the metadata of the channel, None if the scan cannot be read or exported.
+
+    """
+
+    channel, scan_path, fixed_scan_path, array_path, geometry, transforms_path, cache, config, interpolator = task
+
+    # A channel that fails is reported as failed, so that it does not abort the export of the other channels.
+    try:
+        scan = SITKHelper.load_series(scan_path)
+        if scan is None:
+            return None
+
+        metadata = {"channel": channel, "path": scan_path,
+                    **PatientTensorExporterHelper.read_series_metadata(scan_path)}
+
+        if fixed_scan_path is None:
+            metadata.update({"role": FIXED_CHANNEL_ROLE, "transform": None})
+            transform = sitk.Transform(3, sitk.sitkIdentity)
+        else:
+            # The registration always goes through the cache, keyed on the fingerprints of the scans, so a
+            # transform written before the scans changed is never reused.
+            moving_scan = DICOMDatasetReaderHelper.serialize_scan(scan_path)
+            fixed_scan = DICOMDatasetReaderHelper.serialize_scan(fixed_scan_path)
+            transform_path = os.path.join(transforms_path, moving_scan.get_registration_file_name(fixed_scan, "tfm"))
+
+            moving_scan.perform_registration(fixed_scan, transforms_path, transform_only=True, cache=cache,
+                                             config=config)
+
+            metadata.update({"role": MOVING_CHANNEL_ROLE, "transform": transform_path})
+            transform = SITKRegistrationHelper.read_transform(transform_path)
+
+        resampled_scan = SITKRegistrationHelper.apply_transforms(
+            sitk.Cast(scan, sitk.sitkFloat32), PatientTensorExporterHelper.create_reference_scan(geometry),
+            [transform], interpolator=interpolator)
+        voxels = sitk.GetArrayViewFromImage(resampled_scan)
+
+        # Every worker writes only its channel, so the channels can be written in parallel.
+        array = np.load(array_path, mmap_mode="r+")
+        array[channel] = voxels
+        array.flush()
+        del array
+
+        metadata.update({"minimum": float(voxels.min()), "maximum": float(voxels.max())})
+    except Exception as exception:
+        logger.debug(f"The scan {scan_path} cannot be exported: {exception}")
+        return None
+
+    return metadata
+
+
+class PatientTensorExporter:
+    """Exports all the scans of a patient as a single (channels, z, y, x) memory mapped array on the
+    grid of the fixed scan. The channels are resampled in parallel, and the transforms stored in the
+    registration cache are reused instead of registering the scans again.
+
+    """
+
+    def __init__(self, dataset_reader, output_path, fixed_spacing=(1., 1., 1.), scheduler=None, cache=None,
+                 transforms_path=None, config=None, interpolator=sitk.sitkLinear, dtype=np.float32):
+        """
+
+        Initialization method of the object.
+        Args:
+            dataset_reader: DICOMDatasetReader of the organized dataset.
+            output_path: folder in which the arrays of the patients are written.
+            fixed_spacing: spacing of the grid, the fixed scan is resampled with it.
+            scheduler: ThreadBudgetScheduler used to resample the channels, one using
+                       all the cores is created if not supplied.
+            cache: optional RegistrationCache used by the registrations, without it every moving scan
+                   is registered again.
+            transforms_path: folder in which the transforms are written, the folder of the patient if
+                             not specified.
+            config: registration configuration, the default one if not specified.
+            interpolator: interpolator used to resample the channels.
+            dtype: data type of the array.
+
+        """
+
+        self.dataset_reader = dataset_reader
+        self.output_path = output_path
+        self.fixed_spacing = tuple(fixed_spacing)
+        self.scheduler = scheduler if scheduler is not None else ThreadBudgetScheduler()
+        self.cache = cache
+        self.transforms_path = transforms_path
+        self.config = config if config is not None else RegistrationConfig()
+        self.interpolator = interpolator
+        self.dtype = np.dtype(dtype)
+
+    def export(self, patient_name):
+        """Exports the scans of a patient, the fixed scan is the first channel and the moving scans
+        follow in the order of their folders.
+
+        Args:
+            patient_name: name of the patient.
+
+        Returns: the path of the array, None if the fixed scan cannot be read.
+
+        """
+
+        scans_paths = DICOMDatasetConverterHelper.get_scans_paths(
+            os.path.join(self.dataset_reader.dataset_path, patient_name))
+
+        fixed_scan_path = scans_paths.pop(DICOMDatasetConverterHelper.get_fixed_scan_index(scans_paths))
+
+        fixed_scan = SITKHelper.load_series(fixed_scan_path)
+        if fixed_scan is None:
+            logger.debug(f"The fixed scan of the patient {patient_name} cannot be read.")
+            return None
+
+        geometry = PatientTensorExporterHelper.get_reference_geometry(fixed_scan, self.fixed_spacing)
+        del fixed_scan
+
+        output_patient_path = os.path.join(self.output_path, patient_name)
+        transforms_path = self.transforms_path if self.transforms_path is not None else output_patient_path
+        os.makedirs(output_patient_path, exist_ok=True)
+
+        # The array is created here and every worker maps it to write its channel.
+        array_path = os.path.join(output_patient_path, CHANNELS_FILE_NAME)
+        shape = (1 + len(scans_paths),) + tuple(geometry["size"][::-1])
+        array = np.lib.format.open_memmap(array_path, mode="w+", dtype=self.dtype, shape=shape)
+        del array
+
+        tasks = [(channel, scan_path, None if channel == 0 else fixed_scan_path, array_path, geometry,
+                  transforms_path, self.cache, self.config, self.interpolator)
+                 for channel, scan_path in enumerate([fixed_scan_path] + scans_paths)]
+
+        logger.debug(f"Exporting {len(tasks)} channels of the patient {patient_name}.")
+
+        channels = self.scheduler.map(_export_channel, tasks)
+
+        failed_channels = [{"channel": task[0], "path": task[1]} for task, channel in zip(tasks, channels)
+                           if channel is None]
+        if len(failed_channels) > 0:
+            logger.debug(f"The scans {[channel['path'] for channel in failed_channels]} cannot be exported, "
+                         f"their channels are empty.")
+
+        metadata = {"patient": patient_name, "shape": shape, "dtype": self.dtype.str, **geometry,
+                    "channels": [channel for channel in channels if channel is not None], "failed": failed_channels}
+
+        with open(os.path.join(output_patient_path, CHANNELS_METADATA_FILE_NAME), "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2, default=str)
+
+        return array_path
+
+
+class PatientTensorExporterHelper:
+    """Helper class containing methods to describe the grid of the exported arrays and their channels.
+
+    """
+
+    @staticmethod
+    def get_reference_geometry(fixed_scan, spacing):
+        """Gets the grid of the fixed scan resampled with a spacing, the same grid of SITKHelper.resample.
+
+        Args:
+            fixed_scan: fixed scan read by SimpleITK.
+            spacing: spacing of the grid.
+
+        Returns: a dictionary with the size, origin, spacing and direction of the grid.
+
+        """
+
+        physical_size = np.array(fixed_scan.GetSpacing()) * np.array(fixed_scan.GetSize())
+
+        return {
+            "size": [int(dimension) for dimension in physical_size / np.array(spacing)],
+            "origin": list(fixed_scan.GetOrigin()),
+            "spacing": list(spacing),
+            "direction": np.eye(3).flatten().tolist(),
+        }
+
+    @staticmethod
+    def create_reference_scan(geometry):
+        """Creates an empty scan with the grid described by a geometry, used as the reference of the resampling.
+
+        """
+
+        reference_scan = sitk.Image([int(dimension) for dimension in geometry["size"]], sitk.sitkUInt8)
+        reference_scan.SetOrigin(geometry["origin"])
+        reference_scan.SetSpacing(geometry["spacing"])
+        reference_scan.SetDirection(geometry["direction"])
+
+        return reference_scan
+
+    @staticmethod
+    def read_series_metadata(scan_path):
+        """Reads the description of a series from the header of one of its DICOM files.
+
+        Args:
+            scan_path: path of the folder containing the DICOM files of the scan.
+
+        Returns: a dictionary with the series number, the series description and the modality.
+
+        """
+
+        header = pydicom.dcmread(os.path.join(scan_path, sorted(os.listdir(scan_path))[0]), stop_before_pixels=True,
+                                 specific_tags=["SeriesNumber", "SeriesDescription", "Modality"])
+
+        return {
+            "series_number": int(header.SeriesNumber) if header.get("SeriesNumber") is not None else None,
+            "series_description": str(header.get("SeriesDescription", "")),
+            "modality": str(header.get("Modality", "")),
+        }
@@ -0,0 +1,202 @@
+"""This module contains the reading of NIfTI-1 files without decoding them with SimpleITK: the
+header is parsed directly, so that uncompressed volumes can be memory mapped and re-reading a
+converted dataset costs almost nothing.
+
+"""
+
+import gzip
+import logging
+import sys
+
+import SimpleITK as sitk
+import numpy as np
+
+from pycomed.exceptions import ScanTypeNotSupportedException
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+NIFTI_HEADER_SIZE = 348
+NIFTI_MAGICS = (b"n+1", b"ni1")
+
+# Layout of the NIfTI-1 header.
+NIFTI_HEADER_DTYPE = np.dtype([
+    ("sizeof_hdr", "i4"), ("data_type", "S10"), ("db_name", "S18"), ("extents", "i4"), ("session_error", "i2"),
+    ("regular", "S1"), ("dim_info", "u1"), ("dim", "i2", (8,)), ("intent_p1", "f4"), ("intent_p2", "f4"),
+    ("intent_p3", "f4"), ("intent_code", "i2"), ("datatype", "i2"), ("bitpix", "i2"), ("slice_start", "i2"),
+    ("pixdim", "f4", (8,)), ("vox_offset", "f4"), ("scl_slope", "f4"), ("scl_inter", "f4"), ("slice_end", "i2"),
+    ("slice_code", "u1"), ("xyzt_units", "u1"), ("cal_max", "f4"), ("cal_min", "f4"), ("slice_duration", "f4"),
+    ("toffset", "f4"), ("glmax", "i4"), ("glmin", "i4"), ("descrip", "S80"), ("aux_file", "S24"),
+    ("qform_code", "i2"), ("sform_code", "i2"), ("quatern_b", "f4"), ("quatern_c", "f4"), ("quatern_d", "f4"),
+    ("qoffset_x", "f4"), ("qoffset_y", "f4"), ("qoffset_z", "f4"), ("srow_x", "f4", (4,)), ("srow_y", "f4", (4,)),
+    ("srow_z", "f4", (4,)), ("intent_name", "S16"), ("magic", "S4"),
+])
+
+# NIfTI data type codes of the supported scalar types.
+NIFTI_DATA_TYPES = {
+    2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+    256: np.int8, 512: np.uint16, 768: np.uint32, 1024: np.int64, 1280: np.uint64,
+}
+
+# NIfTI uses the RAS+ convention, ITK the LPS+ one.
+RAS_TO_LPS = np.diag([-1., -1., 1.])
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed nifti.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class NIfTIHelper:
+    """Helper class containing methods to read NIfTI-1 headers, geometry and voxels.
+
+    """
+
+    @staticmethod
+    def is_nifti_path(path):
+        """Checks if a path has the extension of a NIfTI file.
+
+        """
+
+        return path.endswith(NIFTI_EXTENSIONS)
+
+    @staticmethod
+    def read_header(path):
+        """Reads the header of a NIfTI-1 file, compressed or not.
+
+        Args:
+            path: path of the .nii or .nii.gz file.
+
+        Returns: the header as a NumPy record, with the byte order of the file.
+
+        """
+
+        open_file = gzip.open if path.endswith(".gz") else open
+        with open_file(path, "rb") as nifti_file:
+            header_bytes = nifti_file.read(NIFTI_HEADER_SIZE)
+
+        if len(header_bytes) < NIFTI_HEADER_SIZE:
+            raise ScanTypeNotSupportedException()
+
+        # The size of the header is used to detect the byte order of the file.
+        header = np.frombuffer(header_bytes, dtype=NIFTI_HEADER_DTYPE.newbyteorder("<"))[0]
+        if header["sizeof_hdr"] != NIFTI_HEADER_SIZE:
+            header = np.frombuffer(header_bytes, dtype=NIFTI_HEADER_DTYPE.newbyteorder(">"))[0]
+
+        if header["sizeof_hdr"] != NIFTI_HEADER_SIZE or header["magic"][:3] not in NIFTI_MAGICS:
+            raise ScanTypeNotSupportedException()
+
+        return header
+
+    @staticmethod
+    def get_size(header):
+        """Gets the size (x, y, z) of the volume, 1 for the missing dimensions.
+
+        """
+
+        number_of_dimensions = int(header["dim"][0])
+
+        return tuple(int(header["dim"][i]) if i <= number_of_dimensions else 1 for i in range(1, 4))
+
+    @staticmethod
+    def get_geometry(header):
+        """Gets the geometry of the volume in the LPS convention used by SimpleITK, from the
+        sform if defined, otherwise from the qform, otherwise only from the voxel sizes.
+
+        Args:
+            header: header read by read_header.
+
+        Returns: a dictionary with the origin, spacing and direction (flattened as in SimpleITK).
+
+        """
+
+        pixdim = header["pixdim"].astype(np.float64)
+
+        if header["sform_code"] > 0:
+            affine = np.stack([header["srow_x"], header["srow_y"], header["srow_z"]]).astype(np.float64)
+            matrix, origin = affine[:, :3], affine[:, 3]
+        elif header["qform_code"] > 0:
+            b, c, d = (float(header[key]) for key in ("quatern_b", "quatern_c", "quatern_d"))
+            a = np.sqrt(max(1. - (b * b + c * c + d * d), 0.))
+            rotation = np.array([
+                [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+            ])
+            # The sign of the slice direction is stored in the first voxel size.
+            qfac = -1. if pixdim[0] < 0 else 1.
+            matrix = rotation * np.array([pixdim[1], pixdim[2], qfac * pixdim[3]])
+            origin = np.array([header["qoffset_x"], header["qoffset_y"], header["qoffset_z"]], dtype=np.float64)
+        else:
+            matrix, origin = np.diag(pixdim[1:4]), np.zeros(3)
+
+        matrix = RAS_TO_LPS @ matrix
+        spacing = np.linalg.norm(matrix, axis=0)
+        spacing[spacing == 0] = 1.
+
+        return {
+            "origin": tuple((RAS_TO_LPS @ origin).tolist()),
+            "spacing": tuple(spacing.tolist()),
+            "direction": tuple((matrix / spacing).flatten().tolist()),
+        }
+
+    @staticmethod
+    def load_array(path, header=None, memmap=True):
+        """Loads the voxels of a NIfTI-1 file as a (z, y, x) array, the same layout of
+        sitk.GetArrayFromImage. Uncompressed files without intensity scaling are memory mapped,
+        so only the accessed slices are read from the disk.
+
+        Args:
+            path: path of the .nii or .nii.gz file.
+            header: header read by read_header, it is read if not supplied.
+            memmap: if true uncompressed files are memory mapped (read only).
+
+        Returns: the array of the voxels.
+
+        """
+
+        if header is None:
+            header = NIfTIHelper.read_header(path)
+
+        data_type = NIFTI_DATA_TYPES.get(int(header["datatype"]))
+        if data_type is None:
+            raise ScanTypeNotSupportedException()
+
+        dtype = np.dtype(data_type).newbyteorder(header.dtype["sizeof_hdr"].byteorder)
+        shape = NIfTIHelper.get_size(header)[::-1]
+        offset = int(header["vox_offset"])
+
+        if memmap and not path.endswith(".gz"):
+            array = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            open_file = gzip.open if path.endswith(".gz") else open
+            with open_file(path, "rb") as nifti_file:
+                nifti_file.seek(offset)
+                array = np.frombuffer(nifti_file.read(int(np.prod(shape)) * dtype.itemsize), dtype=dtype)
+            array = array.reshape(shape)
+
+        slope, intercept = float(header["scl_slope"]), float(header["scl_inter"])
+        if slope not in (0., 1.) or intercept != 0.:
+            # The scaled intensities cannot be mapped from the disk.
+            array = array * (slope if slope != 0. else 1.) + intercept
+
+        return array
+
+    @staticmethod
+    def load_scan(path, memmap=True):
+        """Loads a NIfTI-1 file as a SimpleITK scan, using the array loaded by load_array.
+
+        Args:
+            path: path of the .nii or .nii.gz file.
+            memmap: if true uncompressed files are memory mapped while they are copied.
+
+        Returns: the SimpleITK scan.
+
+        """
+
+        header = NIfTIHelper.read_header(path)
+        geometry = NIfTIHelper.get_geometry(header)
+
+        scan = sitk.GetImageFromArray(NIfTIHelper.load_array(path, header, memmap))
+        scan.SetOrigin(geometry["origin"])
+        scan.SetSpacing(geometry["spacing"])
+        scan.SetDirection(geometry["direction"])
+
+        return scan
@@ -12,9 +12,11 @@ from abc import ABC, abstractmethod
 import pydicom
 from pydicom.errors import InvalidDicomError
 
-from pycomed.entities import DICOMScan, ScanType
-from pycomed.exceptions import MalformedDatasetException, WrongDateIntervalException, ScanTypeNotSupportedException
-from pycomed.processing import SITKHelper
+from pycomed.entities import DICOMScan, NIfTIScan, ScanType
+from pycomed.exceptions import MalformedDatasetException, MetadataNotAvailableException, \
+    ScanTypeNotSupportedException, WrongDateIntervalException
+from pycomed.io.conversion import FIXED_SCAN_TYPE, DICOMDatasetConverterHelper
+from pycomed.io.nifti import NIfTIHelper
 
 # Setting up the logger.
 logger = logging.getLogger("pycomed reading.py logger")
@@ -39,10 +41,16 @@ class DatasetValidator:
 
         # Checking if the first layer contains all folders, that in our case
         # corresponds to the patients.
-        if self.are_all_folders(self.dataset_path):
-            for patient_folder_name in os.listdir(self.dataset_path):
+        if self.are_all_folders(self.dataset_path, scan_type):
+            for patient_folder_name in self.list_contents(self.dataset_path, scan_type):
                 patient_path = os.path.join(self.dataset_path, patient_folder_name)
 
+                # NIfTI datasets have one file for each scan directly inside of the patient folders.
+                if scan_type == ScanType.NIFTI:
+                    if not self.are_all_files(patient_path, scan_type):
+                        raise MalformedDatasetException()
+                    continue
+
                 # Checking if the second layer contains all folders, that in our case
                 # corresponds to the scans folders containing all the DICOM scans.
                 if self.are_all_folders(patient_path):
@@ -58,11 +66,30 @@ class DatasetValidator:
         else:
             raise MalformedDatasetException()
 
-    def are_all_folders(self, path):
+    @staticmethod
+    def list_contents(path, scan_type=None):
+        """Lists the contents of a path, the hidden files and folders of a NIfTI dataset (e.g. the
+        conversion manifest) are skipped.
+
+        Args:
+            path: path of the folder.
+            scan_type: type of the scan of the dataset.
+
+        Returns: the names of the contents.
+
+        """
+
+        if scan_type != ScanType.NIFTI:
+            return os.listdir(path)
+
+        return [content_name for content_name in os.listdir(path) if not content_name.startswith(".")]
+
+    def are_all_folders(self, path, scan_type=None):
         """Checks if inside of a specific path there are only folders.
 
         Args:
             path: path in which to look for folders.
+            scan_type: type of the scan of the dataset.
 
         Returns: true if there are only folders, false otherwise.
 
@@ -71,8 +98,10 @@ class DatasetValidator:
         if not os.path.exists(path):
             return False
 
+        contents = self.list_contents(path, scan_type)
+
         return len(list(filter(lambda content_name: os.path.isdir(os.path.join(path, content_name)),
-                               os.listdir(path)))) == len(os.listdir(path)) and not len(os.listdir(path)) == 0
+                               contents))) == len(contents) and not len(contents) == 0
 
     def are_all_files(self, path, scan_type=None):
         """Checks if inside of a specific path there are only files.
@@ -89,6 +118,15 @@ class DatasetValidator:
         if not os.path.exists(path):
             return False
 
+        # The NIfTI files are checked one by one, the hidden files are skipped.
+        if scan_type == ScanType.NIFTI:
+            contents = self.list_contents(path, scan_type)
+
+            return len(list(filter(
+                lambda file_name: not os.path.isdir(os.path.join(path, file_name)) and self.check_scan_type(
+                    os.path.join(path, file_name), scan_type),
+                contents))) == len(contents) and not len(contents) == 0
+
         return len(list(filter(
             lambda file_name: not os.path.isdir(
                 os.path.join(path, file_name) and self.check_scan_type(os.path.join(path, file_name), scan_type)),
@@ -111,6 +149,15 @@ class DatasetValidator:
                 return True
             except InvalidDicomError:
                 return False
+        elif scan_type == ScanType.NIFTI:
+            if not NIfTIHelper.is_nifti_path(file_path):
+                return False
+
+            try:
+                NIfTIHelper.read_header(file_path)
+                return True
+            except (ScanTypeNotSupportedException, OSError):
+                return False
         else:
             raise ScanTypeNotSupportedException()
 
@@ -275,11 +322,82 @@ class DICOMDatasetReader(DatasetReader):
 
         """
 
-        patient_scans = self.get_scans_by_patient_name(patient_name)
+        # The fixed scan is chosen from the DICOM headers, in the same way of the converter and the exporter.
+        scans_paths = DICOMDatasetConverterHelper.get_scans_paths(os.path.join(self.dataset_path, patient_name))
+
+        return DICOMDatasetReaderHelper.serialize_scan(
+            scans_paths[DICOMDatasetConverterHelper.get_fixed_scan_index(scans_paths)])
+
+
+class NIfTIDatasetReader(DatasetReader):
+    """Reads a dataset of NIfTI scans, e.g. converted by the DICOMDatasetConverter, following the schema:
+    /rootDir: (contains n number of different patients)
+        /patientX: (contains the NIfTI files of the scans of the patient)
+
+    Only the headers are read when querying, the voxels of uncompressed files are memory mapped.
+
+    """
+
+    def __init__(self, dataset_path):
+        DatasetValidator(dataset_path).validate(ScanType.NIFTI)
+
+        super(NIfTIDatasetReader, self).__init__(dataset_path=dataset_path)
+
+    def get_scans(self, filter_by=None):
+        """InheritDoc.
+
+        """
+
+        scans = []
+
+        for patient_folder_name in sorted(DatasetValidator.list_contents(self.dataset_path, ScanType.NIFTI)):
+            scans.extend(self.get_scans_by_patient_name(patient_folder_name, filter_by))
+
+        return scans
+
+    def get_scans_by_patient_name(self, patient_name, filter_by=None):
+        """InheritDoc.
+
+        """
+
+        patient_path = os.path.join(self.dataset_path, patient_name)
+
+        if not os.path.isdir(patient_path):
+            return []
+
+        scans_paths = [os.path.join(patient_path, scan_file_name)
+                       for scan_file_name in sorted(DatasetValidator.list_contents(patient_path, ScanType.NIFTI))]
+
+        return [NIfTIScan(scan_path) for scan_path in scans_paths if not filter_by or filter_by(scan_path)]
+
+    def get_scans_by_acquisition_date(self, from_date, to_date):
+        """InheritDoc.
+
+        """
+
+        # The NIfTI header does not store the acquisition date.
+        raise MetadataNotAvailableException()
+
+    def get_scans_by_size(self, width, height, depth):
+        """InheritDoc.
+
+        """
+
+        return list(filter(lambda scan: scan.size == (int(width), int(height), int(depth)), self.get_scans()))
+
+    def get_fixed_image(self, patient_name):
+        """InheritDoc.
+
+        """
+
+        fixed_scans = self.get_scans_by_patient_name(
+            patient_name, lambda scan_path: os.path.basename(scan_path).startswith(f"{FIXED_SCAN_TYPE}_"))
 
-        sitk_fixed_scan = SITKHelper.get_fixed_scan(patient_scans)
+        if len(fixed_scans) == 0:
+            logger.debug(f"No fixed scan found for the patient {patient_name}.")
+            return None
 
-        return list(filter(lambda patient_scan: patient_scan.path == sitk_fixed_scan.path, patient_scans))[0]
+        return fixed_scans[0]
 
 
 class DICOMDatasetReaderHelper:
@@ -0,0 +1,433 @@
+"""This module contains the sampling of random 3D patches from the volumes of a dataset, reading only
+the region of every patch from memory mapped NIfTI files or chunked volume stores.
+
+"""
+
+import logging
+import os
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pycomed.exceptions import ScanTypeNotSupportedException
+from pycomed.io.nifti import NIfTIHelper
+from pycomed.io.storage import META_FILE_NAME, ChunkedVolumeStore
+
+# Number of slices read at once when searching the foreground of a volume.
+FOREGROUND_SLICES_PER_CHUNK = 16
+# Maximum number of volumes kept open by a sampler (and by each of its worker processes).
+MAX_OPEN_VOLUMES = 32
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed sampling.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+# Sampler of the worker process, it is sent once when the worker is started.
+_worker_sampler = None
+
+
+def _initialize_worker(sampler):
+    global _worker_sampler
+    _worker_sampler = sampler
+
+
+def _sample_batch(indexes):
+    """Samples the patches of a batch, it is defined at the top level so that it can be run by the worker processes.
+
+    """
+
+    return _worker_sampler.sample_batch(indexes)
+
+
+class PatchSampler:
+    """Draws random 3D patches from many volumes, uniformly or around the voxels of a label
+    (e.g. a ROI) or of the foreground. Every patch is drawn with a random state seeded by the
+    seed of the sampler and the index of the patch, so the output does not depend on the order
+    in which the patches are computed nor on the number of worker processes.
+
+    """
+
+    def __init__(self, samples, patch_size, labels=None, foreground_probability=0., foreground_threshold=None,
+                 seed=0, fill_value=0.):
+        """
+
+        Initialization method of the object.
+        Args:
+            samples: list of samples, each sample is a volume or a list of volumes with the same size
+                     (the channels, e.g. the registered sequences of a patient). A volume is the path
+                     of a NIfTI file or of a chunked store, a NIfTIScan, a ChunkedVolumeStore or an array.
+            patch_size: (z, y, x) size of the patches.
+            labels: optional list with a label volume (or None) for each sample, the patches are
+                    read also from the labels.
+            foreground_probability: probability of drawing a patch centered on a voxel of the
+                                    foreground instead of a uniform one.
+            foreground_threshold: the foreground of the samples without a label are the voxels of
+                                  the first channel above the threshold, if None they are sampled uniformly.
+            seed: seed of the sampler.
+            fill_value: value of the voxels of the patches outside of the volumes.
+
+        """
+
+        self.samples = [list(sample) if isinstance(sample, (list, tuple)) else [sample] for sample in samples]
+        self.patch_size = tuple(int(size) for size in patch_size)
+        self.labels = list(labels) if labels is not None else [None] * len(self.samples)
+        self.foreground_probability = foreground_probability
+        self.foreground_threshold = foreground_threshold
+        self.seed = seed
+        self.fill_value = fill_value
+
+        self._volumes = OrderedDict()
+        self._foregrounds = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def get_volume(self, sample_index, channel=0):
+        """Opens a volume of a sample, at most MAX_OPEN_VOLUMES volumes are kept open by the
+        sampler and the least recently used one is closed when another one is opened.
+
+        Args:
+            sample_index: index of the sample.
+            channel: index of the channel, None for the label.
+
+        Returns: an array (memory mapped if possible) or a ChunkedVolumeStore.
+
+        """
+
+        key = (sample_index, channel)
+        if key in self._volumes:
+            self._volumes.move_to_end(key)
+            return self._volumes[key]
+
+        source = self.samples[sample_index][channel] if channel is not None else self.labels[sample_index]
+        self._volumes[key] = PatchSamplerHelper.open_volume(source)
+
+        if len(self._volumes) > MAX_OPEN_VOLUMES:
+            (evicted_sample_index, evicted_channel), evicted_volume = self._volumes.popitem(last=False)
+            evicted_source = self.samples[evicted_sample_index][evicted_channel] if evicted_channel is not None \
+                else self.labels[evicted_sample_index]
+            # Only the volumes opened from a path are closed, the ones supplied by the caller are left open.
+            if isinstance(evicted_source, str):
+                PatchSamplerHelper.close_volume(evicted_volume)
+
+        return self._volumes[key]
+
+    def get_foreground_volume(self, sample_index):
+        """Gets the volume that defines the foreground of a sample, its label or its first channel.
+
+        Args:
+            sample_index: index of the sample.
+
+        Returns: a tuple with the opened volume and the threshold of its foreground voxels, (None, None)
+                 if the sample has no foreground to sample.
+
+        """
+
+        if self.labels[sample_index] is not None:
+            return self.get_volume(sample_index, None), 0
+
+        if self.foreground_threshold is not None:
+            return self.get_volume(sample_index), self.foreground_threshold
+
+        return None, None
+
+    def get_foreground(self, sample_index):
+        """Gets the cumulative number of foreground voxels of the slices of a sample, so that only
+        one integer per slice is kept (and sent to the worker processes) instead of the indexes of
+        all the voxels. They are computed once, reading the volume in slabs.
+
+        Args:
+            sample_index: index of the sample.
+
+        Returns: the array of the cumulative counts, None if the sample has no foreground to sample.
+
+        """
+
+        if sample_index not in self._foregrounds:
+            volume, threshold = self.get_foreground_volume(sample_index)
+
+            foreground = None
+            if volume is not None:
+                foreground = PatchSamplerHelper.count_foreground(volume, threshold)
+                if foreground[-1] == 0:
+                    logger.debug(f"The sample {sample_index} has no foreground, its patches are sampled uniformly.")
+                    foreground = None
+
+            self._foregrounds[sample_index] = foreground
+
+        return self._foregrounds[sample_index]
+
+    def prepare(self):
+        """Computes the foreground of all the samples, so that it is not computed again by every worker process.
+
+        """
+
+        if self.foreground_probability > 0:
+            for sample_index in range(len(self.samples)):
+                self.get_foreground(sample_index)
+
+    def get_patch_position(self, index):
+        """Draws the sample and the position of a patch.
+
+        Args:
+            index: index of the patch, together with the seed it determines the patch.
+
+        Returns: a tuple with the index of the sample and the (z, y, x) index of the first voxel of the patch.
+
+        """
+
+        random_state = np.random.RandomState([self.seed, index])
+
+        sample_index = random_state.randint(len(self.samples))
+        shape = np.array(PatchSamplerHelper.get_shape(self.get_volume(sample_index)))
+        patch_size = np.array(self.patch_size)
+        # The patches of volumes smaller than the patch size are centered and padded.
+        max_start = shape - patch_size
+
+        if random_state.random_sample() < self.foreground_probability and \
+                self.get_foreground(sample_index) is not None:
+            foreground = self.get_foreground(sample_index)
+            # The voxel is drawn among all the foreground voxels, only its slice is read to find it.
+            volume, threshold = self.get_foreground_volume(sample_index)
+            center = PatchSamplerHelper.find_foreground_voxel(volume, threshold, foreground,
+                                                              random_state.randint(foreground[-1]))
+            start = np.clip(center - patch_size // 2, np.minimum(max_start, 0), np.maximum(max_start, 0))
+        else:
+            start = np.array([random_state.randint(size + 1) if size >= 0 else size // 2 for size in max_start])
+
+        return sample_index, start
+
+    def sample(self, index):
+        """Reads a patch, only its region is read from the volumes.
+
+        Args:
+            index: index of the patch, together with the seed it determines the patch.
+
+        Returns: a dictionary with the index of the sample, the start of the patch, the
+                 (channels, z, y, x) float32 array of the image and the (z, y, x) array of the label (or None).
+
+        """
+
+        sample_index, start = self.get_patch_position(index)
+
+        image = np.empty((len(self.samples[sample_index]),) + self.patch_size, dtype=np.float32)
+        for channel in range(len(self.samples[sample_index])):
+            image[channel] = PatchSamplerHelper.read_patch(self.get_volume(sample_index, channel), start,
+                                                           self.patch_size, self.fill_value)
+
+        label = None
+        if self.labels[sample_index] is not None:
+            label = PatchSamplerHelper.read_patch(self.get_volume(sample_index, None), start, self.patch_size, 0)
+
+        return {"sample": sample_index, "start": tuple(start.tolist()), "image": image, "label": label}
+
+    def sample_batch(self, indexes):
+        """Reads the patches of a batch and stacks them.
+
+        Args:
+            indexes: indexes of the patches of the batch.
+
+        Returns: a dictionary with the indexes of the samples, the starts of the patches, the
+                 (batch, channels, z, y, x) array of the images and the (batch, z, y, x) array
+                 of the labels (None if a sample has no label).
+
+        """
+
+        patches = [self.sample(index) for index in indexes]
+
+        labels = [patch["label"] for patch in patches]
+
+        return {
+            "samples": [patch["sample"] for patch in patches],
+            "starts": [patch["start"] for patch in patches],
+            "images": np.stack([patch["image"] for patch in patches]),
+            "labels": np.stack(labels) if all(label is not None for label in labels) else None,
+        }
+
+    def batches(self, number_of_batches, batch_size, first_batch=0, workers=0, prefetch=2):
+        """Generator of batches of patches, computed in background by a pool of worker processes
+        while the caller consumes the previous ones. The batch k contains the patches with the
+        indexes from k * batch_size, so the batches are the same with any number of workers.
+
+        Args:
+            number_of_batches: number of batches generated.
+            batch_size: number of patches in a batch.
+            first_batch: index of the first batch, e.g. to continue an interrupted training.
+            workers: number of worker processes, if 0 the batches are computed in the caller process.
+            prefetch: number of batches computed in advance by each worker.
+
+        Returns: a generator of the batches returned by sample_batch.
+
+        """
+
+        tasks = (range(batch * batch_size, (batch + 1) * batch_size)
+                 for batch in range(first_batch, first_batch + number_of_batches))
+
+        if workers == 0:
+            for indexes in tasks:
+                yield self.sample_batch(indexes)
+            return
+
+        self.prepare()
+
+        # At most prefetch batches per worker are pending, so that the memory used is bounded.
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(self,)) as executor:
+            pending = deque()
+            try:
+                for indexes in tasks:
+                    pending.append(executor.submit(_sample_batch, indexes))
+                    if len(pending) >= workers * prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def __getstate__(self):
+        # The opened volumes are not sent to other processes, they are opened again by them.
+        state = self.__dict__.copy()
+        state["_volumes"] = OrderedDict()
+
+        return state
+
+
+class PatchSamplerHelper:
+    """Helper class containing methods to open the volumes and to read their regions.
+
+    """
+
+    @staticmethod
+    def open_volume(source):
+        """Opens a volume for reading regions.
+
+        Args:
+            source: path of a NIfTI file or of a chunked store, NIfTIScan, ChunkedVolumeStore or array.
+
+        Returns: an array (memory mapped for the uncompressed NIfTI files) or a ChunkedVolumeStore.
+
+        """
+
+        if isinstance(source, (ChunkedVolumeStore, np.ndarray)):
+            return source
+
+        if isinstance(source, str):
+            if os.path.exists(os.path.join(source, META_FILE_NAME)):
+                return ChunkedVolumeStore(source)
+
+            if not NIfTIHelper.is_nifti_path(source):
+                raise ScanTypeNotSupportedException()
+
+            # The compressed files are decoded completely, only once for every process.
+            if source.endswith(".gz"):
+                logger.debug(f"{source} is compressed and it cannot be memory mapped.")
+
+            return NIfTIHelper.load_array(source)
+
+        # A NIfTIScan.
+        return source.get_array()
+
+    @staticmethod
+    def close_volume(volume):
+        """Closes a volume opened by open_volume. The memory mapped arrays are released when
+        they are no longer referenced, since the patches read from them can be views.
+
+        """
+
+        if isinstance(volume, ChunkedVolumeStore):
+            volume.close()
+
+    @staticmethod
+    def get_shape(volume):
+        """Gets the (z, y, x) shape of an opened volume.
+
+        """
+
+        return tuple(volume.shape)
+
+    @staticmethod
+    def read_region(volume, start, stop):
+        """Reads a region of an opened volume, the region must be inside of the volume.
+
+        """
+
+        if isinstance(volume, ChunkedVolumeStore):
+            return volume.read(start, stop)
+
+        return np.asarray(volume[tuple(slice(a, b) for a, b in zip(start, stop))])
+
+    @staticmethod
+    def read_patch(volume, start, patch_size, fill_value):
+        """Reads a patch of an opened volume, the voxels outside of the volume are filled.
+
+        Args:
+            volume: array or ChunkedVolumeStore.
+            start: (z, y, x) index of the first voxel of the patch, it can be outside of the volume.
+            patch_size: (z, y, x) size of the patch.
+            fill_value: value of the voxels outside of the volume.
+
+        Returns: the array of the patch, with the data type of the volume.
+
+        """
+
+        start = np.asarray(start)
+        stop = start + patch_size
+        inner_start = np.maximum(start, 0)
+        inner_stop = np.minimum(stop, PatchSamplerHelper.get_shape(volume))
+
+        region = PatchSamplerHelper.read_region(volume, inner_start, inner_stop)
+        if region.shape == tuple(patch_size):
+            return region
+
+        patch = np.full(patch_size, fill_value, dtype=region.dtype)
+        patch[tuple(slice(a, b) for a, b in zip(inner_start - start, inner_stop - start))] = region
+
+        return patch
+
+    @staticmethod
+    def count_foreground(volume, threshold):
+        """Counts the voxels of a volume above a threshold, reading the volume in slabs.
+
+        Args:
+            volume: array or ChunkedVolumeStore.
+            threshold: the foreground voxels are strictly greater than it.
+
+        Returns: the cumulative number of foreground voxels of the slices, the last one is the total.
+
+        """
+
+        shape = PatchSamplerHelper.get_shape(volume)
+        slices_per_chunk = volume.chunk_shape[0] if isinstance(volume, ChunkedVolumeStore) \
+            else FOREGROUND_SLICES_PER_CHUNK
+
+        counts = []
+        for z in range(0, shape[0], slices_per_chunk):
+            slab = PatchSamplerHelper.read_region(volume, (z, 0, 0), (min(z + slices_per_chunk, shape[0]),) + shape[1:])
+            counts.append(np.count_nonzero(slab > threshold, axis=(1, 2)))
+
+        return np.cumsum(np.concatenate(counts))
+
+    @staticmethod
+    def find_foreground_voxel(volume, threshold, foreground, voxel):
+        """Finds a foreground voxel of a volume, reading only its slice.
+
+        Args:
+            volume: array or ChunkedVolumeStore.
+            threshold: the foreground voxels are strictly greater than it.
+            foreground: cumulative number of foreground voxels of the slices, see count_foreground.
+            voxel: index of the voxel among the foreground ones, in the order of the flat indexes.
+
+        Returns: the (z, y, x) index of the voxel.
+
+        """
+
+        shape = PatchSamplerHelper.get_shape(volume)
+        z = int(np.searchsorted(foreground, voxel, side="right"))
+        previous = int(foreground[z - 1]) if z > 0 else 0
+
+        volume_slice = PatchSamplerHelper.read_region(volume, (z, 0, 0), (z + 1,) + shape[1:])[0]
+        y, x = np.unravel_index(np.flatnonzero(volume_slice > threshold)[voxel - previous], shape[1:])
+
+        return np.array([z, y, x])
@@ -0,0 +1,264 @@
+"""This module contains a chunked storage of volumes, made for reading small regions (e.g. the patches
+used for training) without decoding the whole volume. A store is a folder with:
+/store:
+    meta.json: (shape, data type, chunk shape, codec, geometry and the offset of every chunk)
+    chunks.bin: (the chunks, each compressed independently, one after the other)
+
+"""
+
+import bz2
+import json
+import logging
+import lzma
+import os
+import sys
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import SimpleITK as sitk
+import numpy as np
+
+META_FILE_NAME = "meta.json"
+CHUNKS_FILE_NAME = "chunks.bin"
+DEFAULT_CHUNK_SHAPE = (32, 32, 32)
+DEFAULT_CODEC = "zlib"
+DEFAULT_CHUNK_COMPRESSION_LEVEL = 1
+# Number of decompressed chunks kept in memory by every store.
+DEFAULT_CACHE_SIZE = 64
+
+# Codecs of the standard library, as functions compressing with a level and decompressing.
+CODECS = {
+    "none": (lambda data, level: data, lambda data: data),
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "bz2": (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed storage.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class ChunkedVolumeStore:
+    """Volume split in fixed size 3D chunks compressed independently, so that reading a region
+    decompresses only the chunks it touches. The indexes of the store follow the (z, y, x)
+    layout of the arrays, the same of sitk.GetArrayFromImage.
+
+    """
+
+    def __init__(self, store_path, cache_size=DEFAULT_CACHE_SIZE):
+        """
+
+        Initialization method of the object, it opens an existing store.
+        Args:
+            store_path: folder of the store.
+            cache_size: number of decompressed chunks kept in memory.
+
+        """
+
+        self.store_path = store_path
+        self.cache_size = cache_size
+
+        with open(os.path.join(store_path, META_FILE_NAME)) as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.shape = tuple(self.meta["shape"])
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.chunk_shape = tuple(self.meta["chunk_shape"])
+        self.grid_shape = tuple(-(-size // chunk_size) for size, chunk_size in zip(self.shape, self.chunk_shape))
+
+        self._decompress = CODECS[self.meta["codec"]][1]
+        self._chunks_file = None
+        self._cache = OrderedDict()
+
+    @property
+    def geometry(self):
+        return {key: tuple(self.meta[key]) for key in ("origin", "spacing", "direction")}
+
+    @classmethod
+    def write(cls, store_path, volume, chunk_shape=DEFAULT_CHUNK_SHAPE, codec=DEFAULT_CODEC,
+              compression_level=DEFAULT_CHUNK_COMPRESSION_LEVEL, geometry=None, threads=None):
+        """Writes a volume as a chunked store, the chunks are compressed in parallel.
+
+        Args:
+            store_path: folder of the store, it is created if it does not exist.
+            volume: SimpleITK scan or (z, y, x) NumPy array (also memory mapped).
+            chunk_shape: (z, y, x) shape of the chunks.
+            codec: name of the codec, one of CODECS.
+            compression_level: compression level of the codec.
+            geometry: dictionary with origin, spacing and direction of a NumPy volume, the one
+                      of the scan is used for a SimpleITK volume.
+            threads: number of compression threads, all the cores if not specified.
+
+        Returns: the store opened for reading.
+
+        """
+
+        if isinstance(volume, sitk.Image):
+            geometry = {"origin": volume.GetOrigin(), "spacing": volume.GetSpacing(),
+                        "direction": volume.GetDirection()}
+            volume = sitk.GetArrayViewFromImage(volume)
+        elif geometry is None:
+            geometry = {"origin": (0.,) * volume.ndim, "spacing": (1.,) * volume.ndim,
+                        "direction": tuple(np.eye(volume.ndim).flatten().tolist())}
+
+        compress = CODECS[codec][0]
+        chunk_shape = tuple(int(chunk_size) for chunk_size in chunk_shape)
+        grid_shape = tuple(-(-size // chunk_size) for size, chunk_size in zip(volume.shape, chunk_shape))
+
+        def compress_chunk(chunk_index):
+            region = tuple(slice(i * chunk_size, (i + 1) * chunk_size) for i, chunk_size in zip(chunk_index, chunk_shape))
+            return compress(np.ascontiguousarray(volume[region]).tobytes(), compression_level)
+
+        os.makedirs(store_path, exist_ok=True)
+
+        offsets = []
+        sizes = []
+        offset = 0
+        with open(os.path.join(store_path, CHUNKS_FILE_NAME), "wb") as chunks_file, \
+                ThreadPoolExecutor(max_workers=threads if threads is not None else os.cpu_count()) as executor:
+            for compressed_chunk in executor.map(compress_chunk, np.ndindex(*grid_shape)):
+                chunks_file.write(compressed_chunk)
+                offsets.append(offset)
+                sizes.append(len(compressed_chunk))
+                offset += len(compressed_chunk)
+
+        meta = {
+            "shape": list(volume.shape),
+            "dtype": volume.dtype.str,
+            "chunk_shape": list(chunk_shape),
+            "codec": codec,
+            "compression_level": compression_level,
+            "origin": list(geometry["origin"]),
+            "spacing": list(geometry["spacing"]),
+            "direction": list(geometry["direction"]),
+            "offsets": offsets,
+            "sizes": sizes,
+        }
+
+        # The meta data are written last and atomically, so that a partially written store is never opened.
+        meta_path = os.path.join(store_path, META_FILE_NAME)
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+        return cls(store_path)
+
+    def read_chunk(self, chunk_index):
+        """Reads and decompresses a chunk, the last chunks of every axis can be smaller.
+
+        Args:
+            chunk_index: (z, y, x) index of the chunk in the grid of the chunks.
+
+        Returns: the array of the chunk.
+
+        """
+
+        chunk_index = tuple(int(i) for i in chunk_index)
+
+        if chunk_index in self._cache:
+            self._cache.move_to_end(chunk_index)
+            return self._cache[chunk_index]
+
+        # The file is opened in the process that reads, so that the store can be sent to worker processes.
+        if self._chunks_file is None:
+            self._chunks_file = open(os.path.join(self.store_path, CHUNKS_FILE_NAME), "rb")
+
+        position = int(np.ravel_multi_index(chunk_index, self.grid_shape))
+        self._chunks_file.seek(self.meta["offsets"][position])
+        data = self._decompress(self._chunks_file.read(self.meta["sizes"][position]))
+
+        shape = tuple(min(chunk_size, size - i * chunk_size)
+                      for i, chunk_size, size in zip(chunk_index, self.chunk_shape, self.shape))
+        chunk = np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+        self._cache[chunk_index] = chunk
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return chunk
+
+    def read(self, start=None, stop=None):
+        """Reads a region of the volume, decompressing only the chunks it touches.
+
+        Args:
+            start: (z, y, x) index of the first voxel of the region, the origin if not specified.
+            stop: (z, y, x) index after the last voxel of the region, the end of the volume if not specified.
+
+        Returns: the array of the region.
+
+        """
+
+        start = np.zeros(len(self.shape), dtype=int) if start is None else np.maximum(np.asarray(start, dtype=int), 0)
+        stop = np.array(self.shape) if stop is None else np.minimum(np.asarray(stop, dtype=int), self.shape)
+
+        region = np.empty(tuple(np.maximum(stop - start, 0)), dtype=self.dtype)
+        if region.size == 0:
+            return region
+
+        first_chunk = start // self.chunk_shape
+        last_chunk = (stop - 1) // self.chunk_shape
+
+        for chunk_index in np.ndindex(*(last_chunk - first_chunk + 1)):
+            chunk_index = first_chunk + np.array(chunk_index)
+            chunk_start = chunk_index * self.chunk_shape
+
+            # Intersection of the chunk with the region, in the coordinates of the volume.
+            intersection_start = np.maximum(start, chunk_start)
+            intersection_stop = np.minimum(stop, chunk_start + self.chunk_shape)
+
+            region[tuple(slice(a, b) for a, b in zip(intersection_start - start, intersection_stop - start))] = \
+                self.read_chunk(chunk_index)[tuple(slice(a, b) for a, b in zip(intersection_start - chunk_start,
+                                                                                 intersection_stop - chunk_start))]
+
+        return region
+
+    def read_scan(self, start=None, stop=None):
+        """Reads a region of the volume as a SimpleITK scan placed in the physical space of the volume.
+
+        Args:
+            start: (z, y, x) index of the first voxel of the region, the origin if not specified.
+            stop: (z, y, x) index after the last voxel of the region, the end of the volume if not specified.
+
+        Returns: the SimpleITK scan of the region.
+
+        """
+
+        geometry = self.geometry
+        start = [0] * len(self.shape) if start is None else [max(int(i), 0) for i in start]
+
+        scan = sitk.GetImageFromArray(self.read(start, stop))
+        scan.SetSpacing(geometry["spacing"])
+        scan.SetDirection(geometry["direction"])
+
+        # The origin of the region is the physical point of its first voxel.
+        direction = np.array(geometry["direction"]).reshape(len(self.shape), len(self.shape))
+        scan.SetOrigin(tuple((np.array(geometry["origin"]) +
+                              direction @ (np.array(geometry["spacing"]) * start[::-1])).tolist()))
+
+        return scan
+
+    def close(self):
+        """Closes the file of the chunks and empties the cache.
+
+        """
+
+        if self._chunks_file is not None:
+            self._chunks_file.close()
+            self._chunks_file = None
+
+        self._cache.clear()
+
+    def __getstate__(self):
+        # The open file and the cache are not sent to other processes.
+        state = self.__dict__.copy()
+        state["_chunks_file"] = None
+        state["_cache"] = OrderedDict()
+        state["_decompress"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._decompress = CODECS[self.meta["codec"]][1]
@@ -1 +1,3 @@
+from .cache import *
 from .registration import *
+from .scheduling import *
@@ -0,0 +1,223 @@
+"""This module contains the persistent cache of the registration results, so that re-running
+a pipeline registers only the pairs of series that changed since the previous run.
+
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import SimpleITK as sitk
+
+from pycomed.entities import RegistrationResult
+
+# Extensions of the files of a cache entry.
+TRANSFORM_EXTENSION = ".tfm"
+ENTRY_EXTENSION = ".json"
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed cache.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class FingerprintHelper:
+    """Helper class containing methods to compute fingerprints of scans and parameters.
+
+    """
+
+    @staticmethod
+    def fingerprint_path(path):
+        """Computes the fingerprint of a file or of a folder (e.g. the folder of a DICOM series)
+        from the names, sizes and modification times of its files, without reading them.
+
+        Args:
+            path: path of the file or of the folder.
+
+        Returns: the fingerprint as an hexadecimal string.
+
+        """
+
+        fingerprint = hashlib.sha1()
+
+        if os.path.isdir(path):
+            file_paths = sorted(entry.path for entry in os.scandir(path) if entry.is_file())
+        else:
+            file_paths = [path]
+
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            fingerprint.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+
+        return fingerprint.hexdigest()
+
+    @staticmethod
+    def fingerprint_image(image):
+        """Computes the fingerprint of the content of a SimpleITK image, e.g. a mask.
+
+        Args:
+            image: image read by SimpleITK.
+
+        Returns: the fingerprint as an hexadecimal string.
+
+        """
+
+        return sitk.Hash(image)
+
+    @staticmethod
+    def fingerprint_parameters(parameters):
+        """Computes the fingerprint of a dictionary of parameters.
+
+        Args:
+            parameters: dictionary that can be serialized as JSON.
+
+        Returns: the fingerprint as an hexadecimal string.
+
+        """
+
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RegistrationCache:
+    """Persistent cache of the registration results (transform and quality metric). Every entry is
+    keyed by the fingerprints of the moving and fixed series and by the fingerprint of the
+    registration parameters, and is saved as a .tfm file plus a .json file, so that processes
+    running in parallel can share the same cache folder.
+
+    """
+
+    def __init__(self, cache_path):
+        """
+
+        Initialization method of the object.
+        Args:
+            cache_path: folder in which the cache entries are saved.
+
+        """
+
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_key(self, moving_fingerprint, fixed_fingerprint, parameters):
+        """Computes the key of a cache entry.
+
+        Args:
+            moving_fingerprint: fingerprint of the moving series.
+            fixed_fingerprint: fingerprint of the fixed series.
+            parameters: dictionary with the registration parameters.
+
+        Returns: the key of the entry.
+
+        """
+
+        return FingerprintHelper.fingerprint_parameters({
+            "moving": moving_fingerprint,
+            "fixed": fixed_fingerprint,
+            "parameters": FingerprintHelper.fingerprint_parameters(parameters),
+        })
+
+    def get(self, moving_fingerprint, fixed_fingerprint, parameters):
+        """Gets the registration result of a pair of series, if it has been already computed.
+
+        Args:
+            moving_fingerprint: fingerprint of the moving series.
+            fixed_fingerprint: fingerprint of the fixed series.
+            parameters: dictionary with the registration parameters.
+
+        Returns: the cached registration result, None if it is not in the cache.
+
+        """
+
+        key = self.get_key(moving_fingerprint, fixed_fingerprint, parameters)
+        entry_path = os.path.join(self.cache_path, key + ENTRY_EXTENSION)
+        transform_path = os.path.join(self.cache_path, key + TRANSFORM_EXTENSION)
+
+        if not os.path.exists(entry_path) or not os.path.exists(transform_path):
+            self.misses += 1
+            return None
+
+        with open(entry_path) as entry_file:
+            entry = json.load(entry_file)
+
+        self.hits += 1
+
+        return RegistrationResult(sitk.ReadTransform(transform_path), entry["metric_value"], reason=entry["reason"])
+
+    def put(self, moving_fingerprint, fixed_fingerprint, parameters, registration_result):
+        """Saves the registration result of a pair of series in the cache.
+
+        Args:
+            moving_fingerprint: fingerprint of the moving series.
+            fixed_fingerprint: fingerprint of the fixed series.
+            parameters: dictionary with the registration parameters.
+            registration_result: result of the registration.
+
+        """
+
+        key = self.get_key(moving_fingerprint, fixed_fingerprint, parameters)
+
+        sitk.WriteTransform(registration_result.transform, os.path.join(self.cache_path, key + TRANSFORM_EXTENSION))
+
+        # The entry is written last and atomically, so that a partially written entry is never read.
+        entry_path = os.path.join(self.cache_path, key + ENTRY_EXTENSION)
+        with open(entry_path + ".tmp", "w") as entry_file:
+            json.dump({
+                "moving": moving_fingerprint,
+                "fixed": fixed_fingerprint,
+                "parameters": parameters,
+                "metric_value": registration_result.metric_value,
+                "reason": registration_result.reason,
+            }, entry_file, default=str)
+        os.replace(entry_path + ".tmp", entry_path)
+
+    def invalidate(self, fingerprint=None):
+        """Removes entries from the cache.
+
+        Args:
+            fingerprint: fingerprint of a series, all the entries in which it is used as moving
+                         or fixed series are removed. If not specified the whole cache is cleared.
+
+        Returns: the number of removed entries.
+
+        """
+
+        removed_entries = 0
+
+        for entry_path in glob.glob(os.path.join(self.cache_path, "*" + ENTRY_EXTENSION)):
+            if fingerprint is not None:
+                with open(entry_path) as entry_file:
+                    entry = json.load(entry_file)
+
+                if fingerprint not in (entry["moving"], entry["fixed"]):
+                    continue
+
+            transform_path = entry_path[:-len(ENTRY_EXTENSION)] + TRANSFORM_EXTENSION
+            os.remove(entry_path)
+            if os.path.exists(transform_path):
+                os.remove(transform_path)
+
+            removed_entries += 1
+
+        logger.debug(f"Removed {removed_entries} entries from the registration cache.")
+
+        return removed_entries
+
+    def get_stats(self):
+        """Gets the hit and miss statistics of this cache object.
+
+        Returns: a dictionary with the number of hits and misses and the hit rate.
+
+        """
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else None,
+        }
@@ -1,14 +1,96 @@
+import json
+import logging
 import os
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import SimpleITK as sitk
 
-from pycomed.entities import SITKScan
+from pycomed.entities import RegistrationResult, SITKScan
+from pycomed.exceptions import PyramidNotCompatibleException, RegistrationPresetNotFoundException
 
 # When the scan direction is bigger than this threshold
 # we assume that is in axial orientation.
 AXIAL_ORIENTATION_THRESHOLD = 0.9
 NO_INDEX = -1
 
+# Multi-resolution levels used by the registration.
+DEFAULT_SHRINK_FACTORS = [4, 2, 1]
+DEFAULT_SMOOTHING_SIGMAS = [2, 1, 0]
+# Seed of the random metric sampling, keeping it fixed makes registrations on the
+# same fixed scan sample the same points.
+DEFAULT_SAMPLING_SEED = 42
+
+# Optimizers supported by the registration configuration.
+GRADIENT_DESCENT_OPTIMIZER = "gradient_descent"
+CONJUGATE_GRADIENT_OPTIMIZER = "conjugate_gradient_line_search"
+# The step of the regular step gradient descent is relaxed every time the gradient changes direction,
+# so it does not oscillate around the optimum and it cannot jump out of the overlap of the scans.
+REGULAR_STEP_GRADIENT_DESCENT_OPTIMIZER = "regular_step_gradient_descent"
+RELAXATION_FACTOR = 0.5
+
+# Named registration presets, every preset overrides the default configuration parameters.
+# The fast preset is meant for QA previews, it skips the full resolution level and uses
+# a cheaper interpolator, the accurate one is meant for the final outputs and converges
+# with the regular step gradient descent instead of oscillating around the optimum.
+REGISTRATION_PRESETS = {
+    "fast": {
+        "shrink_factors": [4, 2],
+        "smoothing_sigmas": [2, 1],
+        "iterations": [100, 50],
+        "convergence_minimum_value": 1e-5,
+        "convergence_window_size": 5,
+        "histogram_bins": 32,
+        "interpolator": sitk.sitkLinear,
+    },
+    "default": {},
+    "accurate": {
+        "iterations": [200, 200, 200],
+        "optimizer": REGULAR_STEP_GRADIENT_DESCENT_OPTIMIZER,
+        "minimum_step": 1e-4,
+        "sampling_percentage": 0.05,
+        "histogram_bins": 64,
+    },
+}
+
+# Reasons recorded in the registration result.
+OPTIMIZED_REASON = "optimized"
+SHARED_FRAME_OF_REFERENCE_REASON = "shared frame of reference, geometry resample only"
+# DICOM attributes describing the scanner geometry, the ones present in the fixed series need
+# to match in the moving series, together with the FrameOfReferenceUID, to skip the registration.
+SCANNER_GEOMETRY_ATTRIBUTES = ["Manufacturer", "ManufacturerModelName", "DeviceSerialNumber", "StationName",
+                               "PatientPosition"]
+
+# Anatomical direction, in the LPS+ frame of SimpleITK, towards which an axis points for every
+# letter of an orientation code, e.g. "LPS" is the identity direction and "RAS" flips x and y.
+ORIENTATION_AXES = {
+    "L": (1., 0., 0.), "R": (-1., 0., 0.),
+    "P": (0., 1., 0.), "A": (0., -1., 0.),
+    "S": (0., 0., 1.), "I": (0., 0., -1.),
+}
+# Maximum difference between a direction cosine and 0 or 1 for the axes to be considered aligned.
+AXIS_ALIGNMENT_TOLERANCE = 1e-4
+
+# Size of the chunks of a NIfTI file compressed in parallel, every chunk is a gzip member.
+GZIP_CHUNK_SIZE = 4 * 1024 * 1024
+# The gzip header is written by zlib when the window bits are 16 plus the window size.
+GZIP_WINDOW_BITS = 16 + zlib.MAX_WBITS
+# Minimum size in bytes of the voxels of a scan compressed in parallel, the smaller scans are compressed
+# by SimpleITK with a single thread, e.g. the parallel compression is not faster for 100x256x256 int16.
+PARALLEL_COMPRESSION_MINIMUM_SIZE = 64 * 1024 * 1024
+
+# Executor of the compressions running in background, it is created when first needed.
+_background_executor = None
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed registration.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
 
 class SITKHelper:
     """Class containing helper methods to use the SimpleITK library.
@@ -50,16 +132,145 @@ class SITKHelper:
             return None
 
     @staticmethod
-    def write_scan_as_nifti(scan, path):
+    def write_scan_as_nifti(scan, path, compression_level=None, threads=None, background=False):
         """Writes a scan on the disk in a specific path.
 
+        A .nii.gz file can be compressed in parallel: the scan is written uncompressed and its chunks
+        are compressed by many threads as members of a multi-member gzip file, that is a standard
+        gzip file readable by SimpleITK, nibabel and gzip. The scans with less voxel data than
+        PARALLEL_COMPRESSION_MINIMUM_SIZE are compressed with a single thread, since for them the
+        parallel compression does not pay off. In background mode the compression runs after the
+        function returns, so the scan can be released as soon as it is written.
+
         Args:
             scan: scan object read by SimpleITK.
-            path: path where the scan will be written.
+            path: path where the scan will be written, a .nii.gz path is compressed.
+            compression_level: zlib compression level (0-9) of a compressed file, the
+                               default one of the library if not specified.
+            threads: number of threads compressing a big .nii.gz file, if not specified the file
+                     is compressed by SimpleITK with a single thread.
+            background: if true a .nii.gz file is compressed in background.
+
+        Returns: a Future completed when the file is written if background is true, None otherwise.
+
+        """
+
+        compressed = path.endswith(".gz")
+
+        voxels_size = scan.GetNumberOfPixels() * scan.GetNumberOfComponentsPerPixel() * scan.GetSizeOfPixelComponent()
+        if voxels_size < PARALLEL_COMPRESSION_MINIMUM_SIZE:
+            threads = 1
+
+        if not compressed or (threads in (None, 1) and not background):
+            if compression_level is None:
+                sitk.WriteImage(scan, path)
+            else:
+                sitk.WriteImage(scan, path, True, int(compression_level))
+
+            return None
+
+        # The image IO is chosen from the extension, so the temporary file ends with .nii. It is hidden
+        # and has a unique name, so that the files written at the same time in a folder do not collide.
+        file_descriptor, uncompressed_path = tempfile.mkstemp(suffix=".nii", prefix=".",
+                                                              dir=os.path.dirname(os.path.abspath(path)))
+        os.close(file_descriptor)
+        sitk.WriteImage(scan, uncompressed_path, False)
+
+        if not background:
+            SITKHelper.compress_file(uncompressed_path, path, compression_level, threads)
+            return None
+
+        global _background_executor
+        if _background_executor is None:
+            _background_executor = ThreadPoolExecutor(max_workers=1)
+
+        return _background_executor.submit(SITKHelper.compress_file, uncompressed_path, path, compression_level,
+                                           threads)
+
+    @staticmethod
+    def compress_file(input_path, output_path, compression_level=None, threads=None):
+        """Compresses a file as a multi-member gzip file, the chunks of the file are compressed
+        in parallel (zlib releases the GIL) and written in order. The input file is removed.
+
+        Args:
+            input_path: path of the file to compress.
+            output_path: path of the compressed file, it is replaced atomically.
+            compression_level: zlib compression level (0-9), the default one of the library if not specified.
+            threads: number of compression threads, all the cores if not specified.
+
+        Returns: the path of the compressed file.
 
         """
 
-        sitk.WriteImage(scan, path)
+        level = -1 if compression_level is None else int(compression_level)
+        threads = threads if threads is not None else os.cpu_count()
+
+        def compress_chunk(chunk):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WINDOW_BITS)
+            return compressor.compress(chunk) + compressor.flush()
+
+        def read_chunks(input_file):
+            chunk = input_file.read(GZIP_CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = input_file.read(GZIP_CHUNK_SIZE)
+
+        file_descriptor, compressed_path = tempfile.mkstemp(suffix=".tmp", prefix=".",
+                                                            dir=os.path.dirname(os.path.abspath(output_path)))
+
+        with open(input_path, "rb") as input_file, os.fdopen(file_descriptor, "wb") as output_file, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            # At most two chunks per thread are in memory, the members are written in order.
+            pending = deque()
+            for chunk in read_chunks(input_file):
+                pending.append(executor.submit(compress_chunk, chunk))
+                if len(pending) >= 2 * threads:
+                    output_file.write(pending.popleft().result())
+            while pending:
+                output_file.write(pending.popleft().result())
+
+        os.replace(compressed_path, output_path)
+        os.remove(input_path)
+
+        return output_path
+
+    @staticmethod
+    def smooth(scan, sigma):
+        """Smooths a scan with a discrete gaussian kernel, in the same way the registration
+        method does for every multi-resolution level.
+
+        Args:
+            scan: scan read by SimpleITK.
+            sigma: standard deviation of the gaussian in physical units.
+
+        Returns: the smoothed scan, or the scan itself if sigma is zero.
+
+        """
+
+        if sigma == 0:
+            return scan
+
+        return sitk.DiscreteGaussian(scan, variance=[float(sigma) ** 2] * scan.GetDimension(), maximumKernelWidth=32,
+                                     maximumError=0.01, useImageSpacing=True)
+
+    @staticmethod
+    def shrink_and_smooth(scan, shrink_factor, sigma):
+        """Creates a level of a multi-resolution pyramid. The scan is shrunk by averaging the
+        voxels, so that the shrinking does not alias, and then smoothed.
+
+        Args:
+            scan: scan read by SimpleITK.
+            shrink_factor: shrink factor of the level, the same for every dimension.
+            sigma: standard deviation of the gaussian in physical units.
+
+        Returns: the level of the pyramid.
+
+        """
+
+        if shrink_factor > 1:
+            scan = sitk.BinShrink(scan, [int(shrink_factor)] * scan.GetDimension())
+
+        return SITKHelper.smooth(scan, sigma)
 
     @staticmethod
     def get_fixed_scan(scans):
@@ -127,8 +338,8 @@ class SITKHelper:
 
         for i, scan in enumerate(scans):
             # We are going to choose the scans that are with an axial view and the depth is the highest.
-            if (all(direction > AXIAL_ORIENTATION_THRESHOLD for direction in scan.direction)) \
-                    & scan.depth > current_max_depth_scan_value:
+            if all(direction > AXIAL_ORIENTATION_THRESHOLD for direction in scan.direction) \
+                    and scan.depth > current_max_depth_scan_value:
                 ref_scan_index = i
                 current_max_depth_scan_value = scan.depth
 
@@ -181,6 +392,110 @@ class SITKHelper:
 
         return out
 
+    @staticmethod
+    def get_orientation_direction(orientation):
+        """Gets the direction matrix of an orientation code.
+
+        Args:
+            orientation: three letters orientation code, e.g. LPS or RAS.
+
+        Returns: the 3x3 direction matrix, its columns are the directions of the axes.
+
+        """
+
+        assert len(orientation) == 3 and set(orientation.upper()) <= set(ORIENTATION_AXES), \
+            "The orientation should be a code of three letters among L, R, P, A, S and I"
+
+        direction = np.stack([ORIENTATION_AXES[letter] for letter in orientation.upper()], axis=1)
+        assert abs(np.linalg.det(direction)) == 1, "The orientation should not repeat an anatomical axis"
+
+        return direction
+
+    @staticmethod
+    def is_axis_aligned(scan):
+        """Checks if the direction of a scan is a signed permutation of the anatomical axes,
+        e.g. an axial, sagittal or coronal acquisition, so that it can be reoriented without interpolation.
+
+        Args:
+            scan: scan read by SimpleITK.
+
+        Returns: true if the axes of the scan are aligned with the anatomical axes.
+
+        """
+
+        direction = np.array(scan.GetDirection()).reshape(3, 3)
+        rounded_direction = np.round(direction)
+
+        return bool(np.allclose(direction, rounded_direction, rtol=0., atol=AXIS_ALIGNMENT_TOLERANCE)
+                    and np.all(np.abs(rounded_direction).sum(axis=0) == 1)
+                    and np.all(np.abs(rounded_direction).sum(axis=1) == 1))
+
+    @staticmethod
+    def reorient(scan, orientation="LPS", interpolator=sitk.sitkBSpline, default_value=0.):
+        """Reorients a scan to a canonical orientation. Axis aligned scans are only permuted and
+        flipped, which is fast and lossless, oblique scans are resampled on the grid with the target
+        orientation covering the whole scan, keeping the spacing of the closest axes.
+
+        Args:
+            scan: scan read by SimpleITK.
+            orientation: three letters orientation code, e.g. LPS or RAS.
+            interpolator: interpolator used to resample the oblique scans.
+            default_value: value of the voxels of the resampled grid outside of the scan.
+
+        Returns: the reoriented scan.
+
+        """
+
+        target_direction = SITKHelper.get_orientation_direction(orientation)
+
+        source_direction = np.array(scan.GetDirection()).reshape(3, 3)
+
+        if SITKHelper.is_axis_aligned(scan):
+            # Every axis of the reoriented scan is an axis of the scan, possibly flipped.
+            alignment = target_direction.T @ np.round(source_direction)
+            permutation = np.argmax(np.abs(alignment), axis=1)
+            flips = alignment[np.arange(3), permutation] < 0
+
+            # The first voxel of the reoriented scan is the last one of the flipped axes.
+            first_voxel_index = [0] * 3
+            for axis, flip in zip(permutation, flips):
+                first_voxel_index[axis] = scan.GetSize()[axis] - 1 if flip else 0
+
+            # The permutation and the flips are applied to the (z, y, x) array, without interpolation.
+            array = sitk.GetArrayViewFromImage(scan)
+            array = array.transpose(tuple(2 - permutation[::-1]) + tuple(range(3, array.ndim)))
+            array = np.flip(array, axis=tuple(2 - axis for axis in range(3) if flips[axis]))
+
+            reoriented_scan = sitk.GetImageFromArray(np.ascontiguousarray(array),
+                                                     isVector=scan.GetNumberOfComponentsPerPixel() > 1)
+            reoriented_scan.SetSpacing(np.array(scan.GetSpacing())[permutation].tolist())
+            reoriented_scan.SetOrigin(scan.TransformIndexToPhysicalPoint(first_voxel_index))
+            # The direction cosines within the tolerance are snapped to the exact orientation.
+            reoriented_scan.SetDirection(target_direction.flatten().tolist())
+            for key in scan.GetMetaDataKeys():
+                reoriented_scan.SetMetaData(key, scan.GetMetaData(key))
+
+            return reoriented_scan
+
+        # Every axis of the grid keeps the spacing of the axis of the scan closest to it.
+        closest_axes = np.argmax(np.abs(target_direction.T @ source_direction), axis=1)
+        spacing = np.array(scan.GetSpacing())[closest_axes]
+
+        # The corners of the scan in the coordinates of the target orientation.
+        corners = np.array([scan.TransformContinuousIndexToPhysicalPoint(
+            [float(corner) * (size - 1) for corner, size in zip(vertex, scan.GetSize())])
+            for vertex in np.ndindex(2, 2, 2)])
+        target_corners = corners @ target_direction
+        minimum_corner = target_corners.min(axis=0)
+        size = np.round((target_corners.max(axis=0) - minimum_corner) / spacing).astype(int) + 1
+
+        reference_scan = sitk.Image([int(dimension) for dimension in size], scan.GetPixelID())
+        reference_scan.SetSpacing(spacing.tolist())
+        reference_scan.SetDirection(target_direction.flatten().tolist())
+        reference_scan.SetOrigin((target_direction @ minimum_corner).tolist())
+
+        return sitk.Resample(scan, reference_scan, sitk.Transform(3, sitk.sitkIdentity), interpolator, default_value)
+
 
 class SITKRegistrationHelper(SITKHelper):
     """Class containing helper methods to perform registration with the SimpleITK library.
@@ -189,52 +504,414 @@ class SITKRegistrationHelper(SITKHelper):
     """
 
     @staticmethod
-    def perform_registration(moving_scan, fixed_scan):
+    def perform_registration(moving_scan, fixed_scan, fixed_pyramid=None, moving_metadata=None, fixed_metadata=None,
+                             force_registration=False, config=None, report=None, fixed_mask=None, moving_mask=None):
         """Performs the registration on the two scans.
 
         Args:
             moving_scan: scan that we want to register.
             fixed_scan: scan that we want to align on.
+            fixed_pyramid: optional SITKFixedImagePyramid built from the fixed scan, if not
+                           supplied it will be built for this registration only.
+            moving_metadata: optional DICOM dataset with the header of the moving scan.
+            fixed_metadata: optional DICOM dataset with the header of the fixed scan.
+            force_registration: if true the optimization is performed even if the headers
+                                show that the scans share the same frame of reference.
+            config: registration configuration, the configuration of the pyramid (if supplied)
+                    or the default one is used if not supplied.
+            report: optional RegistrationReport that collects the instrumentation of the registration.
+            fixed_mask: optional mask of the fixed scan, the metric is sampled only inside of it.
+            moving_mask: optional mask of the moving scan, the metric is sampled only inside of it.
 
         Returns: the registered scan.
 
         """
 
-        registration_method = SITKRegistrationHelper.create_registration_method(moving_scan, fixed_scan)
+        registration_result = SITKRegistrationHelper.compute_registration(
+            moving_scan, fixed_scan, fixed_pyramid, moving_metadata=moving_metadata, fixed_metadata=fixed_metadata,
+            force_registration=force_registration, config=config, report=report, fixed_mask=fixed_mask,
+            moving_mask=moving_mask)
 
-        registration_transform = registration_method.Execute(fixed_scan, moving_scan)
+        return SITKRegistrationHelper.apply_transforms(moving_scan, fixed_scan, [registration_result.transform])
 
-        return sitk.Resample(moving_scan, fixed_scan, registration_transform)
+    @staticmethod
+    def compute_registration(moving_scan, fixed_scan, fixed_pyramid=None, moving_metadata=None, fixed_metadata=None,
+                             force_registration=False, config=None, report=None, fixed_mask=None, moving_mask=None):
+        """Optimizes the transform that aligns the moving scan on the fixed scan without resampling
+        the moving scan. The multi-resolution levels are executed one by one so that the smoothed
+        fixed scan of every level can be taken from a precomputed pyramid and shared across
+        many moving scans.
+
+        If the headers of the scans are supplied and they show that the scans share the same frame
+        of reference, the scans are already aligned and the optimization is skipped: the result
+        contains the identity transform, so that only a geometry resample on the fixed grid is needed.
+
+        The masks restrict the metric sampling to a region (e.g. the patient without the background air),
+        so that fewer samples give a more stable metric and every iteration is cheaper. They can be
+        created with create_mask, create_bbox_mask or create_foreground_mask.
+
+        Args:
+            moving_scan: scan that we want to register.
+            fixed_scan: scan that we want to align on.
+            fixed_pyramid: optional SITKFixedImagePyramid built from the fixed scan, if not
+                           supplied it will be built for this registration only.
+            moving_metadata: optional DICOM dataset with the header of the moving scan.
+            fixed_metadata: optional DICOM dataset with the header of the fixed scan.
+            force_registration: if true the optimization is performed even if the headers
+                                show that the scans share the same frame of reference.
+            config: registration configuration, the configuration of the pyramid (if supplied)
+                    or the default one is used if not supplied.
+            report: optional RegistrationReport that collects the instrumentation of the registration.
+            fixed_mask: optional mask of the fixed scan, the one of the pyramid is used if not supplied.
+            moving_mask: optional mask of the moving scan.
+
+        Returns: the registration result containing the optimized transform.
+
+        """
+
+        start_time = time.perf_counter()
+
+        if not force_registration and moving_metadata is not None and fixed_metadata is not None \
+                and SITKRegistrationHelper.share_frame_of_reference(moving_metadata, fixed_metadata):
+            logger.debug(f"Skipping registration: {SHARED_FRAME_OF_REFERENCE_REASON}.")
+            registration_result = RegistrationResult(sitk.Transform(fixed_scan.GetDimension(), sitk.sitkIdentity),
+                                                     reason=SHARED_FRAME_OF_REFERENCE_REASON)
+
+            if report is not None:
+                report.finish(registration_result, time.perf_counter() - start_time)
+
+            return registration_result
+
+        if config is None:
+            config = fixed_pyramid.config if fixed_pyramid is not None else RegistrationConfig()
+
+        if fixed_pyramid is None:
+            fixed_pyramid = SITKFixedImagePyramid(fixed_scan, config)
+        elif not fixed_pyramid.is_compatible(config):
+            raise PyramidNotCompatibleException()
+
+        if fixed_mask is None:
+            fixed_mask = fixed_pyramid.fixed_mask
+
+        if report is not None:
+            report.start(config, time.perf_counter() - start_time)
+
+        registration_transform = SITKRegistrationHelper.create_initial_transform(moving_scan, fixed_scan)
+        metric_value = None
+
+        for level, fixed_level in enumerate(fixed_pyramid):
+            level_start_time = time.perf_counter()
+
+            # The fixed scan level is precomputed, the moving scan level is computed in the same way.
+            moving_level = SITKHelper.shrink_and_smooth(moving_scan, config.shrink_factors[level],
+                                                        config.smoothing_sigmas[level])
+
+            registration_method = SITKRegistrationHelper.create_registration_method(
+                moving_level, fixed_level, config=config, level=level, initial_transform=registration_transform,
+                fixed_mask=fixed_mask, moving_mask=moving_mask)
+
+            if report is not None:
+                report.observe_level(registration_method, level)
+
+            registration_transform = SITKRegistrationHelper.unwrap_transform(
+                registration_method.Execute(fixed_level, moving_level))
+            metric_value = registration_method.GetMetricValue()
+
+            if report is not None:
+                report.finish_level(registration_method, time.perf_counter() - level_start_time)
+
+        registration_result = RegistrationResult(registration_transform, metric_value, reason=OPTIMIZED_REASON)
+
+        if report is not None:
+            report.finish(registration_result, time.perf_counter() - start_time)
+
+        return registration_result
+
+    @staticmethod
+    def share_frame_of_reference(moving_metadata, fixed_metadata):
+        """Checks from the DICOM headers if two series are already spatially aligned, that is
+        they share the same FrameOfReferenceUID and have been acquired with the same scanner geometry.
+        The scanner geometry attributes of the fixed header need to be present and equal in the moving
+        header, if the fixed header has none of them the series are not considered aligned.
+
+        Args:
+            moving_metadata: DICOM dataset with the header of the moving scan.
+            fixed_metadata: DICOM dataset with the header of the fixed scan.
+
+        Returns: true if the series share the same frame of reference, false otherwise.
+
+        """
+
+        moving_frame_of_reference = getattr(moving_metadata, "FrameOfReferenceUID", None)
+        fixed_frame_of_reference = getattr(fixed_metadata, "FrameOfReferenceUID", None)
+
+        if not moving_frame_of_reference or moving_frame_of_reference != fixed_frame_of_reference:
+            return False
+
+        # The attributes present in the fixed header need to be present and equal in the moving header,
+        # the missing ones cannot prove that the series are aligned.
+        fixed_attributes = [attribute for attribute in SCANNER_GEOMETRY_ATTRIBUTES
+                            if getattr(fixed_metadata, attribute, None) is not None]
+
+        if len(fixed_attributes) == 0:
+            return False
+
+        return all(getattr(moving_metadata, attribute, None) == getattr(fixed_metadata, attribute)
+                   for attribute in fixed_attributes)
 
     @staticmethod
-    def create_registration_method(moving_scan, fixed_scan):
+    def create_mask(segmentation):
+        """Converts a segmentation, e.g. a ROI loaded from a RTSTRUCT with dicom_utils.loaders.load_roi,
+        into a mask that can be used by the registration.
+
+        Args:
+            segmentation: segmentation read by SimpleITK, the voxels different from zero are inside of the mask.
+
+        Returns: the mask as an unsigned char image.
+
+        """
+
+        return sitk.Cast(sitk.NotEqual(segmentation, 0), sitk.sitkUInt8)
+
+    @staticmethod
+    def create_bbox_mask(scan, start_vertex, stop_vertex):
+        """Creates a mask containing a bounding box, e.g. the one computed with
+        dicom_utils.processing.get_bbox_vertices.
+
+        Args:
+            scan: scan on which grid the mask is created.
+            start_vertex: physical coordinates of the first vertex of the bounding box.
+            stop_vertex: physical coordinates of the opposite vertex of the bounding box.
+
+        Returns: the mask as an unsigned char image.
+
+        """
+
+        vertices_index = np.array([scan.TransformPhysicalPointToContinuousIndex([float(x) for x in vertex])
+                                   for vertex in (start_vertex, stop_vertex)])
+
+        # The direction of the scan can flip the axes, so the vertices are sorted in index space.
+        start_index = np.clip(np.floor(vertices_index.min(axis=0)).astype(int), 0, None)
+        stop_index = np.minimum(np.ceil(vertices_index.max(axis=0)).astype(int) + 1, scan.GetSize())
+
+        mask_np = np.zeros(scan.GetSize()[::-1], dtype=np.uint8)
+        mask_np[start_index[2]:stop_index[2], start_index[1]:stop_index[1], start_index[0]:stop_index[0]] = 1
+
+        mask = sitk.GetImageFromArray(mask_np)
+        mask.CopyInformation(scan)
+
+        return mask
+
+    @staticmethod
+    def create_foreground_mask(scan, threshold=None):
+        """Creates a mask of the foreground of a scan, e.g. to exclude the background air.
+
+        Args:
+            scan: scan read by SimpleITK.
+            threshold: intensity above which a voxel is foreground, the Otsu threshold is used if not supplied.
+
+        Returns: the mask as an unsigned char image.
+
+        """
+
+        if threshold is None:
+            return sitk.OtsuThreshold(scan, 0, 1)
+
+        return sitk.Cast(scan > threshold, sitk.sitkUInt8)
+
+    @staticmethod
+    def unwrap_transform(transform):
+        """The registration method returns the optimized transform wrapped inside of a composite
+        transform, this method extracts it so that it can be used as the initial transform of the
+        next level and written on the disk.
+
+        Args:
+            transform: transform returned by the registration method.
+
+        Returns: the transform without the composite wrapper, if it wraps a single transform.
+
+        """
+
+        if transform.GetName() != "CompositeTransform":
+            return transform
+
+        composite_transform = sitk.CompositeTransform(transform)
+        composite_transform.FlattenTransform()
+
+        if composite_transform.GetNumberOfTransforms() == 1:
+            return composite_transform.GetNthTransform(0)
+
+        return composite_transform
+
+    @staticmethod
+    def compose_transforms(transforms):
+        """Composes a chain of transforms into a single one, so that a scan registered
+        through intermediate scans can be resampled only once.
+
+        Args:
+            transforms: transforms in the order they are applied to a point of the reference
+                        scan, e.g. [fixed->intermediate, intermediate->moving].
+
+        Returns: the composite transform.
+
+        """
+
+        composite_transform = sitk.CompositeTransform(3)
+
+        # The composite transform applies the last added transform first.
+        for transform in reversed(transforms):
+            composite_transform.AddTransform(transform)
+
+        return composite_transform
+
+    @staticmethod
+    def apply_transforms(scan, reference_scan, transforms, interpolator=sitk.sitkLinear, default_value=0.):
+        """Resamples a scan on the grid of a reference scan through a chain of transforms
+        with a single interpolation.
+
+        Args:
+            scan: scan that we want to resample.
+            reference_scan: scan that defines the output grid, usually the fixed scan.
+            transforms: transforms in the order they are applied to a point of the reference scan.
+            interpolator: interpolator used for the resampling.
+            default_value: value of the voxels mapped outside of the scan.
+
+        Returns: the resampled scan.
+
+        """
+
+        return sitk.Resample(scan, reference_scan, SITKRegistrationHelper.compose_transforms(transforms),
+                             interpolator, default_value)
+
+    @staticmethod
+    def apply_transforms_to_mask(mask, reference_scan, transforms):
+        """Resamples a mask (e.g. a ROI) on the grid of a reference scan, the nearest neighbour
+        interpolation keeps the labels of the mask unchanged.
+
+        Args:
+            mask: mask that we want to resample.
+            reference_scan: scan that defines the output grid, usually the fixed scan.
+            transforms: transforms in the order they are applied to a point of the reference scan.
+
+        Returns: the resampled mask.
+
+        """
+
+        return SITKRegistrationHelper.apply_transforms(mask, reference_scan, transforms,
+                                                       interpolator=sitk.sitkNearestNeighbor)
+
+    @staticmethod
+    def write_transform(transform, path):
+        """Writes a transform on the disk in a specific path.
+
+        Args:
+            transform: transform computed by the registration.
+            path: path where the transform will be written, usually with the .tfm extension.
+
+        """
+
+        sitk.WriteTransform(transform, path)
+
+    @staticmethod
+    def write_registration_result(registration_result, path):
+        """Writes the outcome of a registration on the disk as JSON, next to the transform or to
+        the registered scan, so that it is known why and how well the scans have been aligned.
+
+        Args:
+            registration_result: result of the registration.
+            path: path where the outcome will be written, usually with the .json extension.
+
+        """
+
+        with open(path, "w") as result_file:
+            json.dump({"reason": registration_result.reason, "metric_value": registration_result.metric_value},
+                      result_file, indent=2)
+
+    @staticmethod
+    def read_transform(path):
+        """Reads a transform written on the disk.
+
+        Args:
+            path: path of the transform file.
+
+        Returns: the transform.
+
+        """
+
+        return sitk.ReadTransform(path)
+
+    @staticmethod
+    def create_registration_method(moving_scan, fixed_scan, config=None, level=None, initial_transform=None,
+                                   fixed_mask=None, moving_mask=None):
         """Initializes and sets all the method necessary for the registration to
-        work. The parameters are custom tuned by hand but in future there will
-        be an option through the UI that will enable the user to toggle this parameters
-        to achieve the best results.
+        work. The parameters are taken from the registration configuration, the default
+        one contains the parameters custom tuned by hand.
 
         Args:
             moving_scan: scan that we want to register.
             fixed_scan: scan that we want to align on.
+            config: registration configuration, the default configuration is used if not supplied.
+            level: if supplied the method executes only this multi-resolution level of the configuration
+                   and the scans are expected to be already shrunk and smoothed, otherwise the method
+                   executes all the levels with the highest number of iterations of the configuration.
+            initial_transform: transform the optimization starts from, the geometrical
+                               centering of the two scans is used if not supplied.
+            fixed_mask: optional mask of the fixed scan, the metric is sampled only inside of it.
+            moving_mask: optional mask of the moving scan, the metric is sampled only inside of it.
 
-        Returns:
+        Returns: the registration method ready to be executed.
 
         """
 
+        if config is None:
+            config = RegistrationConfig()
+        if initial_transform is None:
+            initial_transform = SITKRegistrationHelper.create_initial_transform(moving_scan, fixed_scan)
+
+        if level is None:
+            shrink_factors = config.shrink_factors
+            smoothing_sigmas = config.smoothing_sigmas
+            iterations = max(config.iterations)
+        else:
+            shrink_factors = [1]
+            smoothing_sigmas = [0]
+            iterations = config.iterations[level]
+
         registration_method = sitk.ImageRegistrationMethod()
 
         # Registration parameters.
-        registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
+        registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=config.histogram_bins)
         registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-        registration_method.SetMetricSamplingPercentage(0.01)
-        registration_method.SetInterpolator(sitk.sitkBSpline)
-        registration_method.SetOptimizerAsGradientDescent(learningRate=1, numberOfIterations=100)
+        registration_method.SetMetricSamplingPercentage(config.sampling_percentage, config.sampling_seed)
+        registration_method.SetInterpolator(config.interpolator)
+
+        # The masks are defined in physical space, so they are used at full resolution on every level.
+        if fixed_mask is not None:
+            registration_method.SetMetricFixedMask(fixed_mask)
+        if moving_mask is not None:
+            registration_method.SetMetricMovingMask(moving_mask)
+
+        if config.optimizer == CONJUGATE_GRADIENT_OPTIMIZER:
+            registration_method.SetOptimizerAsConjugateGradientLineSearch(
+                learningRate=config.learning_rate, numberOfIterations=iterations,
+                convergenceMinimumValue=config.convergence_minimum_value,
+                convergenceWindowSize=config.convergence_window_size)
+        elif config.optimizer == REGULAR_STEP_GRADIENT_DESCENT_OPTIMIZER:
+            # The optimization of a level stops when the step has been relaxed below the minimum value.
+            registration_method.SetOptimizerAsRegularStepGradientDescent(
+                learningRate=config.learning_rate, minStep=config.minimum_step,
+                numberOfIterations=iterations, relaxationFactor=RELAXATION_FACTOR)
+        else:
+            registration_method.SetOptimizerAsGradientDescent(
+                learningRate=config.learning_rate, numberOfIterations=iterations,
+                convergenceMinimumValue=config.convergence_minimum_value,
+                convergenceWindowSize=config.convergence_window_size)
+
         registration_method.SetOptimizerScalesFromPhysicalShift()
-        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
-        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=shrink_factors)
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=smoothing_sigmas)
         registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-        registration_method.SetInitialTransform(
-            SITKRegistrationHelper.create_initial_transform(moving_scan, fixed_scan), inPlace=False)
+        registration_method.SetInitialTransform(initial_transform, inPlace=False)
 
         return registration_method
 
@@ -253,3 +930,335 @@ class SITKRegistrationHelper(SITKHelper):
 
         return sitk.CenteredTransformInitializer(fixed_scan, moving_scan, sitk.Euler3DTransform(),
                                                  sitk.CenteredTransformInitializerFilter.GEOMETRY)
+
+
+class RegistrationConfig:
+    """Parameters of the registration. The named presets (see REGISTRATION_PRESETS) trade
+    accuracy for speed, e.g. the fast preset for QA previews and the accurate one for the final outputs.
+
+    """
+
+    def __init__(self, shrink_factors=DEFAULT_SHRINK_FACTORS, smoothing_sigmas=DEFAULT_SMOOTHING_SIGMAS,
+                 iterations=(100, 100, 100), learning_rate=1., convergence_minimum_value=1e-6,
+                 convergence_window_size=10, sampling_percentage=0.01, sampling_seed=DEFAULT_SAMPLING_SEED,
+                 histogram_bins=50, interpolator=sitk.sitkBSpline, optimizer=GRADIENT_DESCENT_OPTIMIZER,
+                 minimum_step=1e-4):
+        """
+
+        Initialization method of the object.
+        Args:
+            shrink_factors: shrink factors of the multi-resolution levels.
+            smoothing_sigmas: smoothing sigmas (in physical units) of the multi-resolution levels.
+            iterations: maximum number of iterations of the optimizer for every level.
+            learning_rate: learning rate of the optimizer, the initial step of the regular step gradient descent.
+            convergence_minimum_value: the optimization of a level stops early when the
+                                       convergence value goes below this value.
+            convergence_window_size: number of iterations used to estimate the convergence value.
+            sampling_percentage: percentage of the voxels of the fixed scan sampled by the metric.
+            sampling_seed: seed of the random metric sampling.
+            histogram_bins: number of histogram bins of the mutual information metric.
+            interpolator: interpolator used to evaluate the moving scan.
+            optimizer: name of the optimizer, see the supported optimizers at the top of this file.
+            minimum_step: the regular step gradient descent stops a level when its step has been relaxed
+                          below this value, it replaces the convergence value and window for this optimizer.
+
+        """
+
+        assert len(shrink_factors) == len(smoothing_sigmas) == len(iterations), \
+            "Every level needs a shrink factor, a smoothing sigma and a number of iterations"
+        assert optimizer in (GRADIENT_DESCENT_OPTIMIZER, CONJUGATE_GRADIENT_OPTIMIZER,
+                             REGULAR_STEP_GRADIENT_DESCENT_OPTIMIZER), \
+            f"Optimizer {optimizer} is not supported"
+
+        self.shrink_factors = list(shrink_factors)
+        self.smoothing_sigmas = list(smoothing_sigmas)
+        self.iterations = list(iterations)
+        self.learning_rate = learning_rate
+        self.convergence_minimum_value = convergence_minimum_value
+        self.convergence_window_size = convergence_window_size
+        self.sampling_percentage = sampling_percentage
+        self.sampling_seed = sampling_seed
+        self.histogram_bins = histogram_bins
+        self.interpolator = interpolator
+        self.optimizer = optimizer
+        self.minimum_step = minimum_step
+
+    @classmethod
+    def from_preset(cls, preset_name, **kwargs):
+        """Creates the configuration of a named preset.
+
+        Args:
+            preset_name: name of the preset, one of the keys of REGISTRATION_PRESETS.
+            **kwargs: parameters that override the ones of the preset.
+
+        Returns: the registration configuration.
+
+        """
+
+        if preset_name not in REGISTRATION_PRESETS:
+            raise RegistrationPresetNotFoundException(preset_name)
+
+        return cls(**{**REGISTRATION_PRESETS[preset_name], **kwargs})
+
+    def to_dict(self):
+        """Converts the configuration to a dictionary, e.g. to save it along with the results.
+
+        Returns: a dictionary containing all the parameters.
+
+        """
+
+        return dict(vars(self))
+
+    def __len__(self):
+        return len(self.shrink_factors)
+
+
+class SITKFixedImagePyramid:
+    """Multi-resolution pyramid of a fixed scan. Building it once and passing it to
+    SITKRegistrationHelper.perform_registration avoids smoothing the fixed scan again
+    for every moving scan registered on it, e.g. all the series of a patient or many
+    patients registered on the same atlas.
+
+    """
+
+    def __init__(self, fixed_scan, config=None, fixed_mask=None):
+        """
+
+        Initialization method of the object.
+        Args:
+            fixed_scan: scan that the moving scans will be aligned on.
+            config: registration configuration defining the multi-resolution levels,
+                    the default configuration is used if not supplied.
+            fixed_mask: optional mask of the fixed scan used by all the registrations.
+
+        """
+
+        self.fixed_scan = fixed_scan
+        self.config = config if config is not None else RegistrationConfig()
+        self.fixed_mask = fixed_mask
+        self.levels = [SITKHelper.shrink_and_smooth(fixed_scan, shrink_factor, smoothing_sigma) for
+                       shrink_factor, smoothing_sigma in zip(self.config.shrink_factors, self.config.smoothing_sigmas)]
+
+    @classmethod
+    def from_path(cls, scan_path, config=None, fixed_mask=None):
+        """Loads the DICOM series of the fixed scan and builds its pyramid.
+
+        Args:
+            scan_path: path of the folder containing the DICOM files of the fixed scan.
+            config: registration configuration defining the multi-resolution levels.
+            fixed_mask: optional mask of the fixed scan used by all the registrations.
+
+        Returns: the pyramid of the fixed scan.
+
+        """
+
+        return cls(sitk.Cast(SITKHelper.load_series(scan_path), sitk.sitkFloat32), config, fixed_mask)
+
+    def is_compatible(self, config):
+        """Checks if the pyramid can be used for a registration with a specific configuration.
+
+        Args:
+            config: registration configuration.
+
+        Returns: true if the configuration has the same multi-resolution levels of the pyramid.
+
+        """
+
+        return self.config.shrink_factors == config.shrink_factors and \
+               self.config.smoothing_sigmas == config.smoothing_sigmas
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __iter__(self):
+        return iter(self.levels)
+
+
+class RegistrationReport:
+    """Instrumentation of a single registration: metric value of every iteration, wall time,
+    stop condition and number of sampled points of every level, and the total time.
+    The values are collected with a callback that only appends a number per iteration,
+    so that it can stay enabled on batch runs.
+
+    """
+
+    def __init__(self, name=None):
+        """
+
+        Initialization method of the object.
+        Args:
+            name: name of the registration, e.g. the moving and fixed series.
+
+        """
+
+        self.name = name
+        self.config = None
+        self.setup_time = None
+        self.levels = []
+        self.reason = None
+        self.metric_value = None
+        self.total_time = None
+        self.cached = False
+
+    def start(self, config, setup_time):
+        """Records the configuration of the registration.
+
+        Args:
+            config: registration configuration.
+            setup_time: time spent before the optimization, e.g. to build the fixed pyramid.
+
+        """
+
+        self.config = config.to_dict()
+        self.setup_time = setup_time
+
+    def observe_level(self, registration_method, level):
+        """Attaches the callback collecting the metric values to the registration method of a level.
+
+        Args:
+            registration_method: registration method of the level.
+            level: index of the multi-resolution level.
+
+        """
+
+        metric_values = []
+        self.levels.append({"level": level, "metric_values": metric_values})
+
+        registration_method.AddCommand(sitk.sitkIterationEvent,
+                                       lambda: metric_values.append(registration_method.GetMetricValue()))
+
+    def finish_level(self, registration_method, level_time):
+        """Records the outcome of the level that has just been executed.
+
+        Args:
+            registration_method: registration method of the level.
+            level_time: wall time of the level in seconds.
+
+        """
+
+        self.levels[-1].update({
+            "time": level_time,
+            "iterations": registration_method.GetOptimizerIteration(),
+            "stop_condition": registration_method.GetOptimizerStopConditionDescription(),
+            "sampled_points": registration_method.GetMetricNumberOfValidPoints(),
+            "metric_value": registration_method.GetMetricValue(),
+        })
+
+    def finish(self, registration_result, total_time, cached=False):
+        """Records the outcome of the registration.
+
+        Args:
+            registration_result: result of the registration.
+            total_time: total wall time of the registration in seconds.
+            cached: if true the result has been read from a RegistrationCache instead of being computed.
+
+        """
+
+        self.reason = registration_result.reason
+        self.metric_value = registration_result.metric_value
+        self.total_time = total_time
+        self.cached = cached
+
+    @property
+    def iterations(self):
+        return sum(level_report.get("iterations", 0) for level_report in self.levels)
+
+    def to_dict(self):
+        """Converts the report to a dictionary that can be serialized as JSON.
+
+        Returns: a dictionary containing the report.
+
+        """
+
+        return {
+            "name": self.name,
+            "reason": self.reason,
+            "metric_value": self.metric_value,
+            "total_time": self.total_time,
+            "cached": self.cached,
+            "setup_time": self.setup_time,
+            "iterations": self.iterations,
+            "config": self.config,
+            "levels": self.levels,
+        }
+
+    def write_json(self, path):
+        """Writes the report on the disk as JSON.
+
+        Args:
+            path: path where the report will be written.
+
+        """
+
+        with open(path, "w") as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+
+class RegistrationBatchReport:
+    """Aggregates the reports of the registrations of a batch run, to find out which series
+    and parameters take most of the compute time.
+
+    """
+
+    def __init__(self):
+        self.reports = []
+
+    def create_report(self, name=None):
+        """Creates a report for a new registration of the batch.
+
+        Args:
+            name: name of the registration, e.g. the moving and fixed series.
+
+        Returns: the report, that needs to be passed to the registration.
+
+        """
+
+        report = RegistrationReport(name)
+        self.reports.append(report)
+
+        return report
+
+    def to_dict(self, slowest=10):
+        """Converts the aggregated report to a dictionary that can be serialized as JSON.
+
+        Args:
+            slowest: number of slowest registrations that are listed in the summary.
+
+        Returns: a dictionary containing the summary of the batch and all the single reports.
+
+        """
+
+        finished_reports = [report for report in self.reports if report.total_time is not None]
+        times = [report.total_time for report in finished_reports]
+
+        time_by_reason = {}
+        for report in finished_reports:
+            time_by_reason[report.reason] = time_by_reason.get(report.reason, 0.) + report.total_time
+
+        slowest_reports = sorted(finished_reports, key=lambda report: report.total_time, reverse=True)[:slowest]
+
+        return {
+            "summary": {
+                "registrations": len(finished_reports),
+                "cached_registrations": sum(report.cached for report in finished_reports),
+                "total_time": float(np.sum(times)) if times else 0.,
+                "mean_time": float(np.mean(times)) if times else None,
+                "max_time": float(np.max(times)) if times else None,
+                "total_iterations": sum(report.iterations for report in finished_reports),
+                "time_by_reason": time_by_reason,
+                "slowest": [{"name": report.name, "total_time": report.total_time} for report in slowest_reports],
+            },
+            "registrations": [report.to_dict() for report in finished_reports],
+        }
+
+    def write_json(self, path, slowest=10):
+        """Writes the aggregated report on the disk as JSON.
+
+        Args:
+            path: path where the report will be written.
+            slowest: number of slowest registrations that are listed in the summary.
+
+        """
+
+        with open(path, "w") as report_file:
+            json.dump(self.to_dict(slowest), report_file, indent=2)
@@ -0,0 +1,149 @@
+"""This module contains the scheduler used to run batch processing (registration, resampling,
+conversion) on many scans. SimpleITK uses by default one thread per core for every filter,
+so running many jobs in parallel processes oversubscribes the machine: the scheduler splits
+the cores between the worker processes and the ITK threads of every process.
+
+"""
+
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import SimpleITK as sitk
+
+# Number of ITK threads per worker used when the scheduler is not calibrated, registration and
+# resampling scale well up to few threads so most of the cores are used by the processes.
+DEFAULT_THREADS_PER_WORKER = 2
+
+# Setting up the logger.
+logger = logging.getLogger("pycomed scheduling.py logger")
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+def _set_number_of_threads(threads):
+    """Initializer of the worker processes, it limits the number of threads used by ITK.
+
+    Args:
+        threads: number of threads of every ITK filter in the process.
+
+    """
+
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+class ThreadBudgetScheduler:
+    """Runs a function on many items splitting a budget of threads between worker processes
+    (inter-job parallelism) and ITK threads inside of every process (intra-job parallelism).
+
+    """
+
+    def __init__(self, total_threads=None, workers=None, threads_per_worker=None):
+        """
+
+        Initialization method of the object.
+        Args:
+            total_threads: total number of threads that can be used, all the cores of the
+                           machine if not specified.
+            workers: number of worker processes, derived from the threads per worker if not specified.
+            threads_per_worker: number of ITK threads of every worker, derived from the number
+                                of workers if not specified.
+
+        """
+
+        self.total_threads = total_threads if total_threads is not None else os.cpu_count()
+
+        if workers is None and threads_per_worker is None:
+            threads_per_worker = min(DEFAULT_THREADS_PER_WORKER, self.total_threads)
+
+        self.set_split(workers, threads_per_worker)
+
+    def set_split(self, workers=None, threads_per_worker=None):
+        """Sets how the thread budget is split, the missing value is derived from the other one.
+
+        Args:
+            workers: number of worker processes.
+            threads_per_worker: number of ITK threads of every worker.
+
+        """
+
+        assert workers is not None or threads_per_worker is not None, \
+            "Either workers or threads_per_worker should be defined"
+
+        if workers is None:
+            workers = self.total_threads // threads_per_worker
+        elif threads_per_worker is None:
+            threads_per_worker = self.total_threads // workers
+
+        self.workers = max(1, int(workers))
+        self.threads_per_worker = max(1, int(threads_per_worker))
+
+    def map(self, function, items, chunksize=1):
+        """Runs a function on every item, in parallel with the current split of the thread budget.
+
+        Args:
+            function: function to run, it needs to be defined at the top level of a module
+                      so that it can be sent to the worker processes.
+            items: items passed one by one to the function.
+            chunksize: number of items sent at once to a worker.
+
+        Returns: the list of the results, in the same order of the items.
+
+        """
+
+        if self.workers == 1:
+            # A single job at a time, all the threads are given to ITK without starting processes.
+            previous_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+            _set_number_of_threads(self.threads_per_worker)
+
+            try:
+                return [function(item) for item in items]
+            finally:
+                _set_number_of_threads(previous_threads)
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_set_number_of_threads,
+                                 initargs=(self.threads_per_worker,)) as executor:
+            return list(executor.map(function, items, chunksize=chunksize))
+
+    def calibrate(self, function, sample_item, candidates=None):
+        """Chooses the split of the thread budget with a quick calibration run: for every candidate
+        number of threads per worker, as many copies of a sample item as workers are run concurrently
+        through map, and the throughput of the whole machine is the number of jobs divided by the
+        time of the run. The contention between the workers (memory bandwidth, caches, disk) and the
+        start of the worker processes are then part of the measure.
+
+        Args:
+            function: function that will be run on the items, defined at the top level of a module.
+            sample_item: item representative of the batch, e.g. a registration of average size.
+            candidates: candidate numbers of threads per worker, powers of two up to the
+                        total number of threads if not specified.
+
+        Returns: a dictionary with the measured throughput (jobs per second) of every candidate.
+
+        """
+
+        if candidates is None:
+            candidates = [2 ** exponent for exponent in range(self.total_threads.bit_length())
+                          if 2 ** exponent <= self.total_threads]
+
+        throughputs = {}
+
+        # Warm up run, so that the first candidate is not penalized by loading and caching.
+        self.set_split(threads_per_worker=self.total_threads)
+        self.map(function, [sample_item])
+
+        for threads_per_worker in candidates:
+            self.set_split(threads_per_worker=threads_per_worker)
+
+            start = time.perf_counter()
+            self.map(function, [sample_item] * self.workers)
+            elapsed = time.perf_counter() - start
+
+            throughputs[threads_per_worker] = self.workers / elapsed
+            logger.debug(f"Calibration with {self.workers} workers and {threads_per_worker} threads per worker: "
+                         f"{throughputs[threads_per_worker]:.3f} jobs/s.")
+
+        self.set_split(threads_per_worker=max(throughputs, key=throughputs.get))
+
+        return throughputs
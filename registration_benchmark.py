@@ -0,0 +1,103 @@
+import time
+
+import SimpleITK as sitk
+import numpy as np
+
+import pycomed
+
+# Size (x, y, z) and spacing of the synthetic scans.
+SIZE = (160, 160, 96)
+SPACING = (1., 1., 1.5)
+# Ground truth Euler transform (rotations in radians, translations in mm) applied to the moving scan.
+GROUND_TRUTH_PARAMETERS = (0.05, -0.03, 0.08, 4., -6., 3.)
+# Seeds of the synthetic scans and ground truth parameters of the benchmarked registrations,
+# the times and errors are averaged over them.
+BENCHMARK_CASES = [
+    (0, GROUND_TRUTH_PARAMETERS),
+    (1, (-0.04, 0.06, -0.05, -5., 3., -4.)),
+    (2, (0.07, 0.02, -0.06, 3., 5., 6.)),
+]
+
+
+def create_synthetic_scan(seed=0):
+    """Creates a synthetic scan made of gaussian blobs of different intensities plus noise.
+
+    """
+
+    random_state = np.random.RandomState(seed)
+    z, y, x = np.meshgrid(*[np.arange(s, dtype=np.float32) for s in SIZE[::-1]], indexing='ij')
+    scan_np = np.zeros(SIZE[::-1], dtype=np.float32)
+
+    for _ in range(12):
+        center = [random_state.uniform(0.25, 0.75) * s for s in SIZE[::-1]]
+        sigma = random_state.uniform(4, 20, size=3)
+        scan_np += random_state.uniform(50, 200) * np.exp(-(((z - center[0]) / sigma[0]) ** 2 +
+                                                           ((y - center[1]) / sigma[1]) ** 2 +
+                                                           ((x - center[2]) / sigma[2]) ** 2))
+    scan_np += random_state.normal(0, 5, size=scan_np.shape).astype(np.float32)
+
+    scan = sitk.GetImageFromArray(scan_np)
+    scan.SetSpacing(SPACING)
+
+    return scan
+
+
+def create_ground_truth_transform(fixed_scan, parameters=GROUND_TRUTH_PARAMETERS):
+    """Creates the transform used to move the fixed scan.
+
+    """
+
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(fixed_scan.TransformContinuousIndexToPhysicalPoint(np.array(fixed_scan.GetSize()) / 2.))
+    transform.SetParameters(parameters)
+
+    return transform
+
+
+def get_registration_error(transform, ground_truth_transform, fixed_scan):
+    """Mean distance in mm, over the corners of the fixed scan, between the points mapped by
+    the ground truth transform composed with the recovered one and the original points.
+
+    """
+
+    errors = []
+    for corner in np.ndindex(2, 2, 2):
+        point = np.array(fixed_scan.TransformIndexToPhysicalPoint(
+            [int(c * (s - 1)) for c, s in zip(corner, fixed_scan.GetSize())]))
+        mapped_point = np.array(ground_truth_transform.TransformPoint(transform.TransformPoint(point)))
+        errors.append(np.linalg.norm(mapped_point - point))
+
+    return np.mean(errors)
+
+
+def main():
+    cases = []
+    for seed, parameters in BENCHMARK_CASES:
+        fixed_scan = create_synthetic_scan(seed)
+        ground_truth_transform = create_ground_truth_transform(fixed_scan, parameters)
+        moving_scan = sitk.Resample(fixed_scan, fixed_scan, ground_truth_transform, sitk.sitkLinear, 0.)
+        cases.append((moving_scan, fixed_scan, ground_truth_transform))
+
+    print("{0:10} {1:>10} {2:>14} {3:>16}".format("preset", "time [s]", "final metric", "error [mm]"))
+
+    for preset_name in pycomed.REGISTRATION_PRESETS:
+        config = pycomed.RegistrationConfig.from_preset(preset_name)
+
+        times = []
+        metric_values = []
+        registration_errors = []
+        for moving_scan, fixed_scan, ground_truth_transform in cases:
+            start = time.perf_counter()
+            registration_result = pycomed.SITKRegistrationHelper.compute_registration(moving_scan, fixed_scan,
+                                                                                      config=config)
+            times.append(time.perf_counter() - start)
+            metric_values.append(registration_result.metric_value)
+            registration_errors.append(get_registration_error(registration_result.transform, ground_truth_transform,
+                                                              fixed_scan))
+
+        print("{0:10} {1:10.2f} {2:14.5f} {3:16.3f}".format(preset_name, np.mean(times), np.mean(metric_values),
+                                                            np.mean(registration_errors)))
+
+
+if __name__ == '__main__':
+    main()
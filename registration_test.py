@@ -1,16 +1,23 @@
 import os
 import SimpleITK as sitk
-import matplotlib.pyplot as plt
 import dicom_utils as du
+import json
 import logging
+import numpy as np
 import sys
+import tempfile
 from collections import defaultdict
 
+import pycomed
+import registration_benchmark
+
 logger = logging.getLogger("Registration logger")
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 
 def print_image(image):
+    import matplotlib.pyplot as plt
+
     np = sitk.GetArrayFromImage(image)
     plt.imshow(np[int(np.size(np, 0) / 2), :, :])
     plt.show()
@@ -19,30 +26,153 @@ def print_image(image):
 ROOT_PATH = f'/Volumes/SamsungT5/OPBG_Data/by_type/MB_by_sequence'
 OUTPUT_PATH = f'/Volumes/SamsungT5/OPBG_Data/by_type/MB_registered'
 
-dictionary = defaultdict(lambda: 0)
+# Parameters of the registration before the presets were introduced, the default configuration must keep them.
+BASELINE_REGISTRATION_PARAMETERS = {
+    "shrink_factors": [4, 2, 1],
+    "smoothing_sigmas": [2, 1, 0],
+    "iterations": [100, 100, 100],
+    "learning_rate": 1.,
+    "convergence_minimum_value": 1e-6,
+    "convergence_window_size": 10,
+    "sampling_percentage": 0.01,
+    "histogram_bins": 50,
+    "interpolator": sitk.sitkBSpline,
+    "optimizer": pycomed.GRADIENT_DESCENT_OPTIMIZER,
+}
+
+
+def count_scan_sizes():
+    dictionary = defaultdict(lambda: 0)
+
+    # Loops over patients.
+    for patient_code in filter(lambda path: not path.startswith('.'), os.listdir(ROOT_PATH)):
+        logger.debug(f"Analyzing patient dir: {os.path.join(ROOT_PATH, patient_code)}")
+        patient_path = os.path.join(ROOT_PATH, patient_code)
+        patient_scans_paths = []
+
+        # Loops over the scans of the patient.
+        for patient_scan_number in os.listdir(patient_path):
+            logger.debug(f"Sequence found in dir: {os.path.join(patient_code, patient_scan_number)}")
+            patient_scans_paths.append(os.path.join(patient_code, patient_scan_number))
+
+        # Finds the reference image inside of the patient folder and
+        # returns an array with all the scans.
+        scans, ref_scan_index = du.read_scans_and_find_ref_scan(patient_scans_paths)
+
+        for s in scans:
+            w, h, d = s.scan.GetWidth(), s.scan.GetHeight(), s.scan.GetDepth()
+            t = (w, h, d)
+            dictionary[t] += 1
+
+    for k, v in dictionary.items():
+        print(k, v)
+
+
+def test_default_registration_parity():
+    config = pycomed.RegistrationConfig()
+    config_dict = config.to_dict()
+    for name, value in BASELINE_REGISTRATION_PARAMETERS.items():
+        assert config_dict[name] == value, f"{name}: {config_dict[name]} != {value}"
+    assert config_dict == pycomed.RegistrationConfig.from_preset("default").to_dict()
+
+    fixed_scan = registration_benchmark.create_synthetic_scan(0)
+    ground_truth_transform = registration_benchmark.create_ground_truth_transform(fixed_scan)
+    moving_scan = sitk.Resample(fixed_scan, fixed_scan, ground_truth_transform, sitk.sitkLinear, 0.)
+
+    errors = {}
+    parameters = None
+    for preset_name in ["fast", "default", "accurate"]:
+        registration_result = pycomed.SITKRegistrationHelper.compute_registration(
+            moving_scan, fixed_scan, config=pycomed.RegistrationConfig.from_preset(preset_name))
+        errors[preset_name] = registration_benchmark.get_registration_error(registration_result.transform,
+                                                                            ground_truth_transform, fixed_scan)
+        if preset_name == "default":
+            parameters = registration_result.transform.GetParameters()
+    logger.debug(f"Registration errors of the presets: {errors}")
+
+    # Without a configuration the registration must be the same as the one of the default preset.
+    registration_result = pycomed.SITKRegistrationHelper.compute_registration(moving_scan, fixed_scan)
+    assert registration_result.transform.GetParameters() == parameters
+
+    # The accuracy grows from the fast preset to the accurate one.
+    assert errors["fast"] > errors["default"] > errors["accurate"]
+
+
+def write_synthetic_series(shift, folder, series_number, frame_of_reference_uid):
+    # Two gaussian blobs moved by the shift (z, y, x) in voxels.
+    z, y, x = np.mgrid[:40, :48, :48].astype(np.float32)
+    center = np.array([20, 24, 24]) + np.array(shift)
+    voxels = 100 * np.exp(-(((z - center[0]) / 6) ** 2 + ((y - center[1]) / 10) ** 2 + ((x - center[2]) / 8) ** 2))
+    voxels += 60 * np.exp(-(((z - center[0] - 5) / 3) ** 2 + ((y - center[1] + 6) / 4) ** 2 +
+                            ((x - center[2] - 4) / 3) ** 2))
+    scan = sitk.GetImageFromArray((voxels * 10).astype(np.int16))
+    scan.SetSpacing((1., 1., 1.5))
+
+    os.makedirs(folder)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    series_uid = f'1.2.826.0.1.3680043.2.1125.2.{series_number}'
+    for i in range(scan.GetDepth()):
+        scan_slice = scan[:, :, i]
+        tags = {'0010|0010': 'P1', '0020|0011': str(series_number), '0020|000e': series_uid,
+                '0020|0052': frame_of_reference_uid, '0008|0060': 'MR', '0020|0013': str(i + 1),
+                '0020|0032': '\\'.join(map(str, scan.TransformIndexToPhysicalPoint((0, 0, i)))),
+                '0020|0037': '1\\0\\0\\0\\1\\0', '0008|0016': '1.2.840.10008.5.1.4.1.1.4',
+                '0008|0018': f'{series_uid}.{i}'}
+        for tag, value in tags.items():
+            scan_slice.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(folder, f'IM{i:04d}.dcm'))
+        writer.Execute(scan_slice)
+
+
+def test_export_channel_alignment():
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_path, output_path = os.path.join(directory, 'dataset'), os.path.join(directory, 'tensors')
+        write_synthetic_series((0, 0, 0), os.path.join(dataset_path, 'P1', '1'), 1, '1.2.3.1')
+        write_synthetic_series((2, 3, -2), os.path.join(dataset_path, 'P1', '2'), 2, '1.2.3.2')
+        write_synthetic_series((1, 1, 1), os.path.join(dataset_path, 'P1', '3'), 3, '1.2.3.3')
 
-# Loops over patients.
-for patient_code in filter(lambda path: not path.startswith('.'), os.listdir(ROOT_PATH)):
-    logger.debug(f"Analyzing patient dir: {os.path.join(ROOT_PATH, patient_code)}")
-    patient_path = os.path.join(ROOT_PATH, patient_code)
-    patient_scans_paths = []
+        dataset_reader = pycomed.DICOMDatasetReader(pycomed.DICOMDatasetOrganizer(
+            dataset_path, os.path.join(directory, 'organized')))
+        # A file that is not DICOM replaces a slice of a series after the organization, its metadata cannot be
+        # read. The number of files does not change, so the series is not chosen as the fixed scan.
+        os.remove(os.path.join(dataset_reader.dataset_path, 'P1', '3', 'IM0039.dcm'))
+        with open(os.path.join(dataset_reader.dataset_path, 'P1', '3', 'DIRFILE'), 'w') as not_dicom_file:
+            not_dicom_file.write('not a DICOM file')
 
-    # Loops over the scans of the patient.
-    for patient_scan_number in os.listdir(patient_path):
-        logger.debug(f"Sequence found in dir: {os.path.join(patient_code, patient_scan_number)}")
-        patient_scans_paths.append(os.path.join(patient_code, patient_scan_number))
+        cache = pycomed.RegistrationCache(os.path.join(directory, 'cache'))
+        exporter = pycomed.PatientTensorExporter(dataset_reader, output_path, cache=cache,
+                                                 scheduler=pycomed.ThreadBudgetScheduler(workers=1))
+        array_path = exporter.export('P1')
+        channels = np.load(array_path)
+        with open(os.path.join(output_path, 'P1', pycomed.CHANNELS_METADATA_FILE_NAME)) as metadata_file:
+            metadata = json.load(metadata_file)
 
-    # Finds the reference image inside of the patient folder and
-    # returns an array with all the scans.
-    scans, ref_scan_index = du.read_scans_and_find_ref_scan(patient_scans_paths)
+        # The channel that fails is recorded and the other channels are exported.
+        assert [channel['channel'] for channel in metadata['channels']] == [0, 1]
+        assert [channel['channel'] for channel in metadata['failed']] == [2]
+        assert not channels[2].any()
 
-    for s in scans:
-       w, h, d = s.scan.GetWidth(), s.scan.GetHeight(), s.scan.GetDepth()
-       t = (w, h, d)
-       dictionary[t] += 1
+        # The moving channel is aligned on the fixed one.
+        fixed_channel, moving_channel = channels[0], channels[1]
+        unregistered_channel = sitk.GetArrayFromImage(pycomed.SITKHelper.resample(
+            sitk.Cast(pycomed.SITKHelper.load_series(metadata['channels'][1]['path']), sitk.sitkFloat32),
+            spacing=(1., 1., 1.)))
+        registered_error = np.abs(moving_channel - fixed_channel).mean()
+        unregistered_error = np.abs(unregistered_channel - fixed_channel).mean()
+        logger.debug(f"Export errors, registered: {registered_error}, unregistered: {unregistered_error}")
+        assert registered_error < 0.2 * unregistered_error
 
-for k, v in dictionary.items():
-    print(k, v)
+        # A transform written before is not trusted, the cached one (keyed on the scans) is used again.
+        transform_path = metadata['channels'][1]['transform']
+        pycomed.SITKRegistrationHelper.write_transform(sitk.TranslationTransform(3, (10., 0., 0.)), transform_path)
+        exporter.export('P1')
+        assert np.array_equal(np.load(array_path)[1], moving_channel)
 
 
+if __name__ == '__main__':
+    test_default_registration_parity()
+    test_export_channel_alignment()
 
+    if os.path.exists(ROOT_PATH):
+        count_scan_sizes()
@@ -1,8 +1,16 @@
+import os
+import tempfile
+
 import SimpleITK as sitk
-import matplotlib.pyplot as plt
 import numpy as np
 
 import dicom_utils as du
+import dicom_utils.augmentation
+import dicom_utils.index
+import pycomed
+import pycomed.io.sampling
+
+DATA_PATH = f'/Volumes/Samsung T5/OPBG_Data'
 
 
 def command_iteration(method):
@@ -11,7 +19,107 @@ def command_iteration(method):
                                            method.GetOptimizerPosition()))
 
 
+def test_patch_sampler():
+    random_state = np.random.RandomState(0)
+    patch_size = (8, 12, 12)
+
+    with tempfile.TemporaryDirectory() as directory:
+        volumes, samples, labels = [], [], []
+        for i in range(3):
+            volume = random_state.normal(size=(30 + i * 10, 40, 36)).astype(np.float32)
+            label = np.zeros(volume.shape, dtype=np.uint8)
+            label[20:23, 5:9, 30:34] = 1
+            volumes.append(volume)
+
+            samples.append(os.path.join(directory, f'volume_{i}'))
+            pycomed.ChunkedVolumeStore.write(samples[-1], volume, chunk_shape=(8, 16, 16))
+            labels.append(os.path.join(directory, f'label_{i}.nii'))
+            sitk.WriteImage(sitk.GetImageFromArray(label), labels[-1])
+
+        sampler = pycomed.PatchSampler(samples, patch_size, labels=labels, foreground_probability=1., seed=1)
+        sampler.prepare()
+        # Only the cumulative counts of the slices are kept, the last one is the size of the label.
+        for i in range(3):
+            assert sampler.get_foreground(i).shape == (volumes[i].shape[0],)
+            assert sampler.get_foreground(i)[-1] == 3 * 4 * 4
+
+        for index in range(50):
+            patch = sampler.sample(index)
+            start = np.array(patch["start"])
+            volume = volumes[patch["sample"]]
+            assert patch["image"].shape == (1,) + patch_size and patch["label"].shape == patch_size
+            # The patches of the foreground are inside of the volume and they contain the label.
+            assert np.all(start >= 0) and np.all(start + patch_size <= volume.shape)
+            assert patch["label"].any()
+            assert np.array_equal(patch["image"][0], volume[tuple(slice(a, a + s) for a, s in zip(start, patch_size))])
+
+        # The least recently used volumes are closed when too many are open.
+        first_patch = sampler.sample(0)
+        for volume in sampler._volumes.values():
+            pycomed.PatchSamplerHelper.close_volume(volume)
+        maximum_open_volumes = pycomed.io.sampling.MAX_OPEN_VOLUMES
+        pycomed.io.sampling.MAX_OPEN_VOLUMES = 2
+        sampler = pycomed.PatchSampler(samples, patch_size, labels=labels, foreground_probability=1., seed=1)
+        try:
+            first_store = sampler.get_volume(0)
+            first_store.read((0, 0, 0), (1, 1, 1))
+            sampler.get_volume(1)
+            sampler.get_volume(2)
+            assert len(sampler._volumes) == 2 and first_store._chunks_file is None
+            # The evicted volumes are opened again when they are needed.
+            assert np.array_equal(sampler.sample(0)["image"], first_patch["image"])
+        finally:
+            pycomed.io.sampling.MAX_OPEN_VOLUMES = maximum_open_volumes
+            for volume in sampler._volumes.values():
+                pycomed.PatchSamplerHelper.close_volume(volume)
+
+
+def test_cached_intensity_stats():
+    random_state = np.random.RandomState(0)
+    size = (24, 32, 32)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(2):
+            paths.append(os.path.join(directory, f'image_{i}.nii'))
+            image_np = random_state.normal(100 * (i + 1), 10, size=(20, 24, 24)).astype(np.float32)
+            sitk.WriteImage(sitk.GetImageFromArray(image_np), paths[-1])
+
+        index_path = os.path.join(directory, 'index.json')
+        index = du.DatasetIndex(index_path)
+        stats_list = [index.get_intensity_stats(path) for path in paths]
+        index.save()
+
+        # The statistics of the saved index are reused, they are not computed again.
+        compute_intensity_stats = dicom_utils.index.compute_intensity_stats
+        dicom_utils.index.compute_intensity_stats = None
+        try:
+            index = du.DatasetIndex(index_path)
+            assert [index.get_intensity_stats(path) for path in paths] == stats_list
+        finally:
+            dicom_utils.index.compute_intensity_stats = compute_intensity_stats
+
+        # Without statistics the voxels mapped outside of the image get the exact median, as before the index.
+        image_list = [sitk.ReadImage(path) for path in paths]
+        augmented_list = dicom_utils.augmentation.augment_morph(image_list, random_state=np.random.RandomState(1))
+        transform = dicom_utils.augmentation.morph_transform(image_list[0], random_state=np.random.RandomState(1))
+        for image, augmented_image in zip(image_list, augmented_list):
+            out_value = int(100 * np.nanmedian(sitk.GetArrayViewFromImage(image))) / 100
+            expected_image = sitk.Resample(image, image, transform, sitk.sitkBSpline, out_value)
+            assert np.array_equal(sitk.GetArrayViewFromImage(augmented_image),
+                                  sitk.GetArrayViewFromImage(expected_image))
+
+        # The padding of the batches is the mean of the statistics of the index.
+        batch = next(dicom_utils.augmentation.augmented_batches([paths], 1, size, n_workers=0, shuffle=False,
+                                                                index=index))
+        for j, stats in enumerate(stats_list):
+            assert np.isclose(batch[0, j, 0, 0, 0], stats['mean'])
+        assert np.allclose(du.to_numpy(image_list[0], size, stats=stats_list[0])[0], stats_list[0]['mean'])
+
+
 def main():
+    import matplotlib.pyplot as plt
+
     PATH_1 = f'/Volumes/Samsung T5/OPBG_Data/by_type/MB_by_sequence/OPBG0001_20180622_091540174/11'
     PATH_2 = f'/Volumes/Samsung T5/OPBG_Data/by_type/MB_by_sequence/OPBG0001_20180622_091540174/8'
     moving_image = du.load_series(PATH_1)
@@ -34,4 +142,8 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    test_patch_sampler()
+    test_cached_intensity_stats()
+
+    if os.path.exists(DATA_PATH):
+        main()